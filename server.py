@@ -1,6 +1,14 @@
 #!/usr/bin/python3
 # encoding: utf8
+import argparse
+import contextlib
+import functools
+import json
 import logging
+import math
+import os
+import threading
+import time
 from math import atan2
 from math import cos
 from math import pi
@@ -9,9 +17,24 @@ from math import sqrt
 
 import psycopg2
 from flask import Flask
+from flask import Response
+from flask import abort
 from flask import jsonify
 from flask import request
 
+from tlparser import link_corridor
+from tlparser import mvt
+from tlparser import sqlite_storage
+from tlparser.connection_pool import ConnectionPool
+from tlparser.connection_pool import execute_prepared
+from tlparser.database import SQLITE_PREFIX
+from tlparser.database import connect
+from tlparser.database import is_sqlite
+from tlparser.link_frequency import WEEKDAYS
+from tlparser.response_cache import ExpiringCache
+from tlparser.response_cache import ResponseCache
+from tlparser.table_definitions import dataset_version
+
 app = Flask(__name__, static_url_path='')
 
 DEC2FLOAT = psycopg2.extensions.new_type(
@@ -29,18 +52,56 @@ BASIC_INFO = {
     }
 }
 
+# "sqlite:FILENAME" for a database made with `--database sqlite:FILENAME`
+DATABASE = os.environ.get("TRAVELINEDATA_DATABASE", "dbname=travelinedata")
+
+# postgres connections are kept between requests (sqlite ones are cheap)
+POOL = None if DATABASE.startswith(SQLITE_PREFIX) else ConnectionPool(
+    DATABASE,
+    size=int(os.environ.get("TRAVELINEDATA_POOL_SIZE", 10)),
+    statement_timeout=10)
+
+# Responses are kept (in memory, and on disk if there's a directory)
+# until --matview changes the data: see tlparser/response_cache.py
+RESPONSE_CACHE = ResponseCache(
+    directory=os.environ.get("TRAVELINEDATA_CACHE_DIR"),
+    memory_bytes=int(os.environ.get("TRAVELINEDATA_CACHE_MEMORY_MB", 64)) << 20,
+    disk_bytes=int(os.environ.get("TRAVELINEDATA_CACHE_DISK_MB", 1024)) << 20)
+
+# The geojson features for a bbox, snapped outwards to a grid so that
+# people looking at about the same place share them: see _snap_bbox()
+BBOX_CACHE = ExpiringCache(
+    memory_bytes=int(os.environ.get("TRAVELINEDATA_BBOX_CACHE_MB", 64)) << 20,
+    ttl_seconds=600)
+# the grid is at least this many cells across the bbox
+BBOX_CELLS = 8
+# 2 ** -12 degrees is about 25m
+BBOX_MIN_CELL_EXPONENT = -12
+
+# how often to look for a new dataset_version
+VERSION_CHECK_SECONDS = 10
+
+# tiles only change when --matview runs
+TILE_MAX_AGE = 3600
+TILE_LIMIT = 5000
+TILE_MAX_ZOOM = 18
+
 EARTH_RADIUS_KM = 6371
 MILES_PER_KM = 0.6213712
 
 
+@contextlib.contextmanager
 def database():
-    return psycopg2.connect("dbname=travelinedata")
-
-
-def statement_timeout(conn, seconds):
-    millis = int(seconds * 1000)
-    with conn.cursor() as cur:
-        cur.execute("SET statement_timeout TO %s;", (millis,))
+    if POOL is not None:
+        with POOL.connection() as conn:
+            yield conn
+        return
+    conn = connect(DATABASE)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
 
 
 def json_response(data):
@@ -48,6 +109,51 @@ def json_response(data):
     return jsonify(data)
 
 
+_version_lock = threading.Lock()
+_version = {"checked": 0, "version": None}
+
+
+def current_dataset_version():
+    with _version_lock:
+        if time.time() - _version["checked"] > VERSION_CHECK_SECONDS:
+            with database() as conn:
+                _version["version"] = dataset_version(conn)
+            _version["checked"] = time.time()
+        return _version["version"]
+
+
+def cached(mimetype, max_age=None):
+    """Keeps the response in RESPONSE_CACHE, for the same url and data"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            version = current_dataset_version()
+            key = request.full_path
+            data = RESPONSE_CACHE.get(version, key)
+            if data is None:
+                response = view(*args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                data = response.get_data()
+                RESPONSE_CACHE.put(version, key, data)
+            response = Response(data, mimetype=mimetype)
+            if max_age is not None:
+                response.headers["Cache-Control"] = "public, max-age=%d" % (max_age,)
+            return response
+        return wrapper
+    return decorator
+
+
+@app.route('/cache/stats/')
+def cache_stats():
+    return json_response({"cache": RESPONSE_CACHE.stats(), "bbox_cache": BBOX_CACHE.stats()})
+
+
+@app.route('/database/stats/')
+def database_stats():
+    return json_response({"pool": POOL.stats() if POOL is not None else None})
+
+
 @app.route('/')
 def index():
     return json_response({})
@@ -57,17 +163,16 @@ def index():
 def postcode_location(code):
     code = code.upper().replace(" ", "")
     with database() as conn:
-        statement_timeout(conn, 10)
         with conn.cursor() as cur:
-            cur.execute("""
+            execute_prepared(cur, "postcode_location", "text", """
                 SELECT lat, lng
                     FROM postcodes_short
-                    WHERE postcode = %(postcode)s
+                    WHERE postcode = $1
                 UNION ALL
                 SELECT lat, lng
                     FROM postcodes
-                    WHERE postcode = %(postcode)s
-                """, {"postcode": code})
+                    WHERE postcode = $1
+                """, (code,))
             [[lat, lng]] = cur.fetchall()
             return json_response({"lat": lat, "lng": lng})
 
@@ -88,13 +193,12 @@ def postcode_complete():
         ]})
 
     with database() as conn:
-        statement_timeout(conn, 10)
         with conn.cursor() as cur:
-            cur.execute("""
+            execute_prepared(cur, "postcode_complete", "text", """
                 select unnest(suggestions)
                 from postcode_prefix_lookup
-                where prefix = %(prefix)s
-                """, {'prefix': prefix})
+                where prefix = $1
+                """, (prefix,))
             data = [suggestion for [suggestion] in cur.fetchall()]
             return json_response({"results": data})
 
@@ -111,7 +215,8 @@ def _one_feature_v3(
      min_runtime,
      max_runtime,
      all_services_array,
-     one_service_array):
+     one_service_array,
+     headways):
     return {
         "type": "Feature",
         "geometry": {
@@ -175,6 +280,19 @@ def _runtime(runtime_sec):
     }
 
 
+def _headways(headways):
+    return {
+        band: {
+            "departures": headway["departures"],
+            "first": _runtime(headway["first_departure"]),
+            "last": _runtime(headway["last_departure"]),
+            "max_gap": _runtime(headway["max_gap"]),
+            "median_gap": _runtime(headway["median_gap"]),
+        }
+        for band, headway in headways.items()
+    }
+
+
 def _speed(distance_km, runtime_sec):
     if runtime_sec is None:
         return None
@@ -200,7 +318,8 @@ def _one_feature_v4(
         min_runtime_sec,
         max_runtime_sec,
         all_services_array,
-        one_service_array):
+        one_service_array,
+        headways):
 
     distance_km = _calc_distance_km(from_lng, from_lat, to_lng, to_lat)
     return {
@@ -225,6 +344,7 @@ def _one_feature_v4(
             },
             "distance": _distance(distance_km),
             "speed": _speed(distance_km, max_runtime_sec),
+            "headways": _headways(headways),
         },
         "id": 1
     }
@@ -235,11 +355,80 @@ def geojson_frequency_v4():
     return geojson_frequency_v34(_one_feature_v4)
 
 
-def geojson_frequency_v34(format_function):
-    with database() as conn:
-        statement_timeout(conn, 10)
-        with conn.cursor() as cur:
-            cur.execute("""
+def _valid_weekday(weekday):
+    # (not just `in WEEKDAYS`, which is true for "" and "MT")
+    return len(weekday) == 1 and weekday in WEEKDAYS
+
+
+def _bbox_params():
+    weekday = request.args.get('weekday', 'M')
+    if not _valid_weekday(weekday):
+        abort(400)
+    return dict(
+        limit=request.args.get('limit', 10000),
+        minlat=request.args.get('minlat'),
+        minlng=request.args.get('minlng'),
+        maxlat=request.args.get('maxlat'),
+        maxlng=request.args.get('maxlng'),
+        weekday=weekday)
+
+
+# minlat, minlng, maxlat, maxlng, weekday, limit
+BBOX_TYPES = "float8, float8, float8, float8, char, int"
+
+
+def _links_in_bbox(conn, params, level):
+    # The `limit` busiest links in the bbox, least busy first, as the
+    # arguments for _one_feature_v3/v4. params is like _bbox_params().
+    # level is from link_corridor.level_for_bbox(): when zoomed out,
+    # draw corridors between grid cells instead.
+    if is_sqlite(conn):
+        return sqlite_storage.link_frequency_in_bbox(conn, **params)
+
+    # $1 to $6 in the queries
+    args = (
+        params['minlat'],
+        params['minlng'],
+        params['maxlat'],
+        params['maxlng'],
+        params['weekday'],
+        params['limit'])
+
+    with conn.cursor() as cur:
+        if level is not None:
+            # like the link_frequency3 query, but between grid cells
+            # rather than stops (see tlparser/link_corridor.py)
+            execute_prepared(cur, "links_in_bbox_%d" % (level,), BBOX_TYPES, """
+                with final as (
+                    select
+                        (select sum(num) from unnest(hour_array_total) as per_hour(num)) as count_bus_per_week,
+                        *
+                    from %(tablename)s
+                    where lseg_bbox && box(point($1, $2), point($3, $4))
+                    and weekday = $5
+                    order by 1 desc
+                    limit $6
+                )
+                select
+                    null,
+                    null,
+                    (line_segment[0]::point)[0],
+                    (line_segment[0]::point)[1],
+                    (line_segment[1]::point)[0],
+                    (line_segment[1]::point)[1],
+                    $5 as weekday,
+                    length(line_segment),
+                    null,
+                    null,
+                    hour_array_total,
+                    hour_array_best_service,
+                    '{}'::json
+                from final
+                order by count_bus_per_week asc
+                """ % dict(tablename=link_corridor.tablename(level)), args)
+            return list(cur)
+
+        execute_prepared(cur, "links_in_bbox", BBOX_TYPES, """
                 with bus_per_hour_for_day as (
                     select
                         from_stoppoint,
@@ -249,16 +438,16 @@ def geojson_frequency_v34(format_function):
                         max(max_runtime) over (partition by from_stoppoint, to_stoppoint) as max_runtime,
                         hourarray_sum(hour_array_total::int[24]) over (partition by from_stoppoint, to_stoppoint) as hour_array_total,
                         hourarray_sum(hour_array_best_service::int[24]) over (partition by from_stoppoint, to_stoppoint) as hour_array_best_service
-                    from mv_link_frequency3
-                    where lseg_bbox && box(point(%(minlat)s, %(minlng)s), point(%(maxlat)s, %(maxlng)s))
-                    and weekday = %(weekday)s
+                    from link_frequency3
+                    where lseg_bbox && box(point($1, $2), point($3, $4))
+                    and weekday = $5
                 ), final as (
                     select
                         (select sum(num) from unnest(hour_array_total) as per_hour(num)) as count_bus_per_week,
                         *
                     from bus_per_hour_for_day
                     order by 1 desc
-                    limit %(limit)s
+                    limit $6
                 )
                 select
                     from_stoppoint,
@@ -267,32 +456,197 @@ def geojson_frequency_v34(format_function):
                     (line_segment[0]::point)[1],
                     (line_segment[1]::point)[0],
                     (line_segment[1]::point)[1],
-                    %(weekday)s as weekday,
+                    $5 as weekday,
                     length(line_segment),
                     min_runtime,
                     max_runtime,
                     hour_array_total,
-                    hour_array_best_service
+                    hour_array_best_service,
+                    coalesce((
+                        select json_object_agg(band, json_build_object(
+                            'departures', departures,
+                            'first_departure', first_departure,
+                            'last_departure', last_departure,
+                            'max_gap', max_gap,
+                            'median_gap', median_gap))
+                        from link_headway
+                        where link_headway.from_stoppoint = final.from_stoppoint
+                        and link_headway.to_stoppoint = final.to_stoppoint
+                        and link_headway.weekday = $5
+                    ), '{}'::json)
                 from final
                 -- draw most frequent routes last, which puts them on top
-                order by count_bus_per_week asc;
-                """, dict(
-		    limit=request.args.get('limit', 10000),
-		    minlat=request.args.get('minlat'),
-                    minlng=request.args.get('minlng'),
-                    maxlat=request.args.get('maxlat'),
-                    maxlng=request.args.get('maxlng'),
-                    weekday=request.args.get('weekday', 'M')))
-
-            return json_response({
-                "type": "FeatureCollection",
-                "features": [
-                    format_function(*row)
-                    for row in cur
-                ]
-            })
+                order by count_bus_per_week asc
+                """, args)
+        return list(cur)
+
+
+def _snap_bbox(minlat, minlng, maxlat, maxlng):
+    # Map clients send bboxes to 15 decimal places, so no two are the
+    # same. This is a bigger bbox with its edges on a grid (at least
+    # BBOX_CELLS across, so it's less than 1.5 times as wide), and the
+    # grid cells as a key for it.
+    span = max(maxlat - minlat, maxlng - minlng, 0)
+    exponent = BBOX_MIN_CELL_EXPONENT
+    if span > 0:
+        exponent = max(exponent, math.ceil(math.log2(span / BBOX_CELLS)))
+    cell = 2.0 ** exponent
+    cells = (
+        exponent,
+        math.floor(minlat / cell),
+        math.floor(minlng / cell),
+        math.ceil(maxlat / cell),
+        math.ceil(maxlng / cell))
+    return cells, [edge * cell for edge in cells[1:]]
+
+
+def _feature_bbox(from_lat, from_lng, to_lat, to_lng):
+    return min(from_lat, to_lat), min(from_lng, to_lng), max(from_lat, to_lat), max(from_lng, to_lng)
+
+
+def _feature_collection(features):
+    # features are already json, so this puts them in the
+    # FeatureCollection (with BASIC_INFO) without decoding them again
+    head = json.dumps(dict(BASIC_INFO, type="FeatureCollection"))
+    return "%s, \"features\": [%s]}" % (head[:-1], ", ".join(features))
+
+
+def geojson_frequency_v34(format_function):
+    params = _bbox_params()
+    try:
+        bbox = [float(params[name]) for name in ('minlat', 'minlng', 'maxlat', 'maxlng')]
+        params['limit'] = int(params['limit'])
+    except (TypeError, ValueError):
+        abort(400)
+    # (float() takes "nan" and "inf" too)
+    if not all(math.isfinite(edge) for edge in bbox) or params['limit'] <= 0:
+        abort(400)
+    params.update(zip(('minlat', 'minlng', 'maxlat', 'maxlng'), bbox))
+    minlat, minlng, maxlat, maxlng = bbox
+    level = link_corridor.level_for_bbox(*bbox)
+    cells, snapped = _snap_bbox(*bbox)
+    key = (current_dataset_version(), format_function.__name__, params['weekday'], params['limit'], level, cells)
+
+    # (truncated, [(bbox, json)] for every link in the snapped bbox)
+    entry = BBOX_CACHE.get(key)
+    if entry is None:
+        snapped_params = dict(params)
+        snapped_params.update(zip(('minlat', 'minlng', 'maxlat', 'maxlng'), snapped))
+        with database() as conn:
+            rows = _links_in_bbox(conn, snapped_params, level)
+        # The busiest `limit` links in the snapped bbox aren't always the
+        # busiest in the bbox asked for, so they're no use to us if
+        # there were more than that. Remember that, though.
+        truncated = len(rows) >= params['limit']
+        features = [] if truncated else [
+            (_feature_bbox(*row[2:6]), json.dumps(format_function(*row)))
+            for row in rows]
+        entry = (truncated, features)
+        BBOX_CACHE.put(key, entry, 1 + sum(len(feature) for _, feature in features))
+
+    truncated, features = entry
+    if truncated:
+        # (not worth keeping: nobody else asks for this exact bbox)
+        with database() as conn:
+            rows = _links_in_bbox(conn, params, level)
+        return Response(_feature_collection(
+            json.dumps(format_function(*row)) for row in rows
+        ), mimetype="application/json")
+
+    # The features are already json, so leaving out the ones outside
+    # the bbox asked for is cheap.
+    return Response(_feature_collection(
+        feature
+        for (link_minlat, link_minlng, link_maxlat, link_maxlng), feature in features
+        if link_maxlat >= minlat and link_minlat <= maxlat and link_maxlng >= minlng and link_minlng <= maxlng
+    ), mimetype="application/json")
+
+
+def _tile_properties(max_runtime_sec, all_services_array, one_service_array):
+    # The hour arrays are one property per hour ("all_8" is the buses
+    # between 8am and 9am), leaving out the hours with no buses. Small
+    # numbers like these are shared between all the features in a tile.
+    properties = {
+        "buses": sum(all_services_array),
+        "max_runtime": max_runtime_sec,
+    }
+    for hour, buses in enumerate(all_services_array):
+        if buses:
+            properties["all_%d" % (hour,)] = buses
+    for hour, buses in enumerate(one_service_array):
+        if buses:
+            properties["single_%d" % (hour,)] = buses
+    return properties
+
+
+@app.route('/tiles/links/<weekday>/<int:z>/<int:x>/<int:y>.mvt')
+@cached("application/vnd.mapbox-vector-tile", max_age=TILE_MAX_AGE)
+def tile_links(weekday, z, x, y):
+    if not _valid_weekday(weekday) or z > TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+    minlat, minlng, maxlat, maxlng = mvt.tile_bbox(z, x, y)
+    with database() as conn:
+        rows = _links_in_bbox(conn, dict(
+            limit=TILE_LIMIT,
+            minlat=minlat,
+            minlng=minlng,
+            maxlat=maxlat,
+            maxlng=maxlng,
+            weekday=weekday), link_corridor.level_for_bbox(minlat, minlng, maxlat, maxlng))
+
+    # Zoomed out, the corridors are already simpler than the links, and
+    # lines too short to see at this zoom are left out.
+    layer = mvt.Layer("links")
+    for from_id, to_id, from_lat, from_lng, to_lat, to_lng, _weekday, _length, _min_runtime, max_runtime_sec, all_services_array, one_service_array, _headways in rows:
+        layer.add_linestring(
+            [mvt.tile_point(from_lat, from_lng, z, x, y), mvt.tile_point(to_lat, to_lng, z, x, y)],
+            _tile_properties(max_runtime_sec, all_services_array, one_service_array))
+
+    return Response(mvt.tile([layer]), mimetype="application/vnd.mapbox-vector-tile")
+
+
+def _tiles_in_bbox(z, minlat, minlng, maxlat, maxlng):
+    left, top = mvt.tile_containing(maxlat, minlng, z)
+    right, bottom = mvt.tile_containing(minlat, maxlng, z)
+    for x in range(max(0, left), min(2 ** z, right + 1)):
+        for y in range(max(0, top), min(2 ** z, bottom + 1)):
+            yield x, y
+
+
+def warm_cache(bbox, zooms, weekdays):
+    """Asks for every tile in bbox, so they're in the cache for later
+
+    The zoomed out ones are the slow ones, and everybody looks at those.
+    """
+    client = app.test_client()
+    started = time.time()
+    for weekday in weekdays:
+        for z in zooms:
+            for x, y in _tiles_in_bbox(z, *bbox):
+                response = client.get('/tiles/links/%s/%d/%d/%d.mvt' % (weekday, z, x, y))
+                if response.status_code != 200:
+                    logging.warning("Tile %s/%d/%d/%d: %s", weekday, z, x, y, response.status)
+            logging.info("Warmed %s zoom %d after %.1fs: %r", weekday, z, time.time() - started, RESPONSE_CACHE.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--warm-cache', dest="warm_cache", help='fill the response cache with tiles, rather than running the server (set TRAVELINEDATA_CACHE_DIR to keep them)', action="store_true", default=False)
+    parser.add_argument('--bbox', help='with --warm-cache, minlat,minlng,maxlat,maxlng (default: Great Britain)', default="49.8,-8.2,60.9,1.8")
+    parser.add_argument('--zooms', help='with --warm-cache, the zoom levels (eg: 6-10)', default="6-10")
+    parser.add_argument('--weekdays', help='with --warm-cache', default=WEEKDAYS)
+    args = parser.parse_args()
+
+    if args.warm_cache:
+        first, _, last = args.zooms.partition("-")
+        warm_cache(
+            [float(value) for value in args.bbox.split(",")],
+            range(int(first), int(last or first) + 1),
+            args.weekdays)
+    else:
+        app.run()
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
-    app.run()
+    main()
@@ -403,15 +403,10 @@ window.addEventListener("load", function () {
 	};
 
 	var on_change = function() {
-		if (mymap.getZoom() <= 11) {
-			/* most web browsers will cry if you do this */
-			$("#zoom-in-hint").show();
-			$("#display").hide();
-			return;
-		} else {
-			$("#zoom-in-hint").hide();
-			$("#display").show();
-		}
+		/* zoomed out, the server joins up the links into corridors, so
+		there's no need to stop people doing this any more */
+		$("#zoom-in-hint").hide();
+		$("#display").show();
 
 		/* refetch and redraw */
 		var active_tab = controls_ui.accordion("option", "active");
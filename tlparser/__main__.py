@@ -1,12 +1,17 @@
 #!/usr/bin/python3
 import argparse
-import psycopg2
+import datetime
 import logging
+import os
 
-from .table_definitions import create_tables, drop_materialized_views, create_materialized_views, refresh_materialized_views
+from .table_definitions import create_tables, drop_materialized_views, create_materialized_views, refresh_materialized_views, set_target_week
 from . import naptan_file_parser
 from . import traveline_file_parser
 from . import codepoint_parser
+from . import bulk_load
+from .database import connect, SQLITE_PREFIX
+from .link_frequency import WEEKDAYS
+from .operating_days import monday_on_or_before, parse_date
 
 # Appears to be:
 # <StopPoints>
@@ -32,29 +37,45 @@ def main():
 	args = parse_args()
 
 	if args.destroy_create_tables:
-		with psycopg2.connect(args.database) as conn:
+		with connect(args.database) as conn:
 			drop_materialized_views(conn)
 			create_tables(conn)
 			create_materialized_views(conn)
 
 	if args.naptan:
-		with psycopg2.connect(args.database) as conn:
-			naptan_file_parser.process_all_files(conn)
+		with connect(args.database) as conn:
+			naptan_file_parser.process_all_files(conn, upsert=args.naptan_upsert)
 
 	if args.codepoint:
-		with psycopg2.connect(args.database) as conn:
+		with connect(args.database) as conn:
 			codepoint_parser.process_all(conn)
 
-	if args.process:
-		conn = psycopg2.connect(args.database)
-		traveline_file_parser.process_all_files(conn, args=args)
-	elif args.process_test_data:
-		conn = psycopg2.connect(args.database)
-		traveline_file_parser.process_all_files(conn, test_data_only=True, args=args)
+	if args.process or args.process_test_data:
+		test_data_only = not args.process
+		if args.profile:
+			os.makedirs(args.profile, exist_ok=True)
+			args.profile_run_started = datetime.datetime.now()
+		if args.bulk_load:
+			with connect(args.database) as conn:
+				bulk_load.begin(conn)
+		if args.jobs > 1:
+			traveline_file_parser.process_all_files_parallel(args.jobs, args=args, test_data_only=test_data_only)
+		else:
+			conn = connect(args.database)
+			traveline_file_parser.process_all_files(conn, args=args, test_data_only=test_data_only)
+		if args.bulk_load:
+			with connect(args.database) as conn:
+				bulk_load.finish(conn)
 
 	if args.matview:
-		with psycopg2.connect(args.database) as conn:
-			refresh_materialized_views(conn)
+		with connect(args.database) as conn:
+			# (after --naptan, refresh works out everything again itself)
+			full = args.full_refresh
+			if args.monday_of_desired_week:
+				full = set_target_week(conn, parse_date(args.monday_of_desired_week)) or full
+			refresh_materialized_views(
+				conn, full=full, engine=args.engine,
+				weekdays=[] if full else args.rebuild_weekday)
 
 
 
@@ -62,15 +83,36 @@ def parse_args():
 	parser = argparse.ArgumentParser(prog='Process traveline data')
 	parser.add_argument('--destroy_create_tables', help='Drop and re-create all the travelinedata tables', action="store_true", default=False)
 	parser.add_argument('--naptan', help='import the data from naptan', action="store_true", default=False)
+	parser.add_argument('--naptan-upsert', help='with --naptan, update the stops already imported', action="store_true", dest="naptan_upsert", default=False)
 	parser.add_argument('--codepoint', help='import codepoint (postcode) data', action="store_true", default=False)
 	parser.add_argument('--process', help='import the data from the given zip file', action="store_true", default=False)
 	parser.add_argument('--process-test-data', help='import a small subset of travelinedata', action="store_true", dest="process_test_data", default=False)
 	parser.add_argument('--generate', help='generate a table used as an index', action="store_true", default=False)
 	parser.add_argument('--matview', help='refresh materialized views', action="store_true", default=False)
-	parser.add_argument('--database', help='databse location', default="dbname=travelinedata")
+	parser.add_argument('--full-refresh', dest="full_refresh", help='with --matview, calculate everything again, rather than only what has been imported or deleted since last time', action="store_true", default=False)
+	parser.add_argument('--engine', help='with --matview, what adds up the buses per hour when calculating everything again (numpy needs python3-numpy)', choices=["sql", "numpy"], default="sql")
+	parser.add_argument('--rebuild-weekday', dest="rebuild_weekday", help='with --matview, also calculate everything again for this weekday (one of MTWHFSN, and can be given more than once)', choices=list(WEEKDAYS), action="append", default=[])
+	parser.add_argument('--database', help='databse location, or sqlite:FILENAME', default="dbname=travelinedata")
+	parser.add_argument('--bulk-load', dest="bulk_load", help='with --process, import into empty tables without foreign keys or indexes, and add them afterwards', action="store_true", default=False)
+	parser.add_argument('--jobs', help='number of processes to import xml files with', type=int, default=1)
+	parser.add_argument('--copy-batch-rows', dest="copy_batch_rows", help='rows to collect before writing them with COPY', type=int, default=10000)
+	parser.add_argument('--pipeline', help='write rows in a separate thread, with up to this many batches waiting', type=int, default=0)
+	parser.add_argument('--read-buffer-size', dest="read_buffer_size", help='bytes to read from each xml file at once', type=int, default=1024 * 1024)
 	parser.add_argument('--target-week', dest="monday_of_desired_week", help='the dataset includes data for many weeks, but you should pick one. This value should be a monday', required=False)
-
-	return parser.parse_args()
+	parser.add_argument('--profile', help='with --process, record how long each xml file took in the source_stats table, and write a summary to this directory', required=False)
+	parser.add_argument('--profile-dumps', dest="profile_dumps", help='with --profile, keep cProfile output for this many of the slowest files', type=int, default=0)
+	parser.add_argument('--row-cache', dest="row_cache", help='keep the rows from each xml file in this directory, and use them instead of parsing the file again', required=False)
+	parser.add_argument('--calendar-start', dest="calendar_start", help='first day to record which days each journey runs on, if its service starts before then (default: the --target-week, or this week)', required=False)
+	parser.add_argument('--calendar-days', dest="calendar_days", help='most days to record which days each journey runs on (fewer if its service ends sooner)', type=int, default=182)
+
+	args = parser.parse_args()
+	if args.database.startswith(SQLITE_PREFIX) and args.jobs > 1:
+		parser.error("--jobs can't be used with sqlite, which only has one writer at a time")
+	if args.database.startswith(SQLITE_PREFIX) and (args.bulk_load or args.profile or args.codepoint or args.rebuild_weekday):
+		parser.error("--bulk-load, --profile, --codepoint and --rebuild-weekday are for postgres")
+	if args.calendar_start is None:
+		args.calendar_start = args.monday_of_desired_week or monday_on_or_before(datetime.date.today()).isoformat()
+	return args
 
 
 
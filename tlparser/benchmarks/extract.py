@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+"""How long does it take to pull the fields out of a VehicleJourney?
+
+Copies the VehicleJourney in tests/single_vj.xml lots of times, then
+compares compiled xpath expressions with calling elem.xpath() each time.
+
+	python3 -m tlparser.benchmarks.extract --count 50000
+"""
+
+import argparse
+import copy
+import datetime
+import time
+from os.path import dirname
+
+from lxml import etree
+
+from ..traveline_xml_parser import NAMESPACES, VEHICLEJOURNEY_FIELDS, parse_single_vj_elem
+
+
+SINGLE_VJ = dirname(dirname(__file__)) + "/tests/single_vj.xml"
+
+
+def synthetic_document(count):
+	with open(SINGLE_VJ, mode='rb') as f:
+		root = etree.XML(f.read())
+	[vehiclejourneys] = root.xpath("//tx:VehicleJourneys", namespaces=NAMESPACES)
+	[vjelem] = vehiclejourneys
+	for _ in range(count - 1):
+		vehiclejourneys.append(copy.deepcopy(vjelem))
+	# round trip, so we're timing a tree as it comes from a file
+	return etree.XML(etree.tostring(root))
+
+
+def uncompiled(elem):
+	return tuple(
+		field.reduce(elem.xpath(field.path, namespaces=field.namespaces))
+		for field in VEHICLEJOURNEY_FIELDS.fields)
+
+
+def time_per_element(func, elems):
+	start = time.perf_counter()
+	for elem in elems:
+		func(elem)
+	return (time.perf_counter() - start) / len(elems)
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='Benchmark field extraction')
+	parser.add_argument('--count', help='number of VehicleJourney elements', type=int, default=50000)
+	args = parser.parse_args()
+
+	root = synthetic_document(args.count)
+	elems = root.xpath("//tx:VehicleJourney", namespaces=NAMESPACES)
+	monday = datetime.date(2018, 3, 12)
+
+	for name, func in [
+			("elem.xpath() per field", uncompiled),
+			("compiled fields", VEHICLEJOURNEY_FIELDS),
+			("parse_single_vj_elem", lambda elem: parse_single_vj_elem(elem, monday))]:
+		print("%-24s %8.2f us/element" % (name, 1e6 * time_per_element(func, elems)))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+"""How fast can we import a zip of TransXChange files?
+
+Makes up a zip with tlparser.synthetic (or uses --zip), then imports it
+with process_zipfile, timing each of the PARSERS. Prints elements/s,
+rows/s and MB/s (of xml) for each kind of element.
+
+By default this doesn't touch a database: the rows go to a
+RecordingConnection, so it only times the parsing and the preparing of
+rows. With --database, it imports into a real database instead, which
+has ALL ITS TABLES DROPPED AND RE-CREATED first, so use a throwaway one.
+
+	python3 -m tlparser.benchmarks.ingest --files 10 --journeys 200
+	python3 -m tlparser.benchmarks.ingest --database dbname=scratch --pipeline 4
+
+Time spent writing a batch of rows is counted against whichever element
+filled the batch, so rows/s is most useful for the total.
+"""
+
+import argparse
+import collections
+import os
+import tempfile
+import time
+import zipfile
+
+import psycopg2
+from lxml import etree
+
+from ..intern_cache import intern_cache
+from ..profiling import Profiler
+from ..recording_connection import RecordingConnection
+from ..synthetic import add_size_arguments, write_zip_from_args
+from ..table_definitions import create_tables, upgrade_tables
+from ..traveline_file_parser import PARSERS, configure_writer, process_zipfile
+from ..traveline_xml_parser import NAMESPACES
+from ..xmlparser import DEFAULT_BUFFER_SIZE, iter_namespaced_elements
+
+
+# Which tables each handler writes rows to
+HANDLER_TABLES = {
+	'Service': ("service", "line", "journeypattern_service", "journeypattern_service_section"),
+	'VehicleJourney': ("vehiclejourney",),
+	'JourneyPatternSection': ("jptiminglink",),
+	'Operator': ("operator",),
+	'AnnotatedStopPointRef': ("stoppoint",),
+	'RouteSection': ("routelink",),
+	'Route': ("route",),
+}
+
+
+class TotalProfiler(Profiler):
+	"""Adds up the stats for every file, instead of saving them"""
+
+	def __init__(self):
+		super().__init__(directory=None, run_started=None)
+		self.files = 0
+		self.wall_time = 0.0
+		self.handler_seconds = collections.Counter()
+		self.handler_elements = collections.Counter()
+		self.rows_written = collections.Counter()
+
+	def save(self, conn, source_id, error):
+		stats = self.current
+		self.current = None
+		if error is not None:
+			raise Exception("Importing %s failed:\n%s" % (stats.source, error))
+		self.files += 1
+		self.wall_time += stats.wall_time
+		self.handler_seconds.update(stats.handler_seconds)
+		self.handler_elements.update(stats.handler_elements)
+		self.rows_written.update(stats.rows_written)
+
+
+def xml_bytes(zip_filename, buffer_size):
+	"""Bytes of xml for each kind of element in the zip (not timed)"""
+	sizes = collections.Counter()
+	with zipfile.ZipFile(zip_filename) as container:
+		for contentname in container.namelist():
+			with container.open(contentname) as xmlfile:
+				for tagname, elem in iter_namespaced_elements(xmlfile, PARSERS.keys(), NAMESPACES["tx"], buffer_size):
+					sizes[tagname] += len(etree.tostring(elem))
+	return sizes
+
+
+def connect(args):
+	if args.database is None:
+		return RecordingConnection()
+	conn = psycopg2.connect(args.database)
+	with conn:
+		create_tables(conn)
+		upgrade_tables(conn)
+	intern_cache(conn).preload_atcocodes()
+	return conn
+
+
+def rate(amount, seconds):
+	return amount / seconds if seconds else float("nan")
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='Benchmark importing xml files')
+	add_size_arguments(parser)
+	parser.add_argument('--zip', help='import this zip, instead of making one up')
+	parser.add_argument('--database', help='a database you DO NOT CARE ABOUT (default: no database)')
+	parser.add_argument('--copy-batch-rows', dest="copy_batch_rows", type=int, default=10000)
+	parser.add_argument('--pipeline', type=int, default=0)
+	parser.add_argument('--read-buffer-size', dest="read_buffer_size", type=int, default=DEFAULT_BUFFER_SIZE)
+	args = parser.parse_args()
+
+	# the rest of what process_member wants from the command line
+	args.monday_of_desired_week = "2018-03-12"
+	args.calendar_start = "2018-03-05"
+	args.calendar_days = 182
+	args.profile = None
+	args.row_cache = None
+
+	with tempfile.TemporaryDirectory() as tmpdir:
+		zip_filename = args.zip
+		if zip_filename is None:
+			zip_filename = os.path.join(tmpdir, "SYN.zip")
+			write_zip_from_args(zip_filename, args)
+		sizes = xml_bytes(zip_filename, args.read_buffer_size)
+
+		conn = connect(args)
+		configure_writer(conn, args)
+		profiler = TotalProfiler()
+		start = time.perf_counter()
+		process_zipfile(conn, zip_filename, False, args, profiler)
+		elapsed = time.perf_counter() - start
+		conn.close()
+
+	megabytes = sum(sizes.values()) / (1024 * 1024)
+	print("%-24s %9s %12s %12s %8s" % ("", "elements", "elements/s", "rows/s", "MB/s"))
+	for tagname in sorted(PARSERS, key=lambda tagname: -profiler.handler_seconds[tagname]):
+		seconds = profiler.handler_seconds[tagname]
+		elements = profiler.handler_elements[tagname]
+		rows = sum(profiler.rows_written[tablename] for tablename in HANDLER_TABLES[tagname])
+		print("%-24s %9d %12.0f %12.0f %8.1f" % (
+			tagname, elements, rate(elements, seconds), rate(rows, seconds),
+			rate(sizes[tagname] / (1024 * 1024), seconds)))
+	print("%-24s %9d %12.0f %12.0f %8.1f" % (
+		"total", sum(profiler.handler_elements.values()),
+		rate(sum(profiler.handler_elements.values()), elapsed),
+		rate(sum(profiler.rows_written.values()), elapsed),
+		rate(megabytes, elapsed)))
+	print("%d files, %.1f MB of xml, %.2fs (%.2fs in handlers)" % (
+		profiler.files, megabytes, elapsed, sum(profiler.handler_seconds.values())))
+
+
+if __name__ == '__main__':
+	main()
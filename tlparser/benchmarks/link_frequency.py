@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+"""How long does working out link_frequency3 from scratch take?
+
+Runs the full refresh with each --engine on a database which already
+has some timetables in it (eg: one region, like SW.zip), and checks
+they come up with the same rows. Everything is rolled back at the end,
+so the database is left as it was.
+
+	python3 -m tlparser.benchmarks.link_frequency --database dbname=travelinedata
+	python3 -m tlparser.benchmarks.link_frequency --database dbname=travelinedata --repeat 3
+"""
+
+import argparse
+import logging
+import time
+
+import psycopg2
+
+from .. import link_frequency
+
+
+COMPARED_COLUMNS = """
+	from_stoppoint, to_stoppoint, weekday,
+	hour_array_total, hour_array_best_service, service_ids,
+	min_runtime, max_runtime,
+	line_segment::text, lseg_bbox::text
+	"""
+
+
+def differences(cur, engine_a, engine_b):
+	cur.execute("""
+		SELECT count(1) FROM (
+			(SELECT * FROM result_%(a)s EXCEPT ALL SELECT * FROM result_%(b)s)
+			UNION ALL
+			(SELECT * FROM result_%(b)s EXCEPT ALL SELECT * FROM result_%(a)s)
+		) AS different
+	""" % dict(a=engine_a, b=engine_b))
+	[[count]] = list(cur)
+	return count
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='Benchmark calculating link_frequency3')
+	parser.add_argument('--database', help='a database with timetables in it', required=True)
+	parser.add_argument('--engines', help='comma separated', default="sql,numpy")
+	parser.add_argument('--repeat', help='times to run each engine (the best is reported)', type=int, default=1)
+	args = parser.parse_args()
+	engines = args.engines.split(",")
+
+	conn = psycopg2.connect(args.database)
+	timings = {}
+	try:
+		with conn.cursor() as cur:
+			for engine in engines:
+				for _ in range(args.repeat):
+					start = time.perf_counter()
+					link_frequency.refresh(conn, full=True, engine=engine)
+					elapsed = time.perf_counter() - start
+					timings[engine] = min(timings.get(engine, elapsed), elapsed)
+				cur.execute("""
+					CREATE TEMP TABLE result_%s AS
+					SELECT %s FROM link_frequency3
+				""" % (engine, COMPARED_COLUMNS))
+				print("%-8s %8.2fs %9d rows" % (engine, timings[engine], cur.rowcount))
+			for engine in engines[1:]:
+				print("%s and %s: %d rows differ" % (engines[0], engine, differences(cur, engines[0], engine)))
+	finally:
+		conn.rollback()
+		conn.close()
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+"""How fast can we find the interesting elements in a big xml file?
+
+Writes a zip containing one large TransXChange file (the VehicleJourney
+from tests/single_vj.xml, over and over), then reads it back with
+iter_elements and with iter_namespaced_elements.
+
+	python3 -m tlparser.benchmarks.xmlparser --size-mb 300
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import zipfile
+from os.path import dirname
+
+from lxml import etree
+
+from ..traveline_file_parser import PARSERS
+from ..traveline_xml_parser import NAMESPACES
+from ..xmlparser import DEFAULT_BUFFER_SIZE, iter_elements, iter_namespaced_elements
+
+
+SINGLE_VJ = dirname(dirname(__file__)) + "/tests/single_vj.xml"
+
+
+def write_zip(zip_filename, size_mb):
+	with open(SINGLE_VJ, mode='rb') as f:
+		root = etree.XML(f.read())
+	[vjelem] = root.xpath("//tx:VehicleJourney", namespaces=NAMESPACES)
+	vj = etree.tostring(vjelem)
+	vj = vj.replace(b' xmlns="http://www.transxchange.org.uk/"', b'')
+
+	size = 0
+	with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as container:
+		with container.open("synthetic.xml", "w", force_zip64=True) as xmlfile:
+			xmlfile.write(b'<?xml version="1.0" encoding="utf-8"?>\n<TransXChange xmlns="http://www.transxchange.org.uk/"><VehicleJourneys>')
+			while size < size_mb * 1024 * 1024:
+				xmlfile.write(vj)
+				size += len(vj)
+			xmlfile.write(b'</VehicleJourneys></TransXChange>')
+	return size
+
+
+def throughput(zip_filename, size, iterate):
+	with zipfile.ZipFile(zip_filename) as container:
+		with container.open("synthetic.xml") as xmlfile:
+			start = time.perf_counter()
+			count = sum(1 for _ in iterate(xmlfile))
+			elapsed = time.perf_counter() - start
+	return count, size / (1024 * 1024) / elapsed
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='Benchmark xml streaming')
+	parser.add_argument('--size-mb', dest="size_mb", help='size of the (uncompressed) xml file', type=int, default=300)
+	parser.add_argument('--buffer-size', dest="buffer_size", type=int, default=DEFAULT_BUFFER_SIZE)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmpdir:
+		zip_filename = os.path.join(tmpdir, "synthetic.zip")
+		size = write_zip(zip_filename, args.size_mb)
+
+		for name, iterate in [
+				("iter_elements", lambda xmlfile: iter_elements(xmlfile, PARSERS.keys())),
+				("iter_namespaced_elements", lambda xmlfile: iter_namespaced_elements(xmlfile, PARSERS.keys(), NAMESPACES["tx"], args.buffer_size))]:
+			count, mb_per_second = throughput(zip_filename, size, iterate)
+			print("%-26s %8d elements %8.1f MB/s" % (name, count, mb_per_second))
+
+
+if __name__ == '__main__':
+	main()
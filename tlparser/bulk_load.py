@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""--bulk-load: import into empty tables without foreign keys or indexes.
+
+Every row we write has to update the indexes and queue up checks for
+the (deferred) foreign keys. When the tables start off empty, it's
+quicker to do without them, and put them back afterwards:
+
+- begin() saves the definitions of the foreign keys and the indexes
+  (other than primary keys and unique constraints, which the import
+  relies on) in bulk_load_saved, drops them, and makes the tables
+  UNLOGGED
+
+- ... then the files are imported as usual ...
+
+- finish() looks for rows which would break a foreign key, with one
+  query per foreign key. Those rows are copied to bulk_load_rejects
+  and deleted (which can break other foreign keys, so this repeats
+  until nothing else is deleted). Then the tables are made LOGGED, and
+  the foreign keys and indexes are put back.
+
+If the import is interrupted, running it again with --bulk-load carries
+on from where it got to. But UNLOGGED tables are emptied if postgres
+crashes, so only use this for an import you could start again.
+"""
+
+import logging
+
+from .table_definitions import SOURCE_TABLES, upgrade_tables
+
+
+BULK_LOAD_TABLES = SOURCE_TABLES + ["stoppoint"]
+
+
+def _in_progress(cur):
+	cur.execute("""
+		SELECT count(1) FROM bulk_load_saved
+	""")
+	[[count]] = list(cur)
+	return count > 0
+
+
+def begin(conn):
+	upgrade_tables(conn)
+	with conn.cursor() as cur:
+		if _in_progress(cur):
+			logging.info("Carrying on with the bulk load which was already started")
+			return
+
+		for tablename in BULK_LOAD_TABLES:
+			cur.execute("""
+				SELECT EXISTS (SELECT 1 FROM %s)
+			""" % (tablename,))
+			[[has_rows]] = list(cur)
+			if has_rows:
+				raise ValueError("--bulk-load is for empty tables, but %s has rows in it" % (tablename,))
+
+		cur.execute("""
+			INSERT INTO bulk_load_saved(kind, name, tablename, definition, column_name, ref_tablename, ref_column_name)
+			SELECT
+				'foreign key',
+				con.conname,
+				con.conrelid::regclass::text,
+				pg_get_constraintdef(con.oid),
+				col.attname,
+				con.confrelid::regclass::text,
+				ref_col.attname
+			FROM pg_constraint con
+			JOIN pg_attribute col ON col.attrelid = con.conrelid AND col.attnum = con.conkey[1]
+			JOIN pg_attribute ref_col ON ref_col.attrelid = con.confrelid AND ref_col.attnum = con.confkey[1]
+			WHERE con.contype = 'f'
+			AND (con.conrelid = ANY(%(tables)s::regclass[]) OR con.confrelid = ANY(%(tables)s::regclass[]))
+		""", dict(tables=BULK_LOAD_TABLES))
+		cur.execute("""
+			INSERT INTO bulk_load_saved(kind, name, tablename, definition)
+			SELECT
+				'index',
+				idx.indexrelid::regclass::text,
+				idx.indrelid::regclass::text,
+				pg_get_indexdef(idx.indexrelid)
+			FROM pg_index idx
+			WHERE idx.indrelid = ANY(%(tables)s::regclass[])
+			AND NOT EXISTS (
+				SELECT 1 FROM pg_constraint con
+				WHERE con.conindid = idx.indexrelid)
+		""", dict(tables=BULK_LOAD_TABLES))
+
+		cur.execute("""
+			SELECT kind, name, tablename
+			FROM bulk_load_saved
+		""")
+		for kind, name, tablename in list(cur):
+			logging.info("Dropping %s %s", kind, name)
+			if kind == "foreign key":
+				cur.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (tablename, name))
+			else:
+				cur.execute("DROP INDEX %s" % (name,))
+
+		for tablename in BULK_LOAD_TABLES:
+			cur.execute("ALTER TABLE %s SET UNLOGGED" % (tablename,))
+
+
+def finish(conn):
+	with conn.cursor() as cur:
+		if not _in_progress(cur):
+			return
+
+		cur.execute("""
+			SELECT name, tablename, column_name, ref_tablename, ref_column_name
+			FROM bulk_load_saved
+			WHERE kind = 'foreign key'
+			ORDER BY name
+		""")
+		foreign_keys = list(cur)
+
+		while True:
+			rejected = 0
+			for name, tablename, column_name, ref_tablename, ref_column_name in foreign_keys:
+				cur.execute("""
+					WITH rejected AS (
+						DELETE FROM %(tablename)s t
+						WHERE t.%(column_name)s IS NOT NULL
+						AND NOT EXISTS (
+							SELECT 1 FROM %(ref_tablename)s r
+							WHERE r.%(ref_column_name)s = t.%(column_name)s)
+						RETURNING t.*
+					)
+					INSERT INTO bulk_load_rejects(constraint_name, tablename, row_data)
+					SELECT %%s, %%s, to_jsonb(rejected)
+					FROM rejected
+				""" % dict(tablename=tablename, column_name=column_name, ref_tablename=ref_tablename, ref_column_name=ref_column_name),
+					(name, tablename,))
+				if cur.rowcount:
+					logging.warning(
+						"Rejected %d rows from %s, which broke %s (see bulk_load_rejects)",
+						cur.rowcount, tablename, name)
+					rejected += cur.rowcount
+			if not rejected:
+				break
+
+		for tablename in BULK_LOAD_TABLES:
+			logging.info("Logging table %s", tablename)
+			cur.execute("ALTER TABLE %s SET LOGGED" % (tablename,))
+
+		cur.execute("""
+			SELECT kind, name, tablename, definition
+			FROM bulk_load_saved
+			ORDER BY kind DESC
+		""")
+		for kind, name, tablename, definition in list(cur):
+			logging.info("Creating %s %s", kind, name)
+			if kind == "foreign key":
+				cur.execute("ALTER TABLE %s ADD CONSTRAINT %s %s" % (tablename, name, definition))
+			else:
+				cur.execute(definition)
+
+		cur.execute("""
+			DELETE FROM bulk_load_saved
+		""")
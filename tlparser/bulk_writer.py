@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+import collections
+import io
+import logging
+import queue
+import threading
+import time
+import weakref
+
+from .database import is_sqlite
+from .intern_cache import intern_cache
+
+
+# Rows are written in this order, which matters for the foreign keys
+# which aren't DEFERRABLE (eg: jptiminglink -> stoppoint)
+TABLE_COLUMNS = collections.OrderedDict([
+	("operator", ("source_id", "operator_id", "shortname")),
+	("stoppoint", ("atcocode_id", "name", "indicator", "locality_name", "locality_qualifier")),
+	("routelink", ("source_id", "routelink_id", "routesection", "from_stoppoint", "to_stoppoint", "direction")),
+	("service", ("source_id", "service_id", "privatecode", "mode", "operator_id", "description")),
+	("route", ("source_id", "route_id", "privatecode", "routesection", "description")),
+	("journeypattern_service", ("source_id", "journeypattern_id", "service_id", "route_id", "direction")),
+	("journeypattern_service_section", ("source_id", "jpsection_id", "journeypattern_id", "section_sequence")),
+	("jptiminglink", ("source_id", "jptiminglink_id", "jpsection_id", "routelink_id", "runtime", "from_sequence", "from_stoppoint", "to_sequence", "to_stoppoint", "runtime_seconds")),
+	("line", ("source_id", "line_id", "servicecode", "line_name")),
+	("vehiclejourney", ("source_id", "vjcode_id", "other_vjcode_id", "journeypattern_id", "line_id", "privatecode", "days_mask", "deptime", "deptime_seconds", "operating_from", "operating_days")),
+	("naptan", ("atcocode_id", "code", "name", "latitude", "longitude")),
+])
+
+# The same row can turn up more than once in these tables (stoppoints
+# are shared between files, and a file might list an operator twice).
+# COPY can't do "ON CONFLICT", so these go via a temp table.
+# (Change BulkWriter.on_conflict to do this for other tables.)
+ON_CONFLICT = {
+	"operator": "ON CONFLICT DO NOTHING",
+	"stoppoint": "ON CONFLICT DO NOTHING",
+}
+
+# Shared between files, so these are written with
+# InternCache.shared_cursor() (see use_shared_connection)
+SHARED_TABLES = {"stoppoint"}
+
+
+_WRITERS = weakref.WeakKeyDictionary()
+
+
+def bulk_writer(conn):
+	"""The BulkWriter belonging to this connection"""
+	try:
+		return _WRITERS[conn]
+	except KeyError:
+		if is_sqlite(conn):
+			from .sqlite_storage import SqliteBulkWriter
+			writer = _WRITERS[conn] = SqliteBulkWriter(conn)
+		else:
+			writer = _WRITERS[conn] = BulkWriter(conn)
+		return writer
+
+
+def _copy_text(value):
+	if value is None:
+		return "\\N"
+	return (str(value)
+		.replace("\\", "\\\\")
+		.replace("\t", "\\t")
+		.replace("\n", "\\n")
+		.replace("\r", "\\r"))
+
+
+class BulkWriter(object):
+	"""Collects rows for each table, and writes them using COPY.
+
+	One INSERT per row means one round trip per row, and that's most
+	of the time taken by an import. Call flush() before the end of the
+	transaction: nothing is written until then, or until we've got
+	`threshold` rows waiting.
+
+	After pipeline(), batches of rows are written by a thread of their
+	own, so we can carry on parsing while the database is busy. At most
+	`depth` batches wait in the queue; after that, the parser waits.
+	flush() still waits until everything has been written.
+
+	If `recording` is a dict, every row added is also appended to
+	recording[tablename] (see row_cache.py).
+	"""
+
+	def __init__(self, conn, threshold=10000):
+		self.conn = conn
+		self.threshold = threshold
+		self.on_conflict = dict(ON_CONFLICT)
+		self.rows = collections.defaultdict(list)
+		self.row_count = 0
+		self.rows_written = collections.Counter()
+		self.queue = None
+		self.error = None
+		self.recording = None
+		self.reset_stats()
+
+	def pipeline(self, depth):
+		self.queue = queue.Queue(maxsize=depth)
+		thread = threading.Thread(target=self._writer_thread, name="BulkWriter", daemon=True)
+		thread.start()
+
+	def reset_stats(self):
+		self.stats_since = time.perf_counter()
+		self.parser_idle = 0.0
+		self.writer_busy = 0.0
+		self.writer_idle = 0.0
+
+	def pipeline_stats(self):
+		"""Seconds spent working and waiting by each side, since reset_stats()"""
+		elapsed = time.perf_counter() - self.stats_since
+		return dict(
+			parser_busy=elapsed - self.parser_idle,
+			parser_idle=self.parser_idle,
+			writer_busy=self.writer_busy,
+			writer_idle=self.writer_idle)
+
+	def add(self, tablename, row):
+		if self.recording is not None:
+			self.recording[tablename].append(row)
+		self.rows[tablename].append(row)
+		self.row_count += 1
+		if self.row_count >= self.threshold:
+			self._hand_off()
+
+	def flush(self):
+		self._hand_off()
+		if self.queue is not None:
+			self._parser_wait(self.queue.join)
+			self._raise_writer_error()
+
+	def discard(self):
+		if self.row_count:
+			logging.info("Discarding %d unwritten rows", self.row_count)
+		self.rows.clear()
+		self.row_count = 0
+		if self.queue is not None:
+			# don't let the writer carry on into the next transaction
+			self.queue.join()
+			self.error = None
+
+	def _hand_off(self):
+		intern_cache(self.conn).flush()
+		rows = self.rows
+		self.rows = collections.defaultdict(list)
+		self.row_count = 0
+		if self.queue is None:
+			self._write_batch(rows)
+		else:
+			self._raise_writer_error()
+			self._parser_wait(lambda: self.queue.put(rows))
+
+	def _parser_wait(self, func):
+		started = time.perf_counter()
+		func()
+		self.parser_idle += time.perf_counter() - started
+
+	def _raise_writer_error(self):
+		error, self.error = self.error, None
+		if error is not None:
+			raise error
+
+	def _writer_thread(self):
+		while True:
+			waiting_since = time.perf_counter()
+			rows = self.queue.get()
+			started = time.perf_counter()
+			self.writer_idle += started - max(waiting_since, self.stats_since)
+			try:
+				if self.error is None:
+					self._write_batch(rows)
+			except Exception as e:
+				# The parser will find out next time it hands us something.
+				# Until then, throw away anything else we're given.
+				self.error = e
+			finally:
+				self.writer_busy += time.perf_counter() - started
+				self.queue.task_done()
+
+	def _write_batch(self, rows):
+		with self.conn.cursor() as cur:
+			for tablename in TABLE_COLUMNS:
+				table_rows = rows.get(tablename)
+				if not table_rows:
+					continue
+				if tablename in SHARED_TABLES:
+					with intern_cache(self.conn).shared_cursor() as shared_cur:
+						self._write(shared_cur, tablename, table_rows)
+				else:
+					self._write(cur, tablename, table_rows)
+
+	def _write(self, cur, tablename, rows):
+		columns = ", ".join(TABLE_COLUMNS[tablename])
+		data = io.StringIO("".join(
+			"\t".join(_copy_text(value) for value in row) + "\n"
+			for row in rows))
+
+		on_conflict = self.on_conflict.get(tablename)
+		if on_conflict is None:
+			cur.copy_expert("COPY %s (%s) FROM STDIN" % (tablename, columns), data)
+		else:
+			cur.execute("""
+				CREATE TEMP TABLE IF NOT EXISTS bulk_%(tablename)s
+				(LIKE %(tablename)s INCLUDING DEFAULTS)
+				ON COMMIT DELETE ROWS;
+			""" % dict(tablename=tablename))
+			cur.copy_expert("COPY bulk_%s (%s) FROM STDIN" % (tablename, columns), data)
+			cur.execute("""
+				INSERT INTO %(tablename)s (%(columns)s)
+				SELECT %(columns)s FROM bulk_%(tablename)s
+				%(on_conflict)s;
+				TRUNCATE bulk_%(tablename)s;
+			""" % dict(tablename=tablename, columns=columns, on_conflict=on_conflict))
+		self.rows_written[tablename] += len(rows)
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""Postgres connections for the server, kept between requests.
+
+Connecting (and then setting statement_timeout) took longer than the
+postcode queries themselves. The pool keeps up to size connections
+open, and a thread which wants one when they're all in use waits for up
+to wait_seconds.
+
+The connections are in autocommit mode (the server only reads, so
+BEGIN and COMMIT would just be more round trips), and statement_timeout
+is set when connecting.
+
+A connection which has been idle for longer than check_after_seconds
+gets a "SELECT 1" before it's handed out, so one which died (say
+postgres was restarted) is replaced rather than failing a request. One
+which breaks while it's being used is thrown away when it comes back.
+
+	pool = ConnectionPool("dbname=travelinedata")
+	with pool.connection() as conn:
+		with conn.cursor() as cur:
+			execute_prepared(cur, "count_stops", "text", "SELECT count(*) FROM naptan WHERE code = $1", ("x",))
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+class PooledConnection(psycopg2.extensions.connection):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		# names of the statements PREPAREd on this connection
+		self.prepared = set()
+		self.last_used = time.time()
+
+
+def execute_prepared(cur, name, types, sql, params):
+	"""cur.execute(), but the query is only planned once per connection
+
+	sql uses $1, $2... for params, and types are their postgres types
+	(eg: "float8, text"). The PREPARE happens the first time each
+	connection sees name, so the tables only need to exist if the
+	query is used.
+	"""
+	conn = cur.connection
+	if name not in conn.prepared:
+		cur.execute("PREPARE %s (%s) AS %s" % (name, types, sql))
+		conn.prepared.add(name)
+	cur.execute("EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(params))), params)
+
+
+class ConnectionPool(object):
+	def __init__(self, dsn, size=10, statement_timeout=10, wait_seconds=30, check_after_seconds=30):
+		self.dsn = dsn
+		self.size = size
+		self.statement_timeout = statement_timeout
+		self.wait_seconds = wait_seconds
+		self.check_after_seconds = check_after_seconds
+		self.lock = threading.Lock()
+		self.available = threading.BoundedSemaphore(size)
+		# most recently used last
+		self.idle = []
+		self.in_use = 0
+		self.peak_in_use = 0
+		self.pid = os.getpid()
+		self.counts = collections.Counter()
+		self.wait_time = 0.0
+
+	def _new_connection(self):
+		# (tests/connection_pool.py replaces this)
+		conn = psycopg2.connect(
+			self.dsn,
+			connection_factory=PooledConnection,
+			options="-c statement_timeout=%d" % (self.statement_timeout * 1000,))
+		conn.autocommit = True
+		return conn
+
+	def _connect(self):
+		conn = self._new_connection()
+		with self.lock:
+			self.counts["connects"] += 1
+		return conn
+
+	def _alive(self, conn):
+		if conn.closed:
+			return False
+		if time.time() - conn.last_used < self.check_after_seconds:
+			return True
+		try:
+			with conn.cursor() as cur:
+				cur.execute("SELECT 1")
+			return True
+		except psycopg2.Error:
+			return False
+
+	def _discard(self, conn):
+		with self.lock:
+			self.counts["discarded"] += 1
+		try:
+			conn.close()
+		except psycopg2.Error:
+			pass
+
+	def _release(self):
+		with self.lock:
+			self.in_use -= 1
+		self.available.release()
+
+	def _checkout(self):
+		started = time.time()
+		if not self.available.acquire(blocking=False):
+			with self.lock:
+				self.counts["waits"] += 1
+			if not self.available.acquire(timeout=self.wait_seconds):
+				raise psycopg2.pool.PoolError("no database connection free after %ds" % (self.wait_seconds,))
+		with self.lock:
+			self.wait_time += time.time() - started
+			self.counts["checkouts"] += 1
+			self.in_use += 1
+			self.peak_in_use = max(self.peak_in_use, self.in_use)
+			if os.getpid() != self.pid:
+				# after a fork, the parent's connections are still the
+				# parent's (closing them would close them for it too)
+				self.pid = os.getpid()
+				self.idle = []
+		try:
+			while True:
+				with self.lock:
+					conn = self.idle.pop() if self.idle else None
+				if conn is None:
+					return self._connect()
+				if self._alive(conn):
+					return conn
+				logging.warning("Database connection died while idle: replacing it")
+				self._discard(conn)
+		except Exception:
+			self._release()
+			raise
+
+	def _checkin(self, conn):
+		conn.last_used = time.time()
+		if conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+			self._discard(conn)
+		else:
+			with self.lock:
+				self.idle.append(conn)
+		self._release()
+
+	@contextlib.contextmanager
+	def connection(self):
+		conn = self._checkout()
+		try:
+			yield conn
+		finally:
+			self._checkin(conn)
+
+	def stats(self):
+		with self.lock:
+			return {
+				"size": self.size,
+				"in_use": self.in_use,
+				"idle": len(self.idle),
+				"utilisation": self.in_use / self.size,
+				"peak_in_use": self.peak_in_use,
+				"checkouts": self.counts["checkouts"],
+				"waits": self.counts["waits"],
+				"wait_seconds": self.wait_time,
+				"connects": self.counts["connects"],
+				"discarded": self.counts["discarded"],
+			}
@@ -0,0 +1,19 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+import psycopg2
+
+
+SQLITE_PREFIX = "sqlite:"
+
+
+def connect(database):
+	"""A postgres connection, or a SqliteConnection for "sqlite:PATH" """
+	if database.startswith(SQLITE_PREFIX):
+		from .sqlite_storage import SqliteConnection
+		return SqliteConnection(database[len(SQLITE_PREFIX):])
+	return psycopg2.connect(database)
+
+
+def is_sqlite(conn):
+	return getattr(conn, "dialect", None) == "sqlite"
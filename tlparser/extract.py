@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+import re
+
+from lxml import etree
+
+
+CHILD_TEXT_PATH = re.compile(r"^\./(\w+):(\w+)/text\(\)$")
+
+
+def maybe_one(many):
+	if len(many) == 1:
+		return many[0]
+	if len(many) == 0:
+		return None
+	raise ValueError(many)
+
+def exactly_one(many):
+	[one] = many
+	return one
+
+
+class Field(object):
+	"""One value to pull out of an element, using an xpath expression.
+
+	elem.xpath(path) parses and compiles the expression every time it's
+	called, which adds up when it's called a dozen times for each of
+	millions of elements. This compiles it once.
+	"""
+
+	def __init__(self, path, namespaces, reduce):
+		self.path = path
+		self.namespaces = namespaces
+		self.reduce = reduce
+		self.xpath = etree.XPath(path, namespaces=namespaces, smart_strings=False)
+
+		# "./tx:Foo/text()" is just the text of a child element
+		match = CHILD_TEXT_PATH.match(path)
+		if match:
+			prefix, localname = match.groups()
+			self.child_tag = "{%s}%s" % (namespaces[prefix], localname)
+		else:
+			self.child_tag = None
+
+	def __call__(self, elem):
+		return self.reduce(self.xpath(elem))
+
+	def __repr__(self):
+		return "%s(%r)" % (self.reduce.__name__, self.path,)
+
+
+class Extractor(object):
+	"""Pulls a tuple of Fields out of an element.
+
+	If every field is the text of a child element, we look at each
+	child once instead of running an xpath expression per field.
+	(This only sees the text before any comment in the child, which is
+	fine for the data we're reading.)
+	"""
+
+	def __init__(self, namespaces):
+		self.namespaces = namespaces
+		self.fields = []
+		self.child_tags = None
+
+	def one(self, path):
+		return self._add(Field(path, self.namespaces, exactly_one))
+
+	def maybe_one(self, path):
+		return self._add(Field(path, self.namespaces, maybe_one))
+
+	def all(self, path):
+		return self._add(Field(path, self.namespaces, list))
+
+	def _add(self, field):
+		self.fields.append(field)
+		if all(f.child_tag is not None for f in self.fields):
+			self.child_tags = frozenset(f.child_tag for f in self.fields)
+		else:
+			self.child_tags = None
+		return self
+
+	def __call__(self, elem):
+		if self.child_tags is None:
+			return tuple(field(elem) for field in self.fields)
+
+		found = {}
+		for child in elem:
+			if child.tag in self.child_tags and child.text is not None:
+				found.setdefault(child.tag, []).append(child.text)
+		return tuple(field.reduce(found.get(field.child_tag, ())) for field in self.fields)
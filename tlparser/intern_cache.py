@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+import collections
+import contextlib
+import logging
+import threading
+import weakref
+
+from psycopg2.extras import execute_values
+
+from .database import is_sqlite
+
+
+_CACHES = weakref.WeakKeyDictionary()
+
+
+def intern_cache(conn):
+	"""The InternCache belonging to this connection"""
+	try:
+		return _CACHES[conn]
+	except KeyError:
+		if is_sqlite(conn):
+			from .sqlite_storage import SqliteInternCache
+			cache = _CACHES[conn] = SqliteInternCache(conn)
+		else:
+			cache = _CACHES[conn] = InternCache(conn)
+		return cache
+
+
+class _SourceInterns(object):
+	def __init__(self, fresh):
+		# fresh: we created this source_id, so the database has no
+		# intern rows for it that we don't know about
+		self.fresh = fresh
+		self.ids = collections.defaultdict(dict)
+
+
+class InternCache(object):
+	"""Remembers the ids handed out by the *_intern tables.
+
+	Looking up a code used to cost a SELECT, and maybe an INSERT, for
+	every single reference in the xml. Instead:
+
+	- atcocodes are global, so we load all of atcocode_intern once and
+	  only ask the database about atcocodes we've never seen before
+
+	- everything else is per source_id. If we've just created the
+	  source_id, the intern tables can't contain anything for it, so a
+	  miss is always a new code: we hand out an id from a block
+	  reserved from the sequence and write the intern rows in one go
+	  when flush() is called. The foreign keys onto the intern tables
+	  are DEFERRABLE, so this only needs to happen before the commit.
+
+	- each xml file gets its own source_id, so we only keep the last
+	  few source_ids around
+
+	- see use_shared_connection() for importing with --jobs
+	"""
+
+	def __init__(self, conn, max_sources=4, id_batch_size=500):
+		self.conn = conn
+		self.max_sources = max_sources
+		self.id_batch_size = id_batch_size
+		self.sources = collections.OrderedDict()
+		self.atcocodes = None
+		self.atcocode_names = {}
+		self.reserved_ids = collections.defaultdict(collections.deque)
+		self.pending = collections.defaultdict(list)
+		self.hits = collections.Counter()
+		self.misses = collections.Counter()
+		self.shared_conn = None
+		self.shared_lock = threading.Lock()
+
+	def use_shared_connection(self, shared_conn):
+		"""Write the rows which are shared between files with shared_conn
+
+		That's atcocode_intern here, and stoppoint in BulkWriter. If each
+		file's transaction inserted its own, processes importing files
+		with the same stops would wait for each other (or deadlock) until
+		one of them committed, minutes later. Instead they're committed
+		straight away, whether or not the file works out.
+		"""
+		self.shared_conn = shared_conn
+
+	@contextlib.contextmanager
+	def shared_cursor(self):
+		"""A cursor for the rows which are shared between files"""
+		if self.shared_conn is None:
+			with self.conn.cursor() as cur:
+				yield cur
+			return
+		# (the BulkWriter's thread uses it too)
+		with self.shared_lock:
+			with self.shared_conn:
+				with self.shared_conn.cursor() as cur:
+					yield cur
+
+	def new_source(self, source_id):
+		"""Call this for a source_id which has only just been inserted"""
+		self._remember_source(source_id, _SourceInterns(fresh=True))
+
+	def forget_source(self, source_id):
+		self.sources.pop(source_id, None)
+
+	def _remember_source(self, source_id, interns):
+		self.sources[source_id] = interns
+		while len(self.sources) > self.max_sources:
+			self.sources.popitem(last=False)
+
+	def _source(self, source_id):
+		try:
+			self.sources.move_to_end(source_id)
+			return self.sources[source_id]
+		except KeyError:
+			interns = _SourceInterns(fresh=False)
+			self._remember_source(source_id, interns)
+			return interns
+
+	def interned(self, tablename, source_id, longname):
+		interns = self._source(source_id)
+		ids = interns.ids[tablename]
+		try:
+			short_id = ids[longname]
+		except KeyError:
+			pass
+		else:
+			self.hits[tablename] += 1
+			return short_id
+
+		self.misses[tablename] += 1
+		if interns.fresh:
+			short_id = self._allocate_id(tablename)
+			self.pending[tablename].append((short_id, source_id, longname))
+		else:
+			short_id = self._select_or_insert(tablename, source_id, longname)
+		ids[longname] = short_id
+		return short_id
+
+	def longnames(self, tablename, source_id):
+		"""{id: longname} for everything we've interned for this source_id"""
+		return {
+			short_id: longname
+			for longname, short_id in self._source(source_id).ids[tablename].items()}
+
+	def _allocate_id(self, tablename):
+		reserved = self.reserved_ids[tablename]
+		if not reserved:
+			with self.conn.cursor() as cur:
+				cur.execute("""
+					SELECT nextval(pg_get_serial_sequence(%s, %s))
+					FROM generate_series(1, %s)
+				""", (tablename + "_intern", tablename + "_id", self.id_batch_size,))
+				reserved.extend(short_id for [short_id] in cur)
+		return reserved.popleft()
+
+	def _select_or_insert(self, tablename, source_id, longname):
+		# we might have a pending row for this already
+		self.flush()
+		with self.conn.cursor() as cur:
+			sql = """
+				SELECT %(tablename)s_id
+				FROM %(tablename)s_intern
+				WHERE source_id = %%s
+				AND %(tablename)s = %%s
+			""" % dict(tablename=tablename)
+			cur.execute(sql, (source_id, longname,))
+			rows = list(cur)
+			if len(rows) == 0:
+				sql = """
+					INSERT INTO %(tablename)s_intern(source_id, %(tablename)s)
+					VALUES (%%s, %%s)
+					RETURNING %(tablename)s_id
+				""" % dict(tablename=tablename)
+				cur.execute(sql, (source_id, longname,))
+				rows = list(cur)
+			[[short_id]] = rows
+			return short_id
+
+	def flush(self):
+		"""Write out the intern rows for any ids we've handed out"""
+		with self.conn.cursor() as cur:
+			for tablename, rows in self.pending.items():
+				if not rows:
+					continue
+				sql = """
+					INSERT INTO %(tablename)s_intern(%(tablename)s_id, source_id, %(tablename)s)
+					VALUES %%s
+				""" % dict(tablename=tablename)
+				execute_values(cur, sql, rows, page_size=1000)
+		self.pending.clear()
+
+	def finish_source(self, source_id, failed=False):
+		"""Done with this source_id: flush, unless it's about to be rolled back"""
+		if failed:
+			self.rolled_back()
+		else:
+			self.flush()
+		self.forget_source(source_id)
+
+	def rolled_back(self):
+		"""Forget anything written in a transaction which didn't commit
+
+		That's a file which failed, or one which got as far as COMMIT
+		and failed there (the foreign keys onto the intern tables are
+		only checked then).
+		"""
+		self.pending.clear()
+		self.sources.clear()
+		if self.shared_conn is None:
+			# we might have new atcocodes which aren't there any more,
+			# so load them again next time
+			self.atcocodes = None
+			self.atcocode_names = {}
+
+	def preload_atcocodes(self):
+		with self.conn.cursor() as cur:
+			cur.execute("""
+				SELECT atcocode, atcocode_id
+				FROM atcocode_intern
+			""")
+			self.atcocodes = dict(cur)
+		logging.info("Loaded %d atcocodes", len(self.atcocodes))
+
+	def atcocode(self, atcocode):
+		if self.atcocodes is None:
+			self.preload_atcocodes()
+		try:
+			short_id = self.atcocodes[atcocode]
+		except KeyError:
+			pass
+		else:
+			self.hits['atcocode'] += 1
+			return short_id
+
+		# Other connections may be adding the same atcocode, so don't
+		# try to be clever here. They're rarely missing anyway.
+		self.misses['atcocode'] += 1
+		with self.shared_cursor() as cur:
+			cur.execute("""
+				INSERT INTO atcocode_intern(atcocode)
+				VALUES (%s)
+				ON CONFLICT (atcocode) DO NOTHING
+				RETURNING atcocode_id
+			""", (atcocode,))
+			rows = list(cur)
+			if len(rows) == 0:
+				cur.execute("""
+					SELECT atcocode_id
+					FROM atcocode_intern
+					WHERE atcocode = %s
+				""", (atcocode,))
+				rows = list(cur)
+			[[short_id]] = rows
+		self.atcocodes[atcocode] = short_id
+		return short_id
+
+	def atcocode_ids(self, atcocodes):
+		"""Like atcocode(), but for lots of atcocodes at once"""
+		if self.atcocodes is None:
+			self.preload_atcocodes()
+		missing = sorted(set(atcocodes) - self.atcocodes.keys())
+		self.misses['atcocode'] += len(missing)
+		self.hits['atcocode'] += len(atcocodes) - len(missing)
+		if missing:
+			with self.shared_cursor() as cur:
+				cur.execute("""
+					INSERT INTO atcocode_intern(atcocode)
+					SELECT unnest(%s::text[])
+					ON CONFLICT (atcocode) DO NOTHING
+					RETURNING atcocode, atcocode_id
+				""", (missing,))
+				self.atcocodes.update(cur)
+				# ... and any which someone else inserted meanwhile
+				conflicted = [atcocode for atcocode in missing if atcocode not in self.atcocodes]
+				if conflicted:
+					cur.execute("""
+						SELECT atcocode, atcocode_id
+						FROM atcocode_intern
+						WHERE atcocode = ANY(%s)
+					""", (conflicted,))
+					self.atcocodes.update(cur)
+		return [self.atcocodes[atcocode] for atcocode in atcocodes]
+
+	def atcocode_name(self, atcocode_id):
+		if self.atcocodes is None:
+			self.preload_atcocodes()
+		if len(self.atcocode_names) != len(self.atcocodes):
+			# (atcocodes are only ever added)
+			self.atcocode_names = {
+				short_id: atcocode
+				for atcocode, short_id in self.atcocodes.items()}
+		return self.atcocode_names[atcocode_id]
+
+	def log_stats(self):
+		log_stats(self.hits, self.misses)
+
+
+def log_stats(hits, misses):
+	for tablename in sorted(set(hits) | set(misses)):
+		logging.info(
+			"intern %s: %d hits, %d misses",
+			tablename, hits[tablename], misses[tablename])
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""Bus routes for looking at a whole county (or country) at once.
+
+link_frequency3 has a row for every pair of stops, which is far too
+many lines to draw when the map is zoomed out. Each level here puts the
+stops on a grid instead: both ends of every link are snapped to the
+middle of their grid cell, and the links between the same two cells are
+added up. So the links along a road become a few long lines from cell
+to cell, and the links inside a cell go away.
+
+Each level is a table of its own (link_corridor_1, ...) with a gist
+index, and the server picks one with level_for_bbox(), so a bbox the
+size of the country has about as many rows as one the size of a town.
+
+They're worked out again from link_frequency3 (into link_corridor_N_new,
+which is swapped in at the end) when link_frequency3 is rebuilt. When
+only some of link_frequency3 was updated, just the corridors which the
+updated links go along are worked out again.
+"""
+
+import logging
+import time
+
+from .link_frequency import _hours, _step
+
+
+# (level, size of a grid cell in degrees, the biggest bbox it's used for)
+LEVELS = [
+	(1, 0.01, 3),
+	(2, 0.04, 12),
+	(3, 0.16, None),
+]
+
+# bboxes up to this many degrees across get link_frequency3 itself
+STOP_LEVEL_SPAN = 0.75
+
+
+def tablename(level):
+	return "link_corridor_%d" % (level,)
+
+
+def level_for_bbox(minlat, minlng, maxlat, maxlng):
+	"""The level to draw this bbox from, or None for link_frequency3"""
+	span = max(float(maxlat) - float(minlat), float(maxlng) - float(minlng))
+	if span <= STOP_LEVEL_SPAN:
+		return None
+	for level, _, max_span in LEVELS:
+		if max_span is None or span <= max_span:
+			return level
+
+
+def exists(conn):
+	with conn.cursor() as cur:
+		cur.execute("""
+			SELECT %s
+		""" % (" AND ".join(
+			"to_regclass('%s') IS NOT NULL" % (tablename(level),)
+			for level, _, _ in LEVELS),))
+		[[found]] = list(cur)
+		return found
+
+
+def drop(conn):
+	with conn.cursor() as cur:
+		for level, _, _ in LEVELS:
+			cur.execute("""
+				DROP TABLE IF EXISTS %(tablename)s;
+				DROP TABLE IF EXISTS %(tablename)s_new;
+			""" % dict(tablename=tablename(level)))
+
+
+def _create(cur, tablename):
+	cur.execute("""
+		CREATE TABLE %s(
+			-- between the middles of the two cells
+			line_segment LSEG,
+			lseg_bbox BOX,
+			weekday CHAR NOT NULL,
+			-- floor(latitude / cell size), and the same for longitude
+			from_lat_cell INT NOT NULL,
+			from_lng_cell INT NOT NULL,
+			to_lat_cell INT NOT NULL,
+			to_lng_cell INT NOT NULL,
+			-- how many link_frequency3 rows were added up
+			links INT NOT NULL,
+			hour_array_total INT[],
+			hour_array_best_service INT[]);
+	""" % (tablename,))
+
+
+def _insert(cur, tablename, cell_size, corridors=None):
+	"""Adds up the links between cells, or only the ones in the corridors table"""
+	cur.execute("""
+		INSERT INTO %(tablename)s
+		WITH link_cell AS (
+			SELECT
+				weekday,
+				floor((line_segment[0]::point)[0] / %(cell_size)r)::int AS from_lat_cell,
+				floor((line_segment[0]::point)[1] / %(cell_size)r)::int AS from_lng_cell,
+				floor((line_segment[1]::point)[0] / %(cell_size)r)::int AS to_lat_cell,
+				floor((line_segment[1]::point)[1] / %(cell_size)r)::int AS to_lng_cell,
+				hour_array_total,
+				hour_array_best_service
+			FROM %(links)s
+			WHERE line_segment IS NOT NULL
+		),
+		corridor AS (
+			SELECT
+				weekday,
+				from_lat_cell,
+				from_lng_cell,
+				to_lat_cell,
+				to_lng_cell,
+				count(1) AS links,
+				hourarray_sum(hour_array_total::int[24]) AS hour_array_total,
+				ARRAY [
+					%(hour_bests)s
+				] AS hour_array_best_service
+			FROM link_cell
+			-- (links inside a cell aren't drawn)
+			WHERE (from_lat_cell, from_lng_cell) <> (to_lat_cell, to_lng_cell)
+			%(only_corridors)s
+			GROUP BY 1, 2, 3, 4, 5
+		)
+		SELECT
+			lseg(%(from_point)s, %(to_point)s),
+			box(%(from_point)s, %(to_point)s),
+			weekday,
+			from_lat_cell,
+			from_lng_cell,
+			to_lat_cell,
+			to_lng_cell,
+			links,
+			hour_array_total,
+			hour_array_best_service
+		FROM corridor
+	""" % dict(
+		tablename=tablename,
+		cell_size=cell_size,
+		# the links near the corridors (using the gist index), and then
+		# only the ones between the right cells
+		links="""(
+			SELECT DISTINCT ON (link.from_stoppoint, link.to_stoppoint, link.weekday) link.*
+			FROM %(corridors)s corridor
+			JOIN link_frequency3 link
+			ON link.lseg_bbox && corridor.cells_bbox
+			AND link.weekday = corridor.weekday
+			) link_frequency3""" % dict(corridors=corridors) if corridors else "link_frequency3",
+		only_corridors="""
+			AND (weekday, from_lat_cell, from_lng_cell, to_lat_cell, to_lng_cell) IN (
+				SELECT weekday, from_lat_cell, from_lng_cell, to_lat_cell, to_lng_cell
+				FROM %(corridors)s)
+			""" % dict(corridors=corridors) if corridors else "",
+		hour_bests=_hours("coalesce(max(hour_array_best_service[%(index)d]), 0)"),
+		from_point="point((from_lat_cell + 0.5) * %(cell_size)r, (from_lng_cell + 0.5) * %(cell_size)r)" % dict(cell_size=cell_size),
+		to_point="point((to_lat_cell + 0.5) * %(cell_size)r, (to_lng_cell + 0.5) * %(cell_size)r)" % dict(cell_size=cell_size)))
+	return cur.rowcount
+
+
+def refresh(conn, only_keys=False):
+	"""Works out every level again from link_frequency3
+
+	Every level is calculated before any of them are swapped in, and
+	the swap locks them all, so commit straight afterwards.
+
+	With only_keys, only the corridors for the keys in refresh_key (see
+	link_frequency.refresh) are worked out again.
+	"""
+	if only_keys:
+		_refresh_keys(conn)
+		return
+	started = time.time()
+	with conn.cursor() as cur:
+		for level, cell_size, _ in LEVELS:
+			new = tablename(level) + "_new"
+			with _step("Calculating %s" % (new,)):
+				cur.execute("""
+					DROP TABLE IF EXISTS %s;
+				""" % (new,))
+				_create(cur, new)
+				rows = _insert(cur, new, cell_size)
+				logging.info("%s has %d rows", new, rows)
+				cur.execute("""
+					CREATE INDEX idx_%(tablename)s
+					ON %(tablename)s
+					USING gist(lseg_bbox);
+
+					ANALYZE %(tablename)s;
+				""" % dict(tablename=new))
+		with _step("Swapping in the new link_corridor levels"):
+			for level, _, _ in LEVELS:
+				cur.execute("""
+					DROP TABLE IF EXISTS %(old)s;
+					ALTER TABLE %(old)s_new RENAME TO %(old)s;
+					ALTER INDEX idx_%(old)s_new RENAME TO idx_%(old)s;
+				""" % dict(old=tablename(level)))
+	logging.info("Calculated link_corridor levels in %.1fs", time.time() - started)
+
+
+def _refresh_keys(conn):
+	started = time.time()
+	with conn.cursor() as cur:
+		for level, cell_size, _ in LEVELS:
+			corridors = "refresh_corridor_%d" % (level,)
+			# Where the keys were, and where they are now, are the same:
+			# link_frequency3 gets its line_segments from naptan, and a
+			# new naptan means a full refresh.
+			cur.execute("""
+				CREATE TEMP TABLE %(corridors)s ON COMMIT DROP AS
+				SELECT DISTINCT
+					key.weekday,
+					floor(from_point.latitude::double precision / %(cell_size)r)::int AS from_lat_cell,
+					floor(from_point.longitude::double precision / %(cell_size)r)::int AS from_lng_cell,
+					floor(to_point.latitude::double precision / %(cell_size)r)::int AS to_lat_cell,
+					floor(to_point.longitude::double precision / %(cell_size)r)::int AS to_lng_cell
+				FROM refresh_key key
+				JOIN naptan from_point ON key.from_stoppoint = from_point.atcocode_id
+				JOIN naptan to_point ON key.to_stoppoint = to_point.atcocode_id;
+
+				ALTER TABLE %(corridors)s ADD COLUMN cells_bbox BOX;
+				UPDATE %(corridors)s SET cells_bbox = box(
+					point(least(from_lat_cell, to_lat_cell) * %(cell_size)r, least(from_lng_cell, to_lng_cell) * %(cell_size)r),
+					point((greatest(from_lat_cell, to_lat_cell) + 1) * %(cell_size)r, (greatest(from_lng_cell, to_lng_cell) + 1) * %(cell_size)r));
+				ANALYZE %(corridors)s;
+
+				DELETE FROM %(tablename)s old
+				USING %(corridors)s corridor
+				WHERE old.weekday = corridor.weekday
+				AND old.from_lat_cell = corridor.from_lat_cell
+				AND old.from_lng_cell = corridor.from_lng_cell
+				AND old.to_lat_cell = corridor.to_lat_cell
+				AND old.to_lng_cell = corridor.to_lng_cell;
+			""" % dict(tablename=tablename(level), corridors=corridors, cell_size=cell_size))
+			deleted = cur.rowcount
+			rows = _insert(cur, tablename(level), cell_size, corridors)
+			logging.info("%s: replaced %d rows with %d", tablename(level), deleted, rows)
+	logging.info("Updated link_corridor levels in %.1fs", time.time() - started)
@@ -0,0 +1,779 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""How many buses an hour go between each pair of stops, on each day.
+
+These used to be materialized views, which meant working out the whole
+country again after importing a single xml file. Now they're ordinary
+tables:
+
+- vehiclejourney_per_hour: how many journeys leave in each hour, for
+  each journeypattern, line and days_mask
+
+- link_frequency3: for each (from_stoppoint, to_stoppoint, weekday),
+  the buses per hour (in total, and for the best single service) and
+  the runtimes, from every source
+
+- link_headway: for the same keys, how long you'd wait for a bus in
+  each part of the day (see BANDS and _insert_link_headway)
+
+- link_frequency_source_key: which link_frequency3 rows each source
+  contributed to, last time we looked
+
+Importing or deleting a source adds it to link_frequency_dirty_source
+(see mark_source_dirty). refresh() then only has to work out
+vehiclejourney_per_hour for those sources, and link_frequency3 for the
+keys those sources used to touch or touch now.
+
+Anything which changes every row (a different target week, or stops
+which have moved, see mark_all_dirty) needs a full refresh, which
+builds a new copy of link_frequency3 and swaps it in at the end, so the
+server can carry on reading the old one meanwhile. Updating a few keys
+only locks those rows, so that doesn't get in the server's way either.
+
+link_frequency3 is partitioned by weekday, and each partition has its
+own gist index, so a query for one day only looks at that day's index.
+rebuild_weekdays() works out some of the partitions again.
+"""
+
+import contextlib
+import logging
+import time
+
+
+HOURS = range(24)
+
+# link_frequency3 has a partition for each of these
+WEEKDAYS = "MTWHFSN"
+
+# (band, from hour, to hour) for link_headway. Journeys which run past
+# midnight stay in the evening.
+BANDS = [
+	("early", 0, 7),
+	("am_peak", 7, 10),
+	("interpeak", 10, 16),
+	("pm_peak", 16, 19),
+	("evening", 19, 48),
+]
+
+
+def _hours(template, separator=",\n"):
+	return separator.join(template % dict(hour=hour, index=hour + 1) for hour in HOURS)
+
+
+DIRTY_SOURCE_TABLE = """
+	-- sources imported or deleted since link_frequency3 was last updated
+	CREATE TABLE IF NOT EXISTS link_frequency_dirty_source(
+		source_id INT PRIMARY KEY);
+	"""
+
+
+# In link_frequency_dirty_source, for "everything needs working out
+# again" (see mark_all_dirty). Real source_ids start at 1.
+ALL_SOURCES = 0
+
+
+def mark_source_dirty(conn, source_id):
+	with conn.cursor() as cur:
+		cur.execute("""
+			INSERT INTO link_frequency_dirty_source(source_id)
+			VALUES (%s)
+			ON CONFLICT DO NOTHING
+		""", (source_id,))
+
+
+def mark_all_dirty(conn):
+	"""The next refresh() will be a full one (eg: after a NaPTAN import)"""
+	with conn.cursor() as cur:
+		cur.execute(DIRTY_SOURCE_TABLE)
+	mark_source_dirty(conn, ALL_SOURCES)
+
+
+def create(conn):
+	with conn.cursor() as cur:
+		# The days_mask for the week starting on $3, from operating_from
+		# and the operating_days bitmap. NULL if the bitmap doesn't cover
+		# the whole week.
+		cur.execute("""
+			CREATE FUNCTION days_mask_for_week(DATE, BIT VARYING, DATE) RETURNS INT
+			AS $$
+				SELECT CASE
+					WHEN $3 < $1 OR $3 - $1 + 7 > length($2) THEN NULL
+					ELSE coalesce((
+						SELECT sum(1 << day)::int
+						FROM generate_series(0, 6) AS day
+						WHERE substring($2 FROM $3 - $1 + day + 1 FOR 1) = B'1'), 0)
+				END;
+			$$ LANGUAGE SQL
+			IMMUTABLE
+			RETURNS NULL ON NULL INPUT;
+		""")
+
+		cur.execute("""
+		CREATE TABLE mask_to_weekday (mask INT UNIQUE, weekday CHAR UNIQUE);
+		""")
+		cur.execute("""
+		INSERT INTO mask_to_weekday (mask, weekday)
+		VALUES (1, 'M'), (2, 'T'), (4, 'W'), (8, 'H'), (16, 'F'), (32, 'S'), (64, 'N');
+		""")
+
+		cur.execute("""
+		CREATE FUNCTION hourarray_add(INT[24], INT[24]) RETURNS INT[24]
+			AS $$
+				SELECT ARRAY[
+					%s
+				];
+			$$ LANGUAGE SQL
+			IMMUTABLE
+			RETURNS NULL ON NULL INPUT;
+		""" % (_hours("$1[%(index)d] + $2[%(index)d]"),))
+		cur.execute("""
+		CREATE AGGREGATE hourarray_sum (int[24])
+		(
+		    sfunc = hourarray_add,
+		    stype = int[24],
+		    initcond = '{0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0}'
+		);
+		""")
+
+		cur.execute(DIRTY_SOURCE_TABLE)
+		cur.execute("""
+			CREATE TABLE vehiclejourney_per_hour(
+				source_id INT NOT NULL,
+				journeypattern_id INT,
+				line_id INT,
+				days_mask INT,
+				%s);
+		""" % (_hours("hour_%(hour)d INT"),))
+		cur.execute("""
+			CREATE INDEX idx_vehiclejourney_per_hour_id
+			ON vehiclejourney_per_hour
+			USING btree (journeypattern_id);
+		""")
+		cur.execute("""
+			CREATE INDEX idx_vehiclejourney_per_hour_source
+			ON vehiclejourney_per_hour
+			USING btree (source_id);
+		""")
+
+		cur.execute("""
+			CREATE TABLE link_frequency_source_key(
+				source_id INT NOT NULL,
+				from_stoppoint INT NOT NULL,
+				to_stoppoint INT NOT NULL,
+				weekday CHAR NOT NULL,
+				PRIMARY KEY (source_id, from_stoppoint, to_stoppoint, weekday));
+		""")
+
+		_create_link_frequency3(cur, "link_frequency3")
+		_index_link_frequency3(cur, "link_frequency3")
+		_create_link_headway(cur, "link_headway")
+
+		# for finding the timing links for a few keys
+		cur.execute("""
+			CREATE INDEX IF NOT EXISTS idx_timing_link
+			ON jptiminglink(from_stoppoint, to_stoppoint);
+		""")
+
+
+def _partition(tablename, weekday):
+	return "%s_%s" % (tablename, weekday.lower())
+
+
+def _create_link_frequency3(cur, tablename, weekday=None):
+	"""Partitioned by weekday, or (with weekday) a table for one of the partitions"""
+	if weekday is not None and weekday not in WEEKDAYS:
+		raise ValueError("weekday should be one of %s" % (WEEKDAYS,))
+	cur.execute("""
+		CREATE TABLE %(tablename)s(
+			-- a line segment allows you to draw directly from a
+			-- query on this table, which is a massive speed improvement
+			line_segment LSEG,
+			-- ... but you can only (easily) have a gist index on a box!
+			lseg_bbox BOX,
+			from_stoppoint INT NOT NULL,
+			to_stoppoint INT NOT NULL,
+			weekday CHAR NOT NULL,
+			hour_array_total INT[],
+			hour_array_best_service INT[],
+			service_ids INT[],
+			min_runtime INT,
+			max_runtime INT
+			%(check)s)
+		%(partition_by)s;
+	""" % dict(
+		tablename=tablename,
+		# saves ATTACH PARTITION from checking every row
+		check=", CONSTRAINT %s_weekday CHECK (weekday = '%s')" % (tablename, weekday) if weekday else "",
+		partition_by="" if weekday else "PARTITION BY LIST (weekday)"))
+	if weekday is None:
+		for weekday in WEEKDAYS:
+			cur.execute("""
+				CREATE TABLE %(partition)s
+				PARTITION OF %(tablename)s
+				FOR VALUES IN ('%(weekday)s');
+			""" % dict(partition=_partition(tablename, weekday), tablename=tablename, weekday=weekday))
+
+
+def _index_link_frequency3(cur, tablename, weekday=None):
+	"""Each partition gets its own indexes, idx_<partition> and idx_<partition>_key
+
+	The ones on the partitioned table are made last, so they pick up
+	those rather than making their own.
+	"""
+	if weekday is None:
+		tablenames = [_partition(tablename, weekday) for weekday in WEEKDAYS] + [tablename]
+	else:
+		tablenames = [tablename]
+	for name in tablenames:
+		cur.execute("""
+			CREATE INDEX idx_%(name)s
+			ON %(name)s
+			USING gist(lseg_bbox);
+		""" % dict(name=name))
+		cur.execute("""
+			CREATE UNIQUE INDEX idx_%(name)s_key
+			ON %(name)s
+			USING btree (from_stoppoint, to_stoppoint, weekday);
+		""" % dict(name=name))
+
+
+def _rename_link_frequency3(cur, old, new):
+	cur.execute("""
+		ALTER TABLE %(old)s RENAME TO %(new)s;
+		ALTER INDEX idx_%(old)s RENAME TO idx_%(new)s;
+		ALTER INDEX idx_%(old)s_key RENAME TO idx_%(new)s_key;
+	""" % dict(old=old, new=new))
+
+
+def _create_link_headway(cur, tablename):
+	cur.execute("""
+		CREATE TABLE %(tablename)s(
+			from_stoppoint INT NOT NULL,
+			to_stoppoint INT NOT NULL,
+			weekday CHAR NOT NULL,
+			band TEXT NOT NULL,
+			departures INT NOT NULL,
+			-- seconds since midnight, leaving from_stoppoint
+			first_departure INT NOT NULL,
+			last_departure INT NOT NULL,
+			-- seconds between buses (NULL if there's only one)
+			max_gap INT,
+			median_gap INT,
+			CONSTRAINT %(tablename)s_pkey PRIMARY KEY (from_stoppoint, to_stoppoint, weekday, band));
+	""" % dict(tablename=tablename))
+
+
+def drop(conn):
+	with conn.cursor() as cur:
+		# (materialized views from older versions)
+		cur.execute("""
+			DROP MATERIALIZED VIEW IF EXISTS mv_link_frequency3;
+			DROP MATERIALIZED VIEW IF EXISTS mv_vehiclejourney_per_hour;
+		""")
+		cur.execute("""
+			DROP TABLE IF EXISTS link_frequency3;
+			DROP TABLE IF EXISTS link_frequency3_new;
+			DROP TABLE IF EXISTS link_frequency_source_key;
+			DROP TABLE IF EXISTS link_headway;
+			DROP TABLE IF EXISTS link_headway_new;
+			DROP TABLE IF EXISTS vehiclejourney_per_hour;
+			DROP TABLE IF EXISTS link_frequency_dirty_source;
+			DROP TABLE IF EXISTS mask_to_weekday;
+			DROP AGGREGATE IF EXISTS hourarray_sum (int[24]);
+			DROP FUNCTION IF EXISTS hourarray_add(INT[24], INT[24]);
+			-- (no longer used)
+			DROP FUNCTION IF EXISTS runtime_to_seconds(TEXT);
+			DROP FUNCTION IF EXISTS days_mask_for_week(DATE, BIT VARYING, DATE);
+		""")
+
+
+# Every vehicle journey we're interested in, as vehiclejourney_dedup
+JOURNEYS = """
+	WITH vehiclejourney_fix_jpid AS (
+		SELECT
+			vj.source_id,
+			vj.vjcode_id,
+			vj.other_vjcode_id,
+			coalesce(vj.journeypattern_id, other.journeypattern_id) AS journeypattern_id,
+			vj.line_id,
+			coalesce(
+				days_mask_for_week(vj.operating_from, vj.operating_days, (SELECT monday FROM target_week)),
+				vj.days_mask) AS days_mask,
+			vj.deptime_seconds
+		FROM vehiclejourney vj
+		LEFT JOIN vehiclejourney other ON vj.other_vjcode_id = other.vjcode_id
+		WHERE %(where)s
+	),
+	vehiclejourney_dedup AS (
+		-- So, um, some buses leave at exactly the same time, and go on
+		-- exactly the same route?
+		-- But don't worry, someone adds DaysOfNonOperation each time,
+		-- a couple of days before departure.
+		-- I wouldn't trust that, so let's get rid of the obvious nonsense.
+
+		SELECT DISTINCT source_id, vjcode_id, other_vjcode_id, journeypattern_id, line_id, days_mask, deptime_seconds
+		FROM vehiclejourney_fix_jpid
+	)
+	"""
+
+
+def _insert_vehiclejourney_per_hour(cur, where):
+	cur.execute("""
+		INSERT INTO vehiclejourney_per_hour(source_id, journeypattern_id, line_id, days_mask, %(hour_columns)s)
+		%(journeys)s
+		SELECT
+			vj.source_id,
+			vj.journeypattern_id,
+			vj.line_id,
+			vj.days_mask,
+			%(hour_sums)s
+		FROM vehiclejourney_dedup vj
+		GROUP BY 1,2,3,4
+	""" % dict(
+		journeys=JOURNEYS % dict(where=where),
+		hour_columns=_hours("hour_%(hour)d", ", "),
+		hour_sums=_hours("sum(case when vj.deptime_seconds / 3600 = %(hour)d then 1 else 0 end)::int as hour_%(hour)d")))
+
+
+def _insert_source_keys(cur, where):
+	cur.execute("""
+		INSERT INTO link_frequency_source_key(source_id, from_stoppoint, to_stoppoint, weekday)
+		SELECT DISTINCT
+			vjph.source_id,
+			timing.from_stoppoint,
+			timing.to_stoppoint,
+			weekday.weekday
+		FROM vehiclejourney_per_hour vjph
+		JOIN journeypattern_service_section section USING (journeypattern_id)
+		JOIN jptiminglink timing USING (jpsection_id)
+		JOIN mask_to_weekday weekday ON weekday.mask & vjph.days_mask > 0
+		WHERE %(where)s
+	""" % dict(where=where))
+
+
+def _insert_link_frequency3(cur, tablename, only_keys, weekday=None):
+	"""Works out link_frequency3 from scratch, or only for the keys in refresh_key
+
+	With weekday, only the rows for that day (for _calculate_weekday).
+	"""
+	cur.execute("""
+		INSERT INTO %(tablename)s
+		WITH stops_and_frequency_per_line AS (
+			SELECT
+				timing.from_stoppoint,
+				timing.to_stoppoint,
+				jp_service.service_id,
+				weekday.weekday,
+				ARRAY [
+					%(hour_sums)s
+				]::int[24] AS hour_array,
+				min(timing.runtime_seconds) as min_runtime,
+				max(timing.runtime_seconds) as max_runtime
+			FROM jptiminglink timing
+			JOIN journeypattern_service_section section USING (jpsection_id)
+			JOIN vehiclejourney_per_hour vjph USING (journeypattern_id)
+			LEFT JOIN journeypattern_service jp_service USING (journeypattern_id)
+			JOIN mask_to_weekday weekday ON weekday.mask & vjph.days_mask > 0
+			%(only_weekday)s
+			%(only_keys)s
+			GROUP BY
+				timing.from_stoppoint,
+				timing.to_stoppoint,
+				jp_service.service_id,
+				weekday.weekday
+		),
+		stops_and_frequency AS (
+			SELECT
+				from_stoppoint,
+				to_stoppoint,
+				weekday,
+				ARRAY [
+					%(hour_totals)s
+				] hour_array_total,
+				ARRAY [
+					%(hour_bests)s
+				] hour_array_best_service,
+				array_agg(DISTINCT service_id) AS service_ids,
+				min(min_runtime) AS min_runtime,
+				max(max_runtime) AS max_runtime
+			FROM stops_and_frequency_per_line
+			GROUP BY
+				from_stoppoint,
+				to_stoppoint,
+				weekday
+		)
+		SELECT
+			lseg(point(from_point.latitude::double precision, from_point.longitude::double precision), point(to_point.latitude::double precision, to_point.longitude::double precision)) AS line_segment,
+			box(point(from_point.latitude::double precision, from_point.longitude::double precision), point(to_point.latitude::double precision, to_point.longitude::double precision)) AS lseg_bbox,
+
+			stops_and_frequency.from_stoppoint,
+			stops_and_frequency.to_stoppoint,
+			stops_and_frequency.weekday,
+
+			stops_and_frequency.hour_array_total,
+			stops_and_frequency.hour_array_best_service,
+			stops_and_frequency.service_ids,
+			stops_and_frequency.min_runtime,
+			stops_and_frequency.max_runtime
+
+		FROM stops_and_frequency
+		JOIN naptan from_point ON stops_and_frequency.from_stoppoint = from_point.atcocode_id
+		JOIN naptan to_point ON stops_and_frequency.to_stoppoint = to_point.atcocode_id
+	""" % dict(
+		tablename=tablename,
+		only_keys="""
+			JOIN refresh_key key
+			ON key.from_stoppoint = timing.from_stoppoint
+			AND key.to_stoppoint = timing.to_stoppoint
+			AND key.weekday = weekday.weekday
+			""" if only_keys else "",
+		only_weekday="AND weekday.weekday = '%s'" % (weekday,) if weekday else "",
+		hour_sums=_hours("sum(vjph.hour_%(hour)d)"),
+		hour_totals=_hours("sum(hour_array[%(index)d])"),
+		hour_bests=_hours("max(hour_array[%(index)d])")))
+	return cur.rowcount
+
+
+def _insert_link_headway(cur, tablename, only_keys):
+	"""Works out link_headway from scratch, or only for the keys in refresh_key
+
+	The time a bus leaves from_stoppoint is the journey's departure time,
+	plus the runtimes of the timing links before this one. Sort those for
+	each key, and the gap to the previous bus (in the same band) is lag().
+	Two buses at the same time only count once: you'd get on the first.
+	"""
+	# the journeypatterns which go along the keys in refresh_key
+	only_patterns = """
+		SELECT section.journeypattern_id
+		FROM refresh_key key
+		JOIN jptiminglink timing USING (from_stoppoint, to_stoppoint)
+		JOIN journeypattern_service_section section USING (jpsection_id)
+		"""
+	cur.execute("""
+		INSERT INTO %(tablename)s
+		%(journeys)s,
+		timing_offset AS (
+			SELECT
+				section.journeypattern_id,
+				timing.from_stoppoint,
+				timing.to_stoppoint,
+				coalesce(sum(timing.runtime_seconds) OVER (
+					PARTITION BY section.journeypattern_id
+					ORDER BY section.section_sequence, section.jpsection_id, timing.from_sequence, timing.jptiminglink_id
+					ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS offset_seconds
+			FROM jptiminglink timing
+			JOIN journeypattern_service_section section USING (jpsection_id)
+			%(only_patterns)s
+		),
+		bands(band, start_seconds, end_seconds) AS (
+			VALUES %(bands)s
+		),
+		departures AS (
+			SELECT DISTINCT
+				timing.from_stoppoint,
+				timing.to_stoppoint,
+				weekday.weekday,
+				vj.deptime_seconds + timing.offset_seconds AS departure
+			FROM vehiclejourney_dedup vj
+			JOIN timing_offset timing USING (journeypattern_id)
+			JOIN mask_to_weekday weekday ON weekday.mask & vj.days_mask > 0
+			%(only_keys)s
+		),
+		gaps AS (
+			SELECT
+				departures.*,
+				bands.band,
+				departure - lag(departure) OVER (
+					PARTITION BY from_stoppoint, to_stoppoint, weekday, bands.band
+					ORDER BY departure) AS gap
+			FROM departures
+			JOIN bands ON departure >= bands.start_seconds AND departure < bands.end_seconds
+		)
+		SELECT
+			from_stoppoint,
+			to_stoppoint,
+			weekday,
+			band,
+			count(1),
+			min(departure),
+			max(departure),
+			max(gap),
+			percentile_disc(0.5) WITHIN GROUP (ORDER BY gap)
+		FROM gaps
+		GROUP BY 1, 2, 3, 4
+	""" % dict(
+		tablename=tablename,
+		journeys=JOURNEYS % dict(
+			where="coalesce(vj.journeypattern_id, other.journeypattern_id) IN (%s)" % (only_patterns,) if only_keys else "TRUE"),
+		only_patterns="WHERE section.journeypattern_id IN (%s)" % (only_patterns,) if only_keys else "",
+		only_keys="""
+			JOIN refresh_key key
+			ON key.from_stoppoint = timing.from_stoppoint
+			AND key.to_stoppoint = timing.to_stoppoint
+			AND key.weekday = weekday.weekday
+			""" if only_keys else "",
+		bands=", ".join(
+			"('%s', %d, %d)" % (band, start * 3600, end * 3600)
+			for band, start, end in BANDS)))
+	return cur.rowcount
+
+
+def _exists(cur):
+	cur.execute("""
+		SELECT to_regclass('link_frequency3') IS NOT NULL
+		AND to_regclass('link_headway') IS NOT NULL
+	""")
+	[[exists]] = list(cur)
+	return exists
+
+
+def _partitioned(cur):
+	cur.execute("""
+		SELECT EXISTS (
+			SELECT 1 FROM pg_partitioned_table
+			WHERE partrelid = 'link_frequency3'::regclass)
+	""")
+	[[partitioned]] = list(cur)
+	return partitioned
+
+
+@contextlib.contextmanager
+def _step(description):
+	logging.info("%s...", description)
+	started = time.time()
+	yield
+	logging.info("%s took %.1fs", description, time.time() - started)
+
+
+def _rebuild(cur, engine="sql"):
+	"""Works out everything from scratch.
+
+	The server reads link_frequency3, so we mustn't lock it while this
+	runs. Instead, the new rows go into link_frequency3_new (and its
+	partitions), which is renamed to link_frequency3 at the end. Only
+	that needs an exclusive lock, so commit straight afterwards (see
+	refresh_materialized_views).
+
+	With engine="numpy", the adding up is done by numpy_aggregate.py.
+	"""
+	if engine == "numpy":
+		from . import numpy_aggregate
+
+	# Anything marked after this is left for next time
+	with _step("Clearing link_frequency_dirty_source"):
+		cur.execute("""
+			DELETE FROM link_frequency_dirty_source;
+		""")
+	with _step("Calculating vehiclejourney_per_hour"):
+		cur.execute("""
+			TRUNCATE vehiclejourney_per_hour, link_frequency_source_key;
+		""")
+		if engine == "numpy":
+			per_hour = numpy_aggregate.write_vehiclejourney_per_hour(cur)
+		else:
+			_insert_vehiclejourney_per_hour(cur, "TRUE")
+	with _step("Calculating link_frequency_source_key"):
+		_insert_source_keys(cur, "TRUE")
+	with _step("Calculating link_frequency3_new"):
+		cur.execute("""
+			DROP TABLE IF EXISTS link_frequency3_new;
+		""")
+		_create_link_frequency3(cur, "link_frequency3_new")
+		if engine == "numpy":
+			rows = numpy_aggregate.write_link_frequency3(cur, "link_frequency3_new", *per_hour)
+		else:
+			rows = _insert_link_frequency3(cur, "link_frequency3_new", only_keys=False)
+		logging.info("link_frequency3_new has %d rows", rows)
+	with _step("Indexing link_frequency3_new"):
+		_index_link_frequency3(cur, "link_frequency3_new")
+		cur.execute("""
+			ANALYZE link_frequency3_new;
+		""")
+	with _step("Calculating link_headway_new"):
+		cur.execute("""
+			DROP TABLE IF EXISTS link_headway_new;
+		""")
+		_create_link_headway(cur, "link_headway_new")
+		rows = _insert_link_headway(cur, "link_headway_new", only_keys=False)
+		logging.info("link_headway_new has %d rows", rows)
+		cur.execute("""
+			ANALYZE link_headway_new;
+		""")
+	with _step("Swapping link_frequency3_new for link_frequency3"):
+		cur.execute("""
+			DROP TABLE link_frequency3;
+		""")
+		_rename_link_frequency3(cur, "link_frequency3_new", "link_frequency3")
+		for weekday in WEEKDAYS:
+			_rename_link_frequency3(cur, _partition("link_frequency3_new", weekday), _partition("link_frequency3", weekday))
+		cur.execute("""
+			DROP TABLE IF EXISTS link_headway;
+			ALTER TABLE link_headway_new RENAME TO link_headway;
+			ALTER INDEX link_headway_new_pkey RENAME TO link_headway_pkey;
+		""")
+
+
+def _calculate_weekday(cur, weekday, engine="sql", per_hour=None):
+	"""Works out one partition of link_frequency3 from scratch
+
+	Like _rebuild, it goes into a table of its own first, which
+	_swap_weekday then puts in the place of the old partition.
+	"""
+	new = _partition("link_frequency3_new", weekday)
+	with _step("Calculating %s" % (new,)):
+		cur.execute("""
+			DROP TABLE IF EXISTS %s;
+		""" % (new,))
+		_create_link_frequency3(cur, new, weekday)
+		if engine == "numpy":
+			from . import numpy_aggregate
+			rows = numpy_aggregate.write_link_frequency3(cur, new, *per_hour, weekday=weekday)
+		else:
+			rows = _insert_link_frequency3(cur, new, only_keys=False, weekday=weekday)
+		logging.info("%s has %d rows", new, rows)
+	with _step("Indexing %s" % (new,)):
+		_index_link_frequency3(cur, new, weekday)
+		cur.execute("""
+			ANALYZE %s;
+		""" % (new,))
+
+
+def _swap_weekday(cur, weekday):
+	new = _partition("link_frequency3_new", weekday)
+	old = _partition("link_frequency3", weekday)
+	cur.execute("""
+		ALTER TABLE link_frequency3 DETACH PARTITION %(old)s;
+		DROP TABLE %(old)s;
+	""" % dict(old=old))
+	_rename_link_frequency3(cur, new, old)
+	cur.execute("""
+		ALTER TABLE link_frequency3 ATTACH PARTITION %(old)s FOR VALUES IN ('%(weekday)s');
+	""" % dict(old=old, weekday=weekday))
+
+
+def rebuild_weekdays(conn, weekdays, engine="sql"):
+	"""Works out link_frequency3 for these weekdays from scratch
+
+	This uses vehiclejourney_per_hour as it is, so refresh() first.
+
+	DETACH PARTITION locks the whole of link_frequency3, so every
+	weekday is calculated before any of them are swapped in, and the
+	caller should commit straight afterwards.
+	"""
+	started = time.time()
+	# (--rebuild-weekday can give the same one twice)
+	weekdays = [weekday for weekday in WEEKDAYS if weekday in weekdays]
+	with conn.cursor() as cur:
+		per_hour = None
+		if engine == "numpy":
+			from . import numpy_aggregate
+			per_hour = numpy_aggregate.read_vehiclejourney_per_hour(cur)
+		for weekday in weekdays:
+			_calculate_weekday(cur, weekday, engine, per_hour)
+		with _step("Swapping the new partitions into link_frequency3"):
+			for weekday in weekdays:
+				_swap_weekday(cur, weekday)
+	logging.info("Rebuilt link_frequency3 for %s in %.1fs", "".join(weekdays), time.time() - started)
+
+
+def _all_dirty(cur):
+	cur.execute("""
+		SELECT count(1)
+		FROM link_frequency_dirty_source
+		WHERE source_id = %s
+	""", (ALL_SOURCES,))
+	[[found]] = list(cur)
+	return found > 0
+
+
+def refresh(conn, full=False, engine="sql"):
+	"""Returns False if there was nothing to do
+
+	Otherwise "full" if link_frequency3 was worked out from scratch, or
+	"keys" if only the keys in refresh_key were (it's there until the
+	transaction commits).
+	"""
+	started = time.time()
+	with conn.cursor() as cur:
+		if not _exists(cur):
+			logging.info("Replacing the old materialized views with tables")
+			drop(conn)
+			create(conn)
+			full = True
+		elif not full and not _partitioned(cur):
+			logging.info("Partitioning link_frequency3 by weekday")
+			full = True
+		elif not full and _all_dirty(cur):
+			logging.info("The stops have changed since link_frequency3 was last updated")
+			full = True
+
+		if full:
+			_rebuild(cur, engine)
+			logging.info("Rebuilt link_frequency3 in %.1fs", time.time() - started)
+			return "full"
+
+		# Sources marked after this point are left for next time
+		cur.execute("""
+			CREATE TEMP TABLE refresh_source ON COMMIT DROP AS
+			SELECT source_id FROM link_frequency_dirty_source;
+		""")
+		if not cur.rowcount:
+			logging.info("Nothing has changed since link_frequency3 was last updated")
+			return False
+		sources = cur.rowcount
+
+		# The keys these sources used to contribute to...
+		cur.execute("""
+			CREATE TEMP TABLE refresh_old_key ON COMMIT DROP AS
+			SELECT from_stoppoint, to_stoppoint, weekday
+			FROM link_frequency_source_key
+			WHERE source_id IN (SELECT source_id FROM refresh_source);
+
+			DELETE FROM link_frequency_source_key
+			WHERE source_id IN (SELECT source_id FROM refresh_source);
+
+			DELETE FROM vehiclejourney_per_hour
+			WHERE source_id IN (SELECT source_id FROM refresh_source);
+		""")
+		_insert_vehiclejourney_per_hour(cur, "vj.source_id IN (SELECT source_id FROM refresh_source)")
+		_insert_source_keys(cur, "vjph.source_id IN (SELECT source_id FROM refresh_source)")
+
+		# ... and the ones they contribute to now
+		cur.execute("""
+			CREATE TEMP TABLE refresh_key ON COMMIT DROP AS
+			SELECT from_stoppoint, to_stoppoint, weekday
+			FROM link_frequency_source_key
+			WHERE source_id IN (SELECT source_id FROM refresh_source)
+			UNION
+			SELECT from_stoppoint, to_stoppoint, weekday
+			FROM refresh_old_key;
+		""")
+		keys = cur.rowcount
+		cur.execute("""
+			ANALYZE refresh_key;
+
+			DELETE FROM link_frequency3 link
+			USING refresh_key key
+			WHERE key.from_stoppoint = link.from_stoppoint
+			AND key.to_stoppoint = link.to_stoppoint
+			AND key.weekday = link.weekday;
+		""")
+		rows = _insert_link_frequency3(cur, "link_frequency3", only_keys=True)
+		cur.execute("""
+			DELETE FROM link_headway headway
+			USING refresh_key key
+			WHERE key.from_stoppoint = headway.from_stoppoint
+			AND key.to_stoppoint = headway.to_stoppoint
+			AND key.weekday = headway.weekday;
+		""")
+		_insert_link_headway(cur, "link_headway", only_keys=True)
+
+		cur.execute("""
+			DELETE FROM link_frequency_dirty_source
+			WHERE source_id IN (SELECT source_id FROM refresh_source);
+		""")
+		logging.info(
+			"Updated link_frequency3 for %d sources: %d keys, %d rows, in %.1fs",
+			sources, keys, rows, time.time() - started)
+		return "keys"
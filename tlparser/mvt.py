@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""Mapbox vector tiles, without needing the protobuf library.
+
+A tile is a protobuf message made of layers, and each layer has its
+features, plus a table of the property names (keys) and values which
+the features refer to by index. See
+https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+
+Only what we need is here: LineString features with int, float, string
+and bool properties.
+
+	layer = Layer("links")
+	layer.add_linestring([(0, 0), (4096, 4096)], {"buses": 4})
+	data = tile([layer])
+"""
+
+import math
+import struct
+
+
+EXTENT = 4096
+
+# protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+
+# vector_tile.proto field numbers
+TILE_LAYERS = 3
+LAYER_NAME = 1
+LAYER_FEATURES = 2
+LAYER_KEYS = 3
+LAYER_VALUES = 4
+LAYER_EXTENT = 5
+LAYER_VERSION = 15
+FEATURE_ID = 1
+FEATURE_TAGS = 2
+FEATURE_TYPE = 3
+FEATURE_GEOMETRY = 4
+VALUE_STRING = 1
+VALUE_DOUBLE = 3
+VALUE_SINT = 6
+VALUE_BOOL = 7
+
+LINESTRING = 2
+
+MOVE_TO = 1
+LINE_TO = 2
+
+
+def varint(number):
+	out = bytearray()
+	while True:
+		byte = number & 0x7f
+		number >>= 7
+		if number:
+			out.append(byte | 0x80)
+		else:
+			out.append(byte)
+			return bytes(out)
+
+
+def zigzag(number):
+	return (number << 1) ^ (number >> 63)
+
+
+def _key(field, wire_type):
+	return varint((field << 3) | wire_type)
+
+
+def _varint_field(field, number):
+	return _key(field, VARINT) + varint(number)
+
+
+def _bytes_field(field, data):
+	return _key(field, LENGTH_DELIMITED) + varint(len(data)) + data
+
+
+def _packed_field(field, numbers):
+	return _bytes_field(field, b"".join(varint(number) for number in numbers))
+
+
+def _value(value):
+	# bool is an int, so it has to go first
+	if isinstance(value, bool):
+		return _varint_field(VALUE_BOOL, int(value))
+	if isinstance(value, int):
+		return _varint_field(VALUE_SINT, zigzag(value))
+	if isinstance(value, float):
+		return _key(VALUE_DOUBLE, FIXED64) + struct.pack("<d", value)
+	return _bytes_field(VALUE_STRING, str(value).encode("utf8"))
+
+
+def _command(command, count):
+	return (command & 0x7) | (count << 3)
+
+
+def _linestring_geometry(points):
+	geometry = [_command(MOVE_TO, 1)]
+	x, y = 0, 0
+	for index, (point_x, point_y) in enumerate(points):
+		if index == 1:
+			geometry.append(_command(LINE_TO, len(points) - 1))
+		geometry.append(zigzag(point_x - x))
+		geometry.append(zigzag(point_y - y))
+		x, y = point_x, point_y
+	return geometry
+
+
+class Layer(object):
+	def __init__(self, name, extent=EXTENT):
+		self.name = name
+		self.extent = extent
+		self.keys = {}
+		self.values = {}
+		self.features = []
+
+	def _index(self, table, item):
+		if item not in table:
+			table[item] = len(table)
+		return table[item]
+
+	def add_linestring(self, points, properties, feature_id=None):
+		"""points are (x, y) in tile coordinates: 0 to extent, with y going down
+
+		Points which are in the same place as the one before are left out
+		(which the spec insists on). If that leaves less than a line, it's
+		too small to see at this zoom, so nothing is added and this
+		returns False.
+		"""
+		points = [
+			point for index, point in enumerate(points)
+			if index == 0 or point != points[index - 1]]
+		if len(points) < 2:
+			return False
+		tags = []
+		for key, value in properties.items():
+			if value is None:
+				continue
+			tags.append(self._index(self.keys, key))
+			# (type(value), value) so 1, 1.0 and True are different values
+			tags.append(self._index(self.values, (type(value), value)))
+		feature = b""
+		if feature_id is not None:
+			feature += _varint_field(FEATURE_ID, feature_id)
+		feature += _packed_field(FEATURE_TAGS, tags)
+		feature += _varint_field(FEATURE_TYPE, LINESTRING)
+		feature += _packed_field(FEATURE_GEOMETRY, _linestring_geometry(points))
+		self.features.append(feature)
+		return True
+
+	def encode(self):
+		return b"".join(
+			[_varint_field(LAYER_VERSION, 2), _bytes_field(LAYER_NAME, self.name.encode("utf8"))]
+			+ [_bytes_field(LAYER_FEATURES, feature) for feature in self.features]
+			+ [_bytes_field(LAYER_KEYS, key.encode("utf8")) for key in self.keys]
+			+ [_bytes_field(LAYER_VALUES, _value(value)) for _, value in self.values]
+			+ [_varint_field(LAYER_EXTENT, self.extent)])
+
+
+def tile(layers):
+	return b"".join(_bytes_field(TILE_LAYERS, layer.encode()) for layer in layers)
+
+
+def tile_bbox(z, x, y):
+	"""(minlat, minlng, maxlat, maxlng) of a web mercator tile"""
+	def latitude(tile_y):
+		return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / 2 ** z))))
+
+	def longitude(tile_x):
+		return tile_x / 2 ** z * 360 - 180
+
+	return latitude(y + 1), longitude(x), latitude(y), longitude(x + 1)
+
+
+def _world(lat, lng, z):
+	scale = 2 ** z
+	sin_lat = math.sin(math.radians(lat))
+	return (
+		(lng + 180) / 360 * scale,
+		(0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale)
+
+
+def tile_point(lat, lng, z, x, y, extent=EXTENT):
+	"""Where (lat, lng) is in tile (z, x, y), as integer tile coordinates
+
+	Points outside the tile are fine: they're off the edge (less than 0,
+	or more than extent), and the map clips them.
+	"""
+	world_x, world_y = _world(lat, lng, z)
+	return int(round((world_x - x) * extent)), int(round((world_y - y) * extent))
+
+
+def tile_containing(lat, lng, z):
+	"""(x, y) of the tile with (lat, lng) in it"""
+	world_x, world_y = _world(lat, lng, z)
+	return int(math.floor(world_x)), int(math.floor(world_y))
@@ -1,6 +1,14 @@
 #!/usr/bin/python3
-from .table_definitions import interned_atcocode
+from .bulk_writer import bulk_writer
+from .database import is_sqlite
+from .extract import Extractor
+from .intern_cache import intern_cache
+from .link_frequency import mark_all_dirty
+from .xmlparser import iter_namespaced_elements
 from lxml import etree
+import io
+import itertools
+import json
 import logging
 import zipfile
 
@@ -9,42 +17,122 @@ import zipfile
 # 	<MainNptgLocalities>
 #		<StopPoint>
 
+NAMESPACES = {"naptan": "http://www.naptan.org.uk/"}
 
-def process_all_files(conn):
+# Update the existing row for a stop, for when we're given a newer file
+NAPTAN_UPSERT = """
+	ON CONFLICT (atcocode_id) DO UPDATE SET
+		code = EXCLUDED.code,
+		name = EXCLUDED.name,
+		latitude = EXCLUDED.latitude,
+		longitude = EXCLUDED.longitude
+"""
+
+
+def process_all_files(conn, upsert=False, batch_size=5000):
+	"""Imports the active stops, using COPY.
+
+	With upsert, existing stops are updated and stops which are no
+	longer active are removed, so this can be run on a new NaPTAN file
+	without dropping the table.
+	"""
+	cache = intern_cache(conn)
+	cache.preload_atcocodes()
+	writer = bulk_writer(conn)
+	if upsert:
+		writer.on_conflict["naptan"] = NAPTAN_UPSERT
+
+	seen_atcocode_ids = set()
+	datapoints = get_datapoints_from_xml()
+	while True:
+		batch = [
+			datapoint
+			for datapoint in itertools.islice(datapoints, batch_size)
+			if datapoint[1] is not None]
+		if not batch:
+			break
+		atcocode_ids = cache.atcocode_ids([atcocode for _, atcocode, _, _, _ in batch])
+		# A stop shouldn't be listed twice, but if it is, the last one
+		# wins. (One INSERT ... ON CONFLICT can't update a row twice.)
+		rows = {}
+		for (code, _atcocode, name, latitude, longitude), atcocode_id in zip(batch, atcocode_ids):
+			rows[atcocode_id] = (atcocode_id, code, name, latitude, longitude)
+		if not seen_atcocode_ids.isdisjoint(rows):
+			# write the earlier ones first, and then update them
+			writer.flush()
+			writer.on_conflict["naptan"] = NAPTAN_UPSERT
+		if upsert:
+			clear_moved_codes(conn, rows.values())
+		for row in rows.values():
+			writer.add("naptan", row)
+		seen_atcocode_ids.update(rows)
+	writer.flush()
+	logging.info("Imported %d stops", len(seen_atcocode_ids))
+	# stops might have moved, so every link needs working out again
+	# (whenever the next --matview is)
+	mark_all_dirty(conn)
+
+	if upsert:
+		with conn.cursor() as cur:
+			if is_sqlite(conn):
+				cur.execute("""
+					DELETE FROM naptan
+					WHERE atcocode_id NOT IN (SELECT value FROM json_each(%s))
+				""", (json.dumps(sorted(seen_atcocode_ids)),))
+			else:
+				# (NOT ... = ANY() goes through the whole array for every row)
+				cur.execute("""
+					CREATE TEMP TABLE naptan_seen(atcocode_id INT PRIMARY KEY) ON COMMIT DROP;
+				""")
+				cur.copy_expert("COPY naptan_seen FROM STDIN", io.StringIO("".join(
+					"%d\n" % (atcocode_id,) for atcocode_id in seen_atcocode_ids)))
+				cur.execute("""
+					ANALYZE naptan_seen;
+
+					DELETE FROM naptan
+					WHERE NOT EXISTS (
+						SELECT 1
+						FROM naptan_seen seen
+						WHERE seen.atcocode_id = naptan.atcocode_id);
+				""")
+			logging.info("Removed %d stops", cur.rowcount)
+
+def clear_moved_codes(conn, rows):
+	"""Takes the NaptanCodes in rows off any other stops which have them
+
+	A code can move from one stop to another, and it's UNIQUE, so the
+	upsert would fail otherwise. (The other stop gets its new code
+	when we get to it, if it has one.)
+	"""
+	codes = [(code, atcocode_id) for atcocode_id, code, _, _, _ in rows if code is not None]
 	with conn.cursor() as cur:
-		for code, atcocode, name, latitude, longitude in get_datapoints_from_xml():
-			atcocode_id = interned_atcocode(conn, atcocode)
+		if is_sqlite(conn):
+			cur.execute("""
+				UPDATE naptan SET code = NULL
+				WHERE atcocode_id IN (
+					SELECT naptan.atcocode_id
+					FROM naptan
+					JOIN json_each(%s) new
+					ON naptan.code = json_extract(new.value, '$[0]')
+					AND naptan.atcocode_id <> json_extract(new.value, '$[1]'))
+			""", (json.dumps(codes),))
+		else:
 			cur.execute("""
-				INSERT INTO naptan (atcocode_id, code, name, latitude, longitude)
-				VALUES (%s, %s, %s, %s, %s);
-			""", (atcocode_id, code, name, latitude, longitude,))
+				UPDATE naptan SET code = NULL
+				FROM unnest(%s::text[], %s::int[]) AS new(code, atcocode_id)
+				WHERE naptan.code = new.code
+				AND naptan.atcocode_id <> new.atcocode_id
+			""", ([code for code, _ in codes], [atcocode_id for _, atcocode_id in codes]))
 
 def get_datapoints_from_xml():
 	with zipfile.ZipFile("naptandata/NaPTANxml.zip") as container:
 		[contentname] = container.namelist()
 		with container.open(contentname) as f:
-			parser = etree.XMLPullParser(events=("end",), no_network=True)
-			while True:
-				data = f.read(1024)
-				if not data:
-					break
-				parser.feed(data)
-				for action, elem in parser.read_events():
-					if elem.tag.endswith('StopPoint'):
-						if elem.get("Status") == "active":
-							yield handle_stoppoint(elem)
-						cleanup(elem)
-
-def cleanup(element):
-	element.clear()                 # clean up children
-	while element.getprevious() is not None:
-		del element.getparent()[0]  # clean up preceding siblings
-
-def xpath(elem, path):
-	return elem.xpath(path, namespaces={"naptan": "http://www.naptan.org.uk/"}, smart_strings=False)
-
-def float_content(elem, path):
-	values = xpath(elem, path)
+			for _tagname, elem in iter_namespaced_elements(f, ["StopPoint"], NAMESPACES["naptan"]):
+				if elem.get("Status") == "active":
+					yield handle_stoppoint(elem)
+
+def float_content(values):
 	if len(values) == 1:
 		return float(values[0])
 	elif len(values) == 0:
@@ -53,23 +141,31 @@ def float_content(elem, path):
 		logging.debug("file contains multiple values for location, averaging: %r", values)
 		return sum(float(x) for x in values) / len(values)
 
-def text_content(elem, path):
-	values = xpath(elem, path)
+def text_content(values):
 	if len(values) == 1:
 		return values[0]
 	elif len(values) == 0:
 		return None
 	else:
 		logging.info("text_content: %r", values)
-		return "".join(path)
+		return "".join(values)
+
+STOPPOINT_FIELDS = (Extractor(NAMESPACES)
+	.all("./naptan:Descriptor/naptan:CommonName/text()")
+	.all("./naptan:NaptanCode/text()")
+	.all("./naptan:AtcoCode/text()")
+	# may be in the Location, or in a Translation inside it
+	.all(".//naptan:Latitude/text()")
+	.all(".//naptan:Longitude/text()"))
 
 def handle_stoppoint(elem):
 	try:
-		name = text_content(elem, ".//naptan:Descriptor/naptan:CommonName/text()")
-		code = text_content(elem, ".//naptan:NaptanCode/text()")
-		atcocode = text_content(elem, ".//naptan:AtcoCode/text()")
-		latitude = float_content(elem, ".//naptan:Latitude/text()")
-		longitude = float_content(elem, ".//naptan:Longitude/text()")
+		names, codes, atcocodes, latitudes, longitudes = STOPPOINT_FIELDS(elem)
+		name = text_content(names)
+		code = text_content(codes)
+		atcocode = text_content(atcocodes)
+		latitude = float_content(latitudes)
+		longitude = float_content(longitudes)
 
 		return (code, atcocode, name, latitude, longitude)
 
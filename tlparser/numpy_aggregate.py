@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""--engine numpy: work out link_frequency3 with numpy instead of SQL.
+
+The SQL version adds up 24 CASE expressions for every journey, and then
+24 sums and 24 maxes for every link. Here we fetch the journeys and the
+timing links once (with COPY, as integers), count the journeys in each
+hour with bincount, add them up for each link with add.at, and COPY the
+results back.
+
+It only does the full rebuild (see link_frequency._rebuild): updating a
+few keys is cheap enough in SQL. The rows are the same as the SQL
+version's, which tests/numpy_aggregate.py checks against the sqlite
+version of the same query.
+
+NULLs are -1 here, which is fine because all the ids are positive.
+"""
+
+import io
+
+import numpy
+
+from .bulk_writer import _copy_text
+from .link_frequency import HOURS, JOURNEYS, WEEKDAYS
+
+# rows at a time for add.at, which makes a (rows, 24) array
+CHUNK_ROWS = 1 << 20
+
+NULL = -1
+
+JOURNEYS_QUERY = JOURNEYS % dict(where="TRUE") + """
+	SELECT
+		source_id,
+		coalesce(journeypattern_id, -1),
+		coalesce(line_id, -1),
+		coalesce(days_mask, -1),
+		coalesce(deptime_seconds, -1)
+	FROM vehiclejourney_dedup
+	"""
+
+TIMING_QUERY = """
+	SELECT
+		coalesce(timing.from_stoppoint, -1),
+		coalesce(timing.to_stoppoint, -1),
+		coalesce(section.journeypattern_id, -1),
+		coalesce(jp_service.service_id, -1),
+		coalesce(timing.runtime_seconds, -1)
+	FROM jptiminglink timing
+	JOIN journeypattern_service_section section USING (jpsection_id)
+	LEFT JOIN journeypattern_service jp_service USING (journeypattern_id)
+	"""
+
+
+def per_hour(journeys):
+	"""Like vehiclejourney_per_hour, from JOURNEYS_QUERY.
+
+	Returns each (source_id, journeypattern_id, line_id, days_mask), and
+	how many journeys leave in each hour for each of them.
+	"""
+	if len(journeys) == 0:
+		return numpy.zeros((0, 4), dtype=numpy.int64), numpy.zeros((0, 24), dtype=numpy.int64)
+	keys, index = numpy.unique(journeys[:, :4], axis=0, return_inverse=True)
+	index = index.reshape(-1)
+	deptime = journeys[:, 4]
+	hours = deptime // 3600
+	# (deptime_seconds / 3600 = N for N in 0..23)
+	counted = (deptime >= 0) & (hours < 24)
+	hist = numpy.bincount(
+		index[counted] * 24 + hours[counted],
+		minlength=len(keys) * 24).reshape(-1, 24)
+	return keys, hist
+
+
+def link_frequencies(keys, hist, timing, weekdays=WEEKDAYS):
+	"""Like link_frequency3 (without the locations), from per_hour() and TIMING_QUERY.
+
+	Yields (from_stoppoint, to_stoppoint, weekday, hour_array_total,
+	hour_array_best_service, service_ids, min_runtime, max_runtime), for
+	each of the weekdays.
+	"""
+	# JOIN vehiclejourney_per_hour ... JOIN mask_to_weekday: the
+	# journeys in each hour for each journeypattern on each weekday
+	usable = (keys[:, 1] != NULL) & (keys[:, 3] != NULL)
+	masks = keys[usable, 3]
+	hist = hist[usable]
+	journeypatterns, jp_index = numpy.unique(keys[usable, 1], return_inverse=True)
+	if len(journeypatterns) == 0 or len(timing) == 0:
+		return
+	jp_hours = numpy.zeros((len(journeypatterns), len(WEEKDAYS), 24), dtype=numpy.int64)
+	jp_runs = numpy.zeros((len(journeypatterns), len(WEEKDAYS)), dtype=bool)
+	for day in range(len(WEEKDAYS)):
+		runs = (masks >> day) & 1 == 1
+		numpy.add.at(jp_hours[:, day], jp_index[runs], hist[runs])
+		jp_runs[jp_index[runs], day] = True
+
+	position = numpy.minimum(numpy.searchsorted(journeypatterns, timing[:, 2]), len(journeypatterns) - 1)
+	found = journeypatterns[position] == timing[:, 2]
+	for day, weekday in enumerate(WEEKDAYS):
+		if weekday not in weekdays:
+			continue
+		rows = found & jp_runs[position, day]
+		yield from _links_for_day(weekday, timing[rows], position[rows], jp_hours[:, day])
+
+
+def _links_for_day(weekday, timing, position, jp_hours):
+	if len(timing) == 0:
+		return
+
+	# stops_and_frequency_per_line: GROUP BY from_stoppoint, to_stoppoint, service_id
+	lines, line_index = numpy.unique(timing[:, [0, 1, 3]], axis=0, return_inverse=True)
+	line_index = line_index.reshape(-1)
+	line_hours = numpy.zeros((len(lines), 24), dtype=numpy.int64)
+	for start in range(0, len(timing), CHUNK_ROWS):
+		chunk = slice(start, start + CHUNK_ROWS)
+		numpy.add.at(line_hours, line_index[chunk], jp_hours[position[chunk]])
+
+	runtime = timing[:, 4]
+	has_runtime = runtime != NULL
+	no_runtime = numpy.iinfo(numpy.int64).max
+	line_min = numpy.full(len(lines), no_runtime, dtype=numpy.int64)
+	numpy.minimum.at(line_min, line_index[has_runtime], runtime[has_runtime])
+	line_max = numpy.full(len(lines), NULL, dtype=numpy.int64)
+	numpy.maximum.at(line_max, line_index[has_runtime], runtime[has_runtime])
+
+	# stops_and_frequency: GROUP BY from_stoppoint, to_stoppoint. The
+	# lines are sorted, so each link is a run of them.
+	starts = numpy.flatnonzero(numpy.r_[True, (lines[1:, :2] != lines[:-1, :2]).any(axis=1)])
+	ends = numpy.r_[starts[1:], len(lines)]
+	totals = numpy.add.reduceat(line_hours, starts, axis=0).tolist()
+	bests = numpy.maximum.reduceat(line_hours, starts, axis=0).tolist()
+	mins = numpy.minimum.reduceat(line_min, starts).tolist()
+	maxes = numpy.maximum.reduceat(line_max, starts).tolist()
+	services = lines[:, 2].tolist()
+	for link, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+		service_ids = services[start:end]
+		if service_ids[0] == NULL:
+			# array_agg(DISTINCT ...) puts NULL last
+			service_ids = service_ids[1:] + [None]
+		yield (
+			int(lines[start, 0]),
+			int(lines[start, 1]),
+			weekday,
+			totals[link],
+			bests[link],
+			service_ids,
+			mins[link] if mins[link] != no_runtime else None,
+			maxes[link] if maxes[link] != NULL else None)
+
+
+def _fetch_ints(cur, query, columns):
+	data = io.BytesIO()
+	cur.copy_expert("COPY (%s) TO STDOUT" % (query,), data)
+	return numpy.fromstring(data.getvalue(), dtype=numpy.int64, sep=" ").reshape(-1, columns)
+
+
+def _copy_rows(cur, tablename, columns, rows):
+	data = io.StringIO("".join(
+		"\t".join(_copy_text(value) for value in row) + "\n"
+		for row in rows))
+	cur.copy_expert("COPY %s (%s) FROM STDIN" % (tablename, ", ".join(columns)), data)
+
+
+def _array(values):
+	return "{%s}" % (",".join("NULL" if value is None else str(value) for value in values),)
+
+
+def write_vehiclejourney_per_hour(cur):
+	"""Fills (empty) vehiclejourney_per_hour, and returns per_hour()"""
+	keys, hist = per_hour(_fetch_ints(cur, JOURNEYS_QUERY, 5))
+	_copy_rows(
+		cur, "vehiclejourney_per_hour",
+		["source_id", "journeypattern_id", "line_id", "days_mask"] + ["hour_%d" % (hour,) for hour in HOURS],
+		(
+			[None if value == NULL else value for value in key] + hours
+			for key, hours in zip(keys.tolist(), hist.tolist())))
+	return keys, hist
+
+
+def read_vehiclejourney_per_hour(cur):
+	"""per_hour(), from what's already in vehiclejourney_per_hour"""
+	rows = _fetch_ints(cur, """
+		SELECT
+			source_id,
+			coalesce(journeypattern_id, -1),
+			coalesce(line_id, -1),
+			coalesce(days_mask, -1),
+			%s
+		FROM vehiclejourney_per_hour
+		""" % (", ".join("hour_%d" % (hour,) for hour in HOURS),), 4 + len(HOURS))
+	return rows[:, :4], rows[:, 4:]
+
+
+def write_link_frequency3(cur, tablename, keys, hist, weekday=None):
+	"""Fills (empty) tablename like link_frequency3, and returns the number of rows
+
+	With weekday, only the rows for that day.
+	"""
+	cur.execute("""
+		SELECT atcocode_id, latitude::double precision, longitude::double precision
+		FROM naptan
+	""")
+	locations = {atcocode_id: (latitude, longitude) for atcocode_id, latitude, longitude in cur}
+	timing = _fetch_ints(cur, TIMING_QUERY, 5)
+
+	rows = []
+	for from_stoppoint, to_stoppoint, day, total, best, service_ids, min_runtime, max_runtime in link_frequencies(keys, hist, timing, weekday or WEEKDAYS):
+		# JOIN naptan
+		if from_stoppoint not in locations or to_stoppoint not in locations:
+			continue
+		coordinates = locations[from_stoppoint] + locations[to_stoppoint]
+		if None in coordinates:
+			line_segment = lseg_bbox = None
+		else:
+			line_segment = "[(%r,%r),(%r,%r)]" % coordinates
+			lseg_bbox = "((%r,%r),(%r,%r))" % coordinates
+		rows.append((
+			line_segment, lseg_bbox,
+			from_stoppoint, to_stoppoint, day,
+			_array(total), _array(best), _array(service_ids),
+			min_runtime, max_runtime))
+	_copy_rows(
+		cur, tablename,
+		["line_segment", "lseg_bbox", "from_stoppoint", "to_stoppoint", "weekday",
+		"hour_array_total", "hour_array_best_service", "service_ids", "min_runtime", "max_runtime"],
+		rows)
+	return len(rows)
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""Which days a vehiclejourney runs on.
+
+An OperatingProfile is some regular days of the week, less some ranges
+of dates (DaysOfNonOperation). Rather than boil that down to the days
+of one week, we store a bitmap with one bit per day, starting on
+`operating_from`: "1" if it runs that day, "0" if it doesn't. The
+days_mask for any week in the bitmap can be worked out from that (see
+days_mask_for_week in link_frequency.py for the SQL version).
+
+The bitmap covers the weeks of the service's OperatingPeriod (see
+operating_window), and it doesn't run outside that.
+"""
+
+import datetime
+import functools
+
+MON = 1<<0
+TUE = 1<<1
+WED = 1<<2
+THUR = 1<<3
+FRI = 1<<4
+SAT = 1<<5
+SUN = 1<<6
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_date(date_str):
+	return datetime.date.fromisoformat(date_str)
+
+
+def monday_on_or_before(date):
+	return date - datetime.timedelta(days=date.weekday())
+
+
+@functools.lru_cache(maxsize=16)
+def _week_dates(monday):
+	assert monday.weekday() == 0
+	return tuple(
+		(monday + datetime.timedelta(days=day), 1<<day)
+		for day in range(7))
+
+
+def days_mask_for_week(regular_days, non_operation, monday):
+	"""The days_mask for the week starting on `monday`
+
+	regular_days is a days_mask, non_operation a list of (start, end)
+	dates (inclusive).
+	"""
+	days_mask = regular_days
+	for exclude_start, exclude_end in non_operation:
+		for date, bit in _week_dates(monday):
+			if exclude_start <= date <= exclude_end:
+				days_mask &= ~bit
+	return days_mask
+
+
+@functools.lru_cache(maxsize=1024)
+def _regular_bitmap(regular_days, first_weekday, days):
+	return bytes(
+		ord("1") if regular_days & (1 << ((first_weekday + day) % 7)) else ord("0")
+		for day in range(days))
+
+
+def operating_bitmap(regular_days, non_operation, operating_from, days):
+	"""A string of "0" and "1", one for each of `days` days from operating_from"""
+	bitmap = bytearray(_regular_bitmap(regular_days, operating_from.weekday(), days))
+	for exclude_start, exclude_end in non_operation:
+		first = max((exclude_start - operating_from).days, 0)
+		last = min((exclude_end - operating_from).days, days - 1)
+		if first <= last:
+			bitmap[first:last + 1] = b"0" * (last + 1 - first)
+	return bitmap.decode("ascii")
+
+
+def outside_period(start, end):
+	"""The days outside an OperatingPeriod, like a DaysOfNonOperation
+
+	end is None if it doesn't have one.
+	"""
+	ranges = [(datetime.date.min, start - datetime.timedelta(days=1))]
+	if end is not None:
+		ranges.append((end + datetime.timedelta(days=1), datetime.date.max))
+	return ranges
+
+
+@functools.lru_cache(maxsize=1024)
+def operating_window(start, end, calendar_start, max_days):
+	"""(operating_from, days) for the bitmap of an OperatingPeriod
+
+	Whole weeks, from the one it starts in (but not before
+	calendar_start) to the one it ends in, and at most max_days. No
+	days at all if it ended before calendar_start.
+	"""
+	operating_from = max(monday_on_or_before(start), calendar_start)
+	days = max_days
+	if end is not None:
+		last = monday_on_or_before(end) + datetime.timedelta(days=6)
+		days = min(days, max((last - operating_from).days + 1, 0))
+	return operating_from, days
+
+
+def days_mask_from_bitmap(operating_from, bitmap, monday):
+	"""The days_mask for a week, or None if the bitmap doesn't cover it"""
+	first = (monday - operating_from).days
+	if first < 0 or first + 7 > len(bitmap):
+		return None
+	days_mask = 0
+	for day in range(7):
+		if bitmap[first + day] == "1":
+			days_mask |= 1<<day
+	return days_mask
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""Where does the time go when importing xml files? (--profile DIR)
+
+For each xml file we record the wall time, the time spent in each of
+the PARSERS, the rows written to each table and the peak RSS of the
+process so far. That goes into the source_stats table, and summary()
+writes DIR/summary.json at the end.
+
+With --profile-dumps N, every file is run under cProfile as well, and
+DIR/<file>.prof is kept for the N slowest files. (cProfile makes
+everything a lot slower, so the wall times aren't much use then.)
+"""
+
+import collections
+import cProfile
+import heapq
+import json
+import logging
+import os
+import resource
+import time
+
+from psycopg2.extras import Json
+
+
+def _dump_filename(directory, source):
+	return os.path.join(directory, source.replace("/", "_") + ".prof")
+
+
+class _FileStats(object):
+	def __init__(self, source):
+		self.source = source
+		self.started = time.perf_counter()
+		self.wall_time = None
+		self.handler_seconds = collections.Counter()
+		self.handler_elements = collections.Counter()
+		self.rows_written = collections.Counter()
+		self.peak_rss_kb = None
+
+
+class Profiler(object):
+	def __init__(self, directory, run_started, dumps=0):
+		self.directory = directory
+		self.run_started = run_started
+		self.dumps = dumps
+		# (wall_time, source) of the slowest files we've kept a dump for
+		self.slowest = []
+		self.current = None
+		self.cprofile = None
+		self.rows_before = None
+
+	def start(self, source, parsers, writer):
+		"""Start timing a file. Returns the parsers to use instead of `parsers`"""
+		self.current = _FileStats(source)
+		self.rows_before = collections.Counter(writer.rows_written)
+		if self.dumps:
+			self.cprofile = cProfile.Profile()
+			self.cprofile.enable()
+		return {
+			tagname: self._timed(tagname, func)
+			for tagname, func in parsers.items()}
+
+	def _timed(self, tagname, func):
+		stats = self.current
+		def timed_func(elem, *args):
+			started = time.perf_counter()
+			try:
+				return func(elem, *args)
+			finally:
+				stats.handler_seconds[tagname] += time.perf_counter() - started
+				stats.handler_elements[tagname] += 1
+		return timed_func
+
+	def finish(self, writer):
+		stats = self.current
+		if self.cprofile is not None:
+			self.cprofile.disable()
+		stats.wall_time = time.perf_counter() - stats.started
+		stats.rows_written = collections.Counter(writer.rows_written) - self.rows_before
+		# (kilobytes, on linux)
+		stats.peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		if self.cprofile is not None:
+			self._keep_dump(stats)
+			self.cprofile = None
+
+	def _keep_dump(self, stats):
+		entry = (stats.wall_time, stats.source)
+		if len(self.slowest) < self.dumps:
+			heapq.heappush(self.slowest, entry)
+		elif entry > self.slowest[0]:
+			_, faster_source = heapq.heapreplace(self.slowest, entry)
+			os.remove(_dump_filename(self.directory, faster_source))
+		else:
+			return
+		self.cprofile.dump_stats(_dump_filename(self.directory, stats.source))
+
+	def save(self, conn, source_id, error):
+		"""Writes the stats for the file we've just finished"""
+		stats = self.current
+		self.current = None
+		with conn:
+			with conn.cursor() as cur:
+				cur.execute("""
+					INSERT INTO source_stats(
+						run_started, source, source_id, error,
+						wall_time, handler_seconds, handler_elements,
+						rows_written, peak_rss_kb)
+					VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+				""", (
+					self.run_started, stats.source, source_id, error is not None,
+					stats.wall_time, Json(stats.handler_seconds), Json(stats.handler_elements),
+					Json(stats.rows_written), stats.peak_rss_kb,))
+
+
+def summary(conn, directory, run_started, dumps=0, slowest=20):
+	"""Writes DIR/summary.json for everything in this run, from source_stats.
+
+	Each process only knows which of its own files were slowest, so this
+	is also where the dumps for all but the N slowest files are removed.
+	"""
+	with conn.cursor() as cur:
+		cur.execute("""
+			SELECT source, source_id, error, wall_time, handler_seconds,
+				handler_elements, rows_written, peak_rss_kb
+			FROM source_stats
+			WHERE run_started = %s
+			ORDER BY wall_time DESC
+		""", (run_started,))
+		rows = list(cur)
+
+	handler_seconds = collections.Counter()
+	handler_elements = collections.Counter()
+	rows_written = collections.Counter()
+	for _, _, _, _, seconds, elements, written, _ in rows:
+		handler_seconds.update(seconds)
+		handler_elements.update(elements)
+		rows_written.update(written)
+	wall_time = sum(row[3] for row in rows)
+
+	result = dict(
+		run_started=run_started.isoformat(),
+		files=len(rows),
+		errors=sum(1 for row in rows if row[2]),
+		wall_time=wall_time,
+		# time spent reading the xml, waiting for the database, etc
+		other_seconds=wall_time - sum(handler_seconds.values()),
+		handler_seconds=handler_seconds,
+		handler_elements=handler_elements,
+		rows_written=rows_written,
+		peak_rss_kb=max((row[7] for row in rows), default=None),
+		slowest=[
+			dict(
+				source=source, source_id=source_id, error=error, wall_time=wall,
+				handler_seconds=seconds, rows_written=written, peak_rss_kb=rss)
+			for source, source_id, error, wall, seconds, _, written, rss in rows[:slowest]])
+
+	filename = os.path.join(directory, "summary.json")
+	with open(filename, "w") as f:
+		json.dump(result, f, indent=2, sort_keys=True)
+	logging.info(
+		"Profiled %d files (%.1fs) in %s",
+		len(rows), wall_time, filename)
+
+	if dumps:
+		for source, *_ in rows[dumps:]:
+			try:
+				os.remove(_dump_filename(directory, source))
+			except FileNotFoundError:
+				pass
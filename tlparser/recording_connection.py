@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""Pretends to be a psycopg2 connection, for benchmarks and tests.
+
+Remembers what it was asked to do, but doesn't do it. Just enough of
+an answer is given for an import to run: every INSERT ... RETURNING
+returns a new id, asking for ids from a sequence gets as many as were
+asked for, and everything else returns no rows.
+
+So this times the parsing and the formatting of the rows, but not the
+database.
+"""
+
+import collections
+import itertools
+import re
+
+import psycopg2.extensions
+
+
+GENERATE_SERIES = re.compile(r"generate_series\(1, (\d+)\)")
+
+
+class RecordingCursor(object):
+	def __init__(self, conn):
+		self.connection = conn
+		self.rows = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		pass
+
+	def __iter__(self):
+		rows, self.rows = self.rows, []
+		return iter(rows)
+
+	def fetchall(self):
+		return list(self)
+
+	def mogrify(self, sql, params=None):
+		if isinstance(sql, bytes):
+			sql = sql.decode("utf8")
+		if isinstance(params, dict):
+			sql = sql % {name: repr(param) for name, param in params.items()}
+		elif params is not None:
+			sql = sql % tuple(repr(param) for param in params)
+		return sql.encode("utf8")
+
+	def execute(self, sql, params=None):
+		sql = self.mogrify(sql, params).decode("utf8")
+		self.connection.statements[_statement_name(sql)] += 1
+		self.rows = []
+		match = GENERATE_SERIES.search(sql)
+		if match:
+			self.rows = [(self.connection.next_id(),) for _ in range(int(match.group(1)))]
+		elif "RETURNING" in sql.upper():
+			self.rows = [(self.connection.next_id(),)]
+
+	def copy_expert(self, sql, data):
+		text = data.read()
+		tablename = sql.split()[1]
+		self.connection.statements[_statement_name(sql)] += 1
+		self.connection.copy_rows[tablename] += text.count("\n")
+		self.connection.copy_bytes[tablename] += len(text)
+
+
+def _statement_name(sql):
+	"""The first couple of words, eg: "INSERT INTO" or "COPY vehiclejourney" """
+	return " ".join(sql.split()[:2])
+
+
+class RecordingConnection(object):
+	encoding = "UTF8"
+
+	def __init__(self):
+		self.ids = itertools.count(1)
+		self.statements = collections.Counter()
+		self.copy_rows = collections.Counter()
+		self.copy_bytes = collections.Counter()
+		self.commits = 0
+		self.rollbacks = 0
+
+	def next_id(self):
+		return next(self.ids)
+
+	def cursor(self):
+		return RecordingCursor(self)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.commits += 1
+		else:
+			self.rollbacks += 1
+
+	def get_transaction_status(self):
+		return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+	def close(self):
+		pass
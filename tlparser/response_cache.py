@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""Keeps the server's responses until the data changes.
+
+The bus routes only change when --matview runs, which bumps the number
+in dataset_version (see table_definitions.bump_dataset_version). So a
+response can be kept for as long as that number stays the same.
+
+Responses are kept in memory (the most recently used, up to
+memory_bytes), and in files under directory (up to disk_bytes, again
+throwing away the least recently used). The files are in a directory
+for each version, and the old versions are deleted when a new one
+turns up.
+
+Several server processes can share a directory: each one only knows
+the sizes of the files it has written or read (plus what was there
+when it started), so the total can go a bit over disk_bytes.
+
+ExpiringCache is just the memory part, for things which aren't a whole
+response (server.py keeps the geojson features for a bbox in one).
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+class ResponseCache(object):
+	def __init__(self, directory=None, memory_bytes=64 << 20, disk_bytes=1 << 30):
+		self.directory = directory
+		self.memory_bytes = memory_bytes
+		self.disk_bytes = disk_bytes
+		self.version = None
+		self.lock = threading.Lock()
+		# key: data, least recently used first
+		self.memory = collections.OrderedDict()
+		self.memory_used = 0
+		# filename: size, least recently used first
+		self.disk = collections.OrderedDict()
+		self.disk_used = 0
+		self.counts = collections.Counter()
+
+	def _filename(self, key):
+		digest = hashlib.sha1(key.encode("utf8")).hexdigest()
+		return os.path.join(self.directory, str(self.version), digest[:2], digest)
+
+	def _set_version(self, version):
+		"""True if that's a different version: everything we had is forgotten
+
+		Any change counts, not only a bigger number (the tables might
+		have been made again from scratch). Call with the lock held,
+		and then _use_directory without it.
+		"""
+		if version == self.version:
+			return False
+		logging.info("Response cache is now for dataset version %s", version)
+		self.version = version
+		self.memory.clear()
+		self.memory_used = 0
+		self.disk.clear()
+		self.disk_used = 0
+		return True
+
+	def _use_directory(self, version):
+		"""Deletes the other versions, and picks up the files for this one"""
+		with self.lock:
+			if self.directory is None or self.version != version:
+				return
+		os.makedirs(self.directory, exist_ok=True)
+		for name in os.listdir(self.directory):
+			if name != str(version):
+				shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+		# files from before we started, oldest first
+		found = []
+		for parent, _, filenames in os.walk(os.path.join(self.directory, str(version))):
+			for name in filenames:
+				try:
+					stat = os.stat(os.path.join(parent, name))
+				except FileNotFoundError:
+					continue
+				found.append((stat.st_mtime, os.path.join(parent, name), stat.st_size))
+		evicted = []
+		with self.lock:
+			if self.version == version:
+				for _, filename, size in sorted(found):
+					evicted.extend(self._remember_file(filename, size))
+		self._unlink(evicted)
+
+	def _remember(self, key, data):
+		if key in self.memory:
+			self.memory.move_to_end(key)
+			return
+		self.memory[key] = data
+		self.memory_used += len(data)
+		while self.memory_used > self.memory_bytes:
+			_, old = self.memory.popitem(last=False)
+			self.memory_used -= len(old)
+
+	def _remember_file(self, filename, size):
+		"""The files to delete to make room (with the lock released, please)"""
+		if filename in self.disk:
+			self.disk.move_to_end(filename)
+			return []
+		self.disk[filename] = size
+		self.disk_used += size
+		evicted = []
+		while self.disk_used > self.disk_bytes:
+			old, old_size = self.disk.popitem(last=False)
+			self.disk_used -= old_size
+			evicted.append(old)
+		return evicted
+
+	def _unlink(self, filenames):
+		for filename in filenames:
+			try:
+				os.unlink(filename)
+			except FileNotFoundError:
+				# (another process got there first)
+				pass
+
+	# The lock is only held for looking at and changing the dicts: the
+	# files are read and written without it.
+
+	def get(self, version, key):
+		"""The data, or None"""
+		with self.lock:
+			new_version = self._set_version(version)
+			if key in self.memory:
+				self.memory.move_to_end(key)
+				self.counts["memory"] += 1
+				return self.memory[key]
+			if self.directory is None:
+				self.counts["miss"] += 1
+				return None
+			filename = self._filename(key)
+		if new_version:
+			self._use_directory(version)
+
+		try:
+			with open(filename, "rb") as f:
+				data = f.read()
+			# the mtime is for sorting them when we start again
+			os.utime(filename)
+		except FileNotFoundError:
+			data = None
+
+		evicted = []
+		with self.lock:
+			if data is None:
+				self.counts["miss"] += 1
+			else:
+				self.counts["disk"] += 1
+				if self.version == version:
+					evicted = self._remember_file(filename, len(data))
+					self._remember(key, data)
+		self._unlink(evicted)
+		return data
+
+	def put(self, version, key, data):
+		with self.lock:
+			new_version = self.version is None and self._set_version(version)
+			if version != self.version:
+				# (a request which started before the version changed)
+				return
+			self._remember(key, data)
+			if self.directory is None:
+				return
+			filename = self._filename(key)
+		if new_version:
+			self._use_directory(version)
+
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		# other processes mustn't see half a file
+		with tempfile.NamedTemporaryFile(dir=os.path.dirname(filename), delete=False) as f:
+			f.write(data)
+		os.replace(f.name, filename)
+
+		evicted = []
+		with self.lock:
+			if self.version == version:
+				evicted = self._remember_file(filename, len(data))
+		self._unlink(evicted)
+
+	def stats(self):
+		with self.lock:
+			requests = sum(self.counts.values())
+			return {
+				"version": self.version,
+				"requests": requests,
+				"memory_hits": self.counts["memory"],
+				"disk_hits": self.counts["disk"],
+				"misses": self.counts["miss"],
+				"hit_rate": (self.counts["memory"] + self.counts["disk"]) / requests if requests else None,
+				"memory_bytes": self.memory_used,
+				"memory_items": len(self.memory),
+				"disk_bytes": self.disk_used,
+				"disk_items": len(self.disk),
+			}
+
+
+class ExpiringCache(object):
+	"""Python objects in memory, for up to ttl_seconds each
+
+	Like the memory part of ResponseCache (throwing away the least
+	recently used when there's more than memory_bytes), but the caller
+	says how big each value is, and the key includes the version.
+	"""
+	def __init__(self, memory_bytes=64 << 20, ttl_seconds=600):
+		self.memory_bytes = memory_bytes
+		self.ttl_seconds = ttl_seconds
+		self.lock = threading.Lock()
+		# key: (expires, size, value), least recently used first
+		self.items = collections.OrderedDict()
+		self.memory_used = 0
+		self.counts = collections.Counter()
+
+	def _forget(self, key):
+		_, size, _ = self.items.pop(key)
+		self.memory_used -= size
+
+	def get(self, key):
+		"""The value, or None"""
+		with self.lock:
+			if key in self.items:
+				expires, _, value = self.items[key]
+				if time.monotonic() < expires:
+					self.items.move_to_end(key)
+					self.counts["hit"] += 1
+					return value
+				self._forget(key)
+				self.counts["expired"] += 1
+			self.counts["miss"] += 1
+			return None
+
+	def put(self, key, value, size):
+		with self.lock:
+			if key in self.items:
+				self._forget(key)
+			self.items[key] = (time.monotonic() + self.ttl_seconds, size, value)
+			self.memory_used += size
+			while self.memory_used > self.memory_bytes:
+				self._forget(next(iter(self.items)))
+
+	def stats(self):
+		with self.lock:
+			requests = self.counts["hit"] + self.counts["miss"]
+			return {
+				"requests": requests,
+				"hits": self.counts["hit"],
+				"misses": self.counts["miss"],
+				"expired": self.counts["expired"],
+				"hit_rate": self.counts["hit"] / requests if requests else None,
+				"memory_bytes": self.memory_used,
+				"memory_items": len(self.items),
+			}
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""Keeps the rows from each xml file on disk, so we can skip parsing it.
+
+With --row-cache DIR, the rows the add_* handlers produce for a file
+are saved in DIR, named after the file's checksum. Next time we import
+a file with that checksum (eg: after --destroy_create_tables), the rows
+are loaded from there instead of parsing the xml.
+
+The ids from the *_intern tables will be different next time, so the
+rows are saved with the codes from the xml instead (eg: the
+VehicleJourneyCode rather than vjcode_id), and are interned again when
+they're loaded. Each table is saved as a list of columns, pickled and
+gzipped.
+
+The rows for a vehiclejourney depend on --target-week and the
+--calendar-* options, so those are part of the filename too. Nothing is
+ever deleted from DIR.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import pickle
+
+from .bulk_writer import TABLE_COLUMNS
+from .intern_cache import intern_cache
+
+
+# Bump this when the add_* handlers change what they produce
+FORMAT_VERSION = 4
+
+# column: the intern table its ids come from
+INTERNED_COLUMNS = {
+	"stoppoint": {"atcocode_id": "atcocode"},
+	"routelink": {"routelink_id": "routelink", "from_stoppoint": "atcocode", "to_stoppoint": "atcocode"},
+	"service": {"service_id": "service"},
+	"route": {"route_id": "route"},
+	"journeypattern_service": {"journeypattern_id": "journeypattern", "service_id": "service", "route_id": "route"},
+	"journeypattern_service_section": {"jpsection_id": "jpsection", "journeypattern_id": "journeypattern"},
+	"jptiminglink": {"jptiminglink_id": "jptiminglink", "jpsection_id": "jpsection", "routelink_id": "routelink", "from_stoppoint": "atcocode", "to_stoppoint": "atcocode"},
+	"line": {"line_id": "line"},
+	"vehiclejourney": {"vjcode_id": "vjcode", "other_vjcode_id": "vjcode", "journeypattern_id": "journeypattern", "line_id": "line"},
+}
+
+
+class RowCache(object):
+	def __init__(self, directory, args):
+		self.directory = directory
+		self.options = (
+			FORMAT_VERSION,
+			args.monday_of_desired_week,
+			args.calendar_start,
+			args.calendar_days)
+
+	def filename(self, zipinfo):
+		options = hashlib.sha1(repr(self.options).encode("utf8")).hexdigest()[:12]
+		return os.path.join(
+			self.directory,
+			"%08x-%d-%s.pickle.gz" % (zipinfo.CRC, zipinfo.file_size, options))
+
+	def load(self, zipinfo):
+		"""The saved tables for this file, or None"""
+		try:
+			with gzip.open(self.filename(zipinfo), "rb") as f:
+				tables = pickle.load(f)
+		except FileNotFoundError:
+			return None
+		except Exception:
+			logging.exception("Ignoring broken row cache %s", self.filename(zipinfo))
+			return None
+		for tablename, (columns, _) in tables.items():
+			if tablename not in TABLE_COLUMNS or columns != _saved_columns(tablename):
+				logging.info("Row cache %s is for an older schema", self.filename(zipinfo))
+				return None
+		return tables
+
+	def save(self, zipinfo, conn, source_id, recording):
+		"""Saves the rows for next time (but a full disk isn't worth failing the import)"""
+		try:
+			self._save(zipinfo, conn, source_id, recording)
+		except Exception:
+			logging.warning("Couldn't save row cache %s", self.filename(zipinfo), exc_info=True)
+			try:
+				os.unlink(self.filename(zipinfo) + ".tmp")
+			except OSError:
+				pass
+
+	def _save(self, zipinfo, conn, source_id, recording):
+		cache = intern_cache(conn)
+		tables = {}
+		for tablename, rows in recording.items():
+			columns = _saved_columns(tablename)
+			interned = INTERNED_COLUMNS.get(tablename, {})
+			data = []
+			for column, values in zip(TABLE_COLUMNS[tablename], zip(*rows)):
+				if column == "source_id":
+					continue
+				intern_tablename = interned.get(column)
+				if intern_tablename == "atcocode":
+					values = [cache.atcocode_name(value) for value in values]
+				elif intern_tablename is not None:
+					longnames = cache.longnames(intern_tablename, source_id)
+					longnames[None] = None
+					values = [longnames[value] for value in values]
+				data.append(list(values))
+			tables[tablename] = (columns, data)
+
+		os.makedirs(self.directory, exist_ok=True)
+		filename = self.filename(zipinfo)
+		with gzip.open(filename + ".tmp", "wb", compresslevel=3) as f:
+			pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(filename + ".tmp", filename)
+
+	def replay(self, conn, source_id, tables, writer):
+		"""Adds the saved rows to the writer, as if we'd parsed the file"""
+		cache = intern_cache(conn)
+		for tablename in TABLE_COLUMNS:
+			if tablename not in tables:
+				continue
+			_, data = tables[tablename]
+			interned = INTERNED_COLUMNS.get(tablename, {})
+			columns = iter(data)
+			row_columns = []
+			for column in TABLE_COLUMNS[tablename]:
+				if column == "source_id":
+					row_columns.append(None)
+					continue
+				values = next(columns)
+				intern_tablename = interned.get(column)
+				if intern_tablename == "atcocode":
+					values = [cache.atcocode(value) for value in values]
+				elif intern_tablename is not None:
+					values = [
+						cache.interned(intern_tablename, source_id, value) if value is not None else None
+						for value in values]
+				row_columns.append(values)
+
+			row_count = len(data[0]) if data else 0
+			row_columns = [
+				[source_id] * row_count if values is None else values
+				for values in row_columns]
+			for row in zip(*row_columns):
+				writer.add(tablename, row)
+
+
+def _saved_columns(tablename):
+	return tuple(column for column in TABLE_COLUMNS[tablename] if column != "source_id")
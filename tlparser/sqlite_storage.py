@@ -0,0 +1,651 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""Keeps everything in one SQLite file, for small deployments and tests.
+
+	python3 -m tlparser --database sqlite:travelinedata.sqlite --destroy_create_tables --process --matview
+
+SqliteConnection looks enough like a psycopg2 connection for most of
+the importer (it turns %s parameters into ?). The differences are
+dealt with here:
+
+- there are no sequences or COPY, so SqliteInternCache hands out ids
+  itself (only one process can write to the file anyway) and
+  SqliteBulkWriter uses executemany
+
+- there are no geometric types or arrays: refresh_link_frequency()
+  works out link_frequency3 (from scratch, every time) with the hour
+  arrays as json, and an R*Tree index on the bounding box of each link
+  (see link_frequency_in_bbox)
+
+- there's no percentile_disc(), so headways() works out link_headway
+  in python
+
+- foreign keys aren't checked
+
+Only the link frequencies are here: the postcode tables aren't.
+"""
+
+import bisect
+import datetime
+import itertools
+import json
+import logging
+import re
+import sqlite3
+
+from .bulk_writer import BulkWriter, TABLE_COLUMNS
+from .intern_cache import InternCache
+from .link_frequency import BANDS, JOURNEYS
+from .operating_days import days_mask_from_bitmap, parse_date
+
+
+sqlite3.register_adapter(datetime.date, datetime.date.isoformat)
+
+PARAMETER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+HOURS = range(24)
+
+
+def _sqlite_parameters(sql):
+	def replace(match):
+		if match.group(1):
+			return ":" + match.group(1)
+		if match.group(0) == "%s":
+			return "?"
+		return "%"
+	return PARAMETER.sub(replace, sql)
+
+
+def days_mask_for_week(operating_from, operating_days, monday):
+	if operating_from is None or operating_days is None or monday is None:
+		return None
+	return days_mask_from_bitmap(parse_date(operating_from), operating_days, parse_date(monday))
+
+
+class SqliteCursor(object):
+	def __init__(self, cur):
+		self.cur = cur
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.cur.close()
+
+	def __iter__(self):
+		return iter(self.cur)
+
+	def fetchall(self):
+		return self.cur.fetchall()
+
+	@property
+	def rowcount(self):
+		return self.cur.rowcount
+
+	def execute(self, sql, params=None):
+		if params is None:
+			self.cur.execute(sql)
+		else:
+			self.cur.execute(_sqlite_parameters(sql), params)
+
+	def executemany(self, sql, seq_of_params):
+		self.cur.executemany(_sqlite_parameters(sql), seq_of_params)
+
+
+class SqliteConnection(object):
+	dialect = "sqlite"
+
+	def __init__(self, path):
+		self.path = path
+		self.conn = sqlite3.connect(path)
+		self.conn.execute("PRAGMA journal_mode = WAL")
+		self.conn.execute("PRAGMA synchronous = NORMAL")
+		self.conn.create_function("days_mask_for_week", 3, days_mask_for_week, deterministic=True)
+
+	def cursor(self):
+		return SqliteCursor(self.conn.cursor())
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.commit()
+		else:
+			self.rollback()
+
+	def commit(self):
+		self.conn.commit()
+
+	def rollback(self):
+		self.conn.rollback()
+
+	def close(self):
+		self.conn.close()
+
+
+class SqliteInternCache(InternCache):
+	def __init__(self, conn, **kwargs):
+		super().__init__(conn, **kwargs)
+		self.last_ids = {}
+
+	def _allocate_id(self, tablename):
+		if tablename not in self.last_ids:
+			with self.conn.cursor() as cur:
+				cur.execute("""
+					SELECT coalesce(max(%(tablename)s_id), 0)
+					FROM %(tablename)s_intern
+				""" % dict(tablename=tablename))
+				[[self.last_ids[tablename]]] = list(cur)
+		self.last_ids[tablename] += 1
+		return self.last_ids[tablename]
+
+	def _select_or_insert(self, tablename, source_id, longname):
+		self.flush()
+		with self.conn.cursor() as cur:
+			cur.execute("""
+				SELECT %(tablename)s_id
+				FROM %(tablename)s_intern
+				WHERE source_id = %%s
+				AND %(tablename)s = %%s
+			""" % dict(tablename=tablename), (source_id, longname,))
+			rows = list(cur)
+			if rows:
+				[[short_id]] = rows
+				return short_id
+		self.pending[tablename].append((self._allocate_id(tablename), source_id, longname))
+		short_id, _, _ = self.pending[tablename][-1]
+		return short_id
+
+	def flush(self):
+		with self.conn.cursor() as cur:
+			for tablename, rows in self.pending.items():
+				if rows:
+					cur.executemany("""
+						INSERT INTO %(tablename)s_intern(%(tablename)s_id, source_id, %(tablename)s)
+						VALUES (%%s, %%s, %%s)
+					""" % dict(tablename=tablename), rows)
+		self.pending.clear()
+
+	def atcocode_ids(self, atcocodes):
+		return [self.atcocode(atcocode) for atcocode in atcocodes]
+
+
+class SqliteBulkWriter(BulkWriter):
+	def pipeline(self, depth):
+		logging.warning("--pipeline doesn't do anything with sqlite")
+
+	def _write(self, cur, tablename, rows):
+		columns = TABLE_COLUMNS[tablename]
+		cur.executemany("""
+			INSERT INTO %(tablename)s (%(columns)s)
+			VALUES (%(values)s)
+			%(on_conflict)s
+		""" % dict(
+			tablename=tablename,
+			columns=", ".join(columns),
+			values=", ".join("%s" for _ in columns),
+			on_conflict=self.on_conflict.get(tablename, "")), rows)
+		self.rows_written[tablename] += len(rows)
+
+
+def _intern_table(tablename):
+	return """
+		CREATE TABLE IF NOT EXISTS %(tablename)s_intern (
+			%(tablename)s_id INTEGER PRIMARY KEY,
+			source_id INTEGER NOT NULL,
+			%(tablename)s TEXT NOT NULL,
+			UNIQUE (source_id, %(tablename)s));
+		""" % dict(tablename=tablename)
+
+INTERN_TABLES = ["journeypattern", "jpsection", "jptiminglink", "vjcode", "line", "service", "route", "routelink"]
+
+TABLES = {
+	"source": """
+		CREATE TABLE IF NOT EXISTS source(
+			source_id INTEGER PRIMARY KEY,
+			source TEXT UNIQUE,
+			crc32 INTEGER,
+			file_size INTEGER);
+		""",
+	"atcocode_intern": """
+		CREATE TABLE IF NOT EXISTS atcocode_intern(
+			atcocode_id INTEGER PRIMARY KEY,
+			atcocode TEXT UNIQUE);
+		""",
+	"naptan": """
+		CREATE TABLE IF NOT EXISTS naptan(
+			atcocode_id INTEGER PRIMARY KEY,
+			code TEXT UNIQUE,
+			name TEXT,
+			latitude REAL,
+			longitude REAL);
+		""",
+	"stoppoint": """
+		CREATE TABLE IF NOT EXISTS stoppoint(
+			atcocode_id INTEGER PRIMARY KEY,
+			name TEXT,
+			indicator TEXT,
+			locality_name TEXT,
+			locality_qualifier TEXT);
+		""",
+	"routelink": """
+		CREATE TABLE IF NOT EXISTS routelink(
+			source_id INTEGER,
+			routelink_id INTEGER PRIMARY KEY,
+			routesection TEXT,
+			from_stoppoint INTEGER,
+			to_stoppoint INTEGER,
+			direction TEXT);
+		""",
+	"service": """
+		CREATE TABLE IF NOT EXISTS service(
+			source_id INTEGER,
+			service_id INTEGER PRIMARY KEY,
+			privatecode TEXT,
+			mode TEXT,
+			operator_id TEXT,
+			description TEXT);
+		""",
+	"route": """
+		CREATE TABLE IF NOT EXISTS route(
+			source_id INTEGER,
+			route_id INTEGER PRIMARY KEY,
+			privatecode TEXT,
+			routesection TEXT,
+			description TEXT);
+		""",
+	"journeypattern_service": """
+		CREATE TABLE IF NOT EXISTS journeypattern_service(
+			source_id INTEGER,
+			journeypattern_id INTEGER PRIMARY KEY,
+			service_id INTEGER NOT NULL,
+			route_id INTEGER,
+			direction TEXT);
+		""",
+	"journeypattern_service_section": """
+		CREATE TABLE IF NOT EXISTS journeypattern_service_section(
+			source_id INTEGER,
+			jpsection_id INTEGER PRIMARY KEY,
+			journeypattern_id INTEGER,
+			section_sequence INTEGER);
+		""",
+	"jptiminglink": """
+		CREATE TABLE IF NOT EXISTS jptiminglink(
+			source_id INTEGER,
+			jptiminglink_id INTEGER PRIMARY KEY,
+			jpsection_id INTEGER,
+			routelink_id INTEGER,
+			runtime TEXT,
+			from_sequence INTEGER,
+			from_stoppoint INTEGER,
+			to_sequence INTEGER,
+			to_stoppoint INTEGER,
+			runtime_seconds INTEGER);
+		""",
+	"line": """
+		CREATE TABLE IF NOT EXISTS line(
+			source_id INTEGER,
+			line_id INTEGER PRIMARY KEY,
+			servicecode TEXT,
+			line_name TEXT);
+		""",
+	"vehiclejourney": """
+		CREATE TABLE IF NOT EXISTS vehiclejourney(
+			source_id INTEGER NOT NULL,
+			vjcode_id INTEGER PRIMARY KEY,
+			other_vjcode_id INTEGER,
+			journeypattern_id INTEGER,
+			line_id INTEGER NOT NULL,
+			privatecode TEXT,
+			days_mask INTEGER,
+			deptime TEXT,
+			deptime_seconds INTEGER,
+			-- "0" and "1", one for each day from operating_from
+			operating_from TEXT,
+			operating_days TEXT);
+		""",
+	"operator": """
+		CREATE TABLE IF NOT EXISTS operator(
+			source_id INTEGER NOT NULL,
+			operator_id TEXT NOT NULL,
+			shortname TEXT,
+			PRIMARY KEY (source_id, operator_id));
+		""",
+	"dataset_version": """
+		CREATE TABLE IF NOT EXISTS dataset_version(
+			version INTEGER NOT NULL);
+		""",
+	"target_week": """
+		CREATE TABLE IF NOT EXISTS target_week(
+			monday TEXT NOT NULL);
+		""",
+	"link_frequency_dirty_source": """
+		CREATE TABLE IF NOT EXISTS link_frequency_dirty_source(
+			source_id INTEGER PRIMARY KEY);
+		""",
+	"mask_to_weekday": """
+		CREATE TABLE IF NOT EXISTS mask_to_weekday(
+			mask INTEGER UNIQUE,
+			weekday TEXT UNIQUE);
+		""",
+	"vehiclejourney_per_hour": """
+		CREATE TABLE IF NOT EXISTS vehiclejourney_per_hour(
+			journeypattern_id INTEGER,
+			line_id INTEGER,
+			days_mask INTEGER,
+			%s);
+		""" % (", ".join("hour_%d INTEGER" % (hour,) for hour in HOURS),),
+	"link_frequency3": """
+		CREATE TABLE IF NOT EXISTS link_frequency3(
+			link_id INTEGER PRIMARY KEY,
+			from_stoppoint INTEGER,
+			to_stoppoint INTEGER,
+			weekday TEXT,
+			from_lat REAL,
+			from_lng REAL,
+			to_lat REAL,
+			to_lng REAL,
+			-- json arrays
+			hour_array_total TEXT,
+			hour_array_best_service TEXT,
+			service_ids TEXT,
+			count_bus_per_week INTEGER,
+			min_runtime INTEGER,
+			max_runtime INTEGER);
+		""",
+	"link_headway": """
+		CREATE TABLE IF NOT EXISTS link_headway(
+			from_stoppoint INTEGER,
+			to_stoppoint INTEGER,
+			weekday TEXT,
+			band TEXT,
+			departures INTEGER,
+			first_departure INTEGER,
+			last_departure INTEGER,
+			max_gap INTEGER,
+			median_gap INTEGER,
+			PRIMARY KEY (from_stoppoint, to_stoppoint, weekday, band));
+		""",
+	"link_frequency3_bbox": """
+		CREATE VIRTUAL TABLE IF NOT EXISTS link_frequency3_bbox USING rtree(
+			link_id,
+			min_lat, max_lat,
+			min_lng, max_lng);
+		""",
+}
+for _tablename in INTERN_TABLES:
+	TABLES[_tablename + "_intern"] = _intern_table(_tablename)
+
+INDEXES = [
+	"CREATE INDEX IF NOT EXISTS idx_timing_section ON jptiminglink(jpsection_id)",
+	"CREATE INDEX IF NOT EXISTS idx_section_journeypattern ON journeypattern_service_section(journeypattern_id)",
+	"CREATE INDEX IF NOT EXISTS idx_vehiclejourney_source ON vehiclejourney(source_id)",
+	"CREATE INDEX IF NOT EXISTS idx_vehiclejourney_per_hour_id ON vehiclejourney_per_hour(journeypattern_id)",
+	"CREATE INDEX IF NOT EXISTS idx_link_frequency3_weekday ON link_frequency3(weekday, link_id)",
+]
+
+
+def create_tables(conn, drop=True):
+	with conn.cursor() as cur:
+		for tablename, create in TABLES.items():
+			if drop:
+				cur.execute("DROP TABLE IF EXISTS %s" % (tablename,))
+			cur.execute(create)
+		for create in INDEXES:
+			cur.execute(create)
+
+		# (files made by older versions)
+		cur.execute("PRAGMA table_info(jptiminglink)")
+		if "runtime_seconds" not in [column for _, column, *_ in cur]:
+			from .traveline_xml_parser import duration_to_seconds
+			conn.conn.create_function("duration_to_seconds", 1, duration_to_seconds)
+			cur.execute("ALTER TABLE jptiminglink ADD COLUMN runtime_seconds INTEGER")
+			cur.execute("UPDATE jptiminglink SET runtime_seconds = duration_to_seconds(runtime)")
+		cur.execute("PRAGMA table_info(journeypattern_service_section)")
+		if "section_sequence" not in [column for _, column, *_ in cur]:
+			cur.execute("ALTER TABLE journeypattern_service_section ADD COLUMN section_sequence INTEGER")
+		cur.execute("PRAGMA table_info(operator)")
+		if [column for _, column, _, _, _, pk in cur if pk] == ["operator_id"]:
+			# (see table_definitions.upgrade_tables)
+			cur.execute("ALTER TABLE operator RENAME TO operator_shared")
+			cur.execute(TABLES["operator"])
+			cur.execute("""
+				INSERT INTO operator (source_id, operator_id, shortname)
+				SELECT source_id, operator_id, shortname
+				FROM operator_shared
+				WHERE source_id IS NOT NULL
+			""")
+			cur.execute("DROP TABLE operator_shared")
+
+		cur.execute("""
+			INSERT OR IGNORE INTO mask_to_weekday (mask, weekday)
+			VALUES (1, 'M'), (2, 'T'), (4, 'W'), (8, 'H'), (16, 'F'), (32, 'S'), (64, 'N');
+		""")
+
+
+def refresh_link_frequency(conn):
+	"""Like link_frequency.refresh(full=True)"""
+	hour_columns = ", ".join("hour_%d" % (hour,) for hour in HOURS)
+	with conn.cursor() as cur:
+		logging.info("Calculating vehiclejourney_per_hour...")
+		cur.execute("DELETE FROM vehiclejourney_per_hour")
+		cur.execute("""
+			INSERT INTO vehiclejourney_per_hour (journeypattern_id, line_id, days_mask, %(hour_columns)s)
+			WITH vehiclejourney_fix_jpid AS (
+				SELECT
+					vj.source_id,
+					vj.vjcode_id,
+					vj.other_vjcode_id,
+					coalesce(vj.journeypattern_id, other.journeypattern_id) AS journeypattern_id,
+					vj.line_id,
+					coalesce(
+						days_mask_for_week(vj.operating_from, vj.operating_days, (SELECT monday FROM target_week)),
+						vj.days_mask) AS days_mask,
+					vj.deptime_seconds
+				FROM vehiclejourney vj
+				LEFT JOIN vehiclejourney other ON vj.other_vjcode_id = other.vjcode_id
+			),
+			vehiclejourney_dedup AS (
+				-- see link_frequency.py
+				SELECT DISTINCT source_id, vjcode_id, other_vjcode_id, journeypattern_id, line_id, days_mask, deptime_seconds
+				FROM vehiclejourney_fix_jpid
+			)
+			SELECT journeypattern_id, line_id, days_mask, %(hour_sums)s
+			FROM vehiclejourney_dedup
+			GROUP BY 1, 2, 3
+		""" % dict(
+			hour_columns=hour_columns,
+			hour_sums=", ".join("sum(CASE WHEN deptime_seconds / 3600 = %d THEN 1 ELSE 0 END)" % (hour,) for hour in HOURS)))
+
+		logging.info("Calculating link_frequency3...")
+		cur.execute("DELETE FROM link_frequency3")
+		cur.execute("DELETE FROM link_frequency3_bbox")
+		cur.execute("""
+			INSERT INTO link_frequency3 (
+				from_stoppoint, to_stoppoint, weekday,
+				from_lat, from_lng, to_lat, to_lng,
+				hour_array_total, hour_array_best_service, service_ids,
+				count_bus_per_week, min_runtime, max_runtime)
+			WITH stops_and_frequency_per_line AS (
+				SELECT
+					timing.from_stoppoint,
+					timing.to_stoppoint,
+					jp_service.service_id,
+					weekday.weekday,
+					%(hour_sums)s,
+					min(timing.runtime_seconds) AS min_runtime,
+					max(timing.runtime_seconds) AS max_runtime
+				FROM jptiminglink timing
+				JOIN journeypattern_service_section section ON section.jpsection_id = timing.jpsection_id
+				JOIN vehiclejourney_per_hour vjph ON vjph.journeypattern_id = section.journeypattern_id
+				LEFT JOIN journeypattern_service jp_service ON jp_service.journeypattern_id = section.journeypattern_id
+				JOIN mask_to_weekday weekday ON weekday.mask & vjph.days_mask > 0
+				GROUP BY 1, 2, 3, 4
+			),
+			stops_and_frequency AS (
+				SELECT
+					from_stoppoint,
+					to_stoppoint,
+					weekday,
+					json_array(%(hour_totals)s) AS hour_array_total,
+					json_array(%(hour_bests)s) AS hour_array_best_service,
+					%(count_bus)s AS count_bus_per_week,
+					'[' || group_concat(DISTINCT service_id) || ']' AS service_ids,
+					min(min_runtime) AS min_runtime,
+					max(max_runtime) AS max_runtime
+				FROM stops_and_frequency_per_line
+				GROUP BY 1, 2, 3
+			)
+			SELECT
+				stops_and_frequency.from_stoppoint,
+				stops_and_frequency.to_stoppoint,
+				stops_and_frequency.weekday,
+				from_point.latitude,
+				from_point.longitude,
+				to_point.latitude,
+				to_point.longitude,
+				hour_array_total,
+				hour_array_best_service,
+				service_ids,
+				count_bus_per_week,
+				min_runtime,
+				max_runtime
+			FROM stops_and_frequency
+			JOIN naptan from_point ON stops_and_frequency.from_stoppoint = from_point.atcocode_id
+			JOIN naptan to_point ON stops_and_frequency.to_stoppoint = to_point.atcocode_id
+		""" % dict(
+			hour_sums=", ".join("sum(vjph.hour_%d) AS hour_%d" % (hour, hour) for hour in HOURS),
+			hour_totals=", ".join("sum(hour_%d)" % (hour,) for hour in HOURS),
+			hour_bests=", ".join("max(hour_%d)" % (hour,) for hour in HOURS),
+			count_bus=" + ".join("sum(hour_%d)" % (hour,) for hour in HOURS)))
+
+		cur.execute("""
+			INSERT INTO link_frequency3_bbox (link_id, min_lat, max_lat, min_lng, max_lng)
+			SELECT link_id, min(from_lat, to_lat), max(from_lat, to_lat), min(from_lng, to_lng), max(from_lng, to_lng)
+			FROM link_frequency3
+		""")
+		logging.info("Calculated link_frequency3 (%d rows)", cur.rowcount)
+
+		logging.info("Calculating link_headway...")
+		cur.execute("DELETE FROM link_headway")
+		cur.execute("""
+			%(journeys)s,
+			timing_offset AS (
+				SELECT
+					section.journeypattern_id,
+					timing.from_stoppoint,
+					timing.to_stoppoint,
+					coalesce(sum(timing.runtime_seconds) OVER (
+						PARTITION BY section.journeypattern_id
+						ORDER BY section.section_sequence, section.jpsection_id, timing.from_sequence, timing.jptiminglink_id
+						ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS offset_seconds
+				FROM jptiminglink timing
+				JOIN journeypattern_service_section section ON section.jpsection_id = timing.jpsection_id
+			)
+			SELECT DISTINCT
+				timing.from_stoppoint,
+				timing.to_stoppoint,
+				weekday.weekday,
+				vj.deptime_seconds + timing.offset_seconds AS departure
+			FROM vehiclejourney_dedup vj
+			JOIN timing_offset timing ON timing.journeypattern_id = vj.journeypattern_id
+			JOIN mask_to_weekday weekday ON weekday.mask & vj.days_mask > 0
+			WHERE vj.deptime_seconds IS NOT NULL
+			ORDER BY 1, 2, 3, 4
+		""" % dict(journeys=JOURNEYS % dict(where="TRUE")))
+		rows = list(headways(cur))
+		cur.executemany("""
+			INSERT INTO link_headway (
+				from_stoppoint, to_stoppoint, weekday, band,
+				departures, first_departure, last_departure, max_gap, median_gap)
+			VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+		""", rows)
+		logging.info("Calculated link_headway (%d rows)", len(rows))
+		cur.execute("DELETE FROM link_frequency_dirty_source")
+
+
+def headways(departures):
+	"""Like link_frequency._insert_link_headway, from sorted (from_stoppoint, to_stoppoint, weekday, departure)"""
+	starts = [start * 3600 for _, start, _ in BANDS]
+	ends = [end * 3600 for _, _, end in BANDS]
+
+	def band(row):
+		departure = row[3]
+		index = bisect.bisect_right(starts, departure) - 1
+		if index < 0 or departure >= ends[index]:
+			return None
+		return BANDS[index][0]
+
+	for (from_stoppoint, to_stoppoint, weekday, name), rows in itertools.groupby(
+			departures, key=lambda row: row[:3] + (band(row),)):
+		if name is None:
+			continue
+		times = [departure for *_, departure in rows]
+		gaps = sorted(later - earlier for earlier, later in zip(times, times[1:]))
+		yield (
+			from_stoppoint, to_stoppoint, weekday, name,
+			len(times), times[0], times[-1],
+			# percentile_disc(0.5)
+			gaps[-1] if gaps else None,
+			gaps[(len(gaps) - 1) // 2] if gaps else None)
+
+
+def link_frequency_in_bbox(conn, minlat, minlng, maxlat, maxlng, weekday, limit):
+	"""The rows for geojson_frequency_v34 in server.py
+
+	The `limit` links with the most buses, least frequent first.
+	"""
+	with conn.cursor() as cur:
+		cur.execute("""
+			SELECT * FROM (
+				SELECT
+					link.from_stoppoint,
+					link.to_stoppoint,
+					link.from_lat,
+					link.from_lng,
+					link.to_lat,
+					link.to_lng,
+					link.weekday,
+					link.min_runtime,
+					link.max_runtime,
+					link.hour_array_total,
+					link.hour_array_best_service,
+					link.count_bus_per_week,
+					(
+						SELECT json_group_object(headway.band, json_object(
+							'departures', headway.departures,
+							'first_departure', headway.first_departure,
+							'last_departure', headway.last_departure,
+							'max_gap', headway.max_gap,
+							'median_gap', headway.median_gap))
+						FROM link_headway headway
+						WHERE headway.from_stoppoint = link.from_stoppoint
+						AND headway.to_stoppoint = link.to_stoppoint
+						AND headway.weekday = link.weekday
+					) AS headways
+				FROM link_frequency3_bbox bbox
+				JOIN link_frequency3 link ON link.link_id = bbox.link_id
+				WHERE bbox.max_lat >= %(minlat)s AND bbox.min_lat <= %(maxlat)s
+				AND bbox.max_lng >= %(minlng)s AND bbox.min_lng <= %(maxlng)s
+				AND link.weekday = %(weekday)s
+				ORDER BY link.count_bus_per_week DESC
+				LIMIT %(limit)s
+			)
+			ORDER BY count_bus_per_week ASC
+		""", dict(
+			minlat=float(minlat), minlng=float(minlng),
+			maxlat=float(maxlat), maxlng=float(maxlng),
+			weekday=weekday, limit=int(limit)))
+		return [
+			(
+				from_stoppoint, to_stoppoint,
+				from_lat, from_lng, to_lat, to_lng,
+				weekday,
+				# length(lseg) in postgres
+				((to_lat - from_lat) ** 2 + (to_lng - from_lng) ** 2) ** 0.5,
+				min_runtime, max_runtime,
+				json.loads(hour_array_total), json.loads(hour_array_best_service),
+				json.loads(headways))
+			for from_stoppoint, to_stoppoint, from_lat, from_lng, to_lat, to_lng, weekday, min_runtime, max_runtime, hour_array_total, hour_array_best_service, _, headways in cur]
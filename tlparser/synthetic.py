@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+# encoding: utf8
+
+"""Makes up TransXChange zip files, for benchmarks and tests.
+
+Each xml file has one operator and `services` services. Each service
+has `patterns` journey patterns (with a route, and a route section and
+a journey pattern section of `links` links each) and `journeys`
+vehicle journeys for each pattern. The stops are picked from a pool of
+`stops` atcocodes, which is shared between all the files, as happens
+in the real data.
+
+Operating profiles are mostly Monday to Friday, with some Saturday and
+Sunday services, and the sort of DaysOfNonOperation you find in the
+real data: bank holidays, and the odd run of excluded weeks.
+
+	python3 -m tlparser.synthetic --files 20 --journeys 200 SYN.zip
+"""
+
+import argparse
+import collections
+import datetime
+import random
+import zipfile
+
+
+HEADER = (
+	'<?xml version="1.0" encoding="utf-8"?>\n'
+	'<TransXChange xmlns="http://www.transxchange.org.uk/" SchemaVersion="2.1" FileName="%(filename)s">\n')
+
+# (days of week, weight)
+REGULAR_DAYS = [
+	(("MondayToFriday",), 50),
+	(("Saturday",), 20),
+	(("Sunday",), 15),
+	(("MondayToSaturday",), 10),
+	(("MondayToSunday",), 3),
+	(("Monday", "Wednesday", "Friday"), 2),
+]
+
+BANK_HOLIDAYS = [
+	datetime.date(2018, 3, 30),
+	datetime.date(2018, 4, 2),
+	datetime.date(2018, 5, 7),
+	datetime.date(2018, 5, 28),
+	datetime.date(2018, 8, 27),
+	datetime.date(2018, 12, 25),
+	datetime.date(2018, 12, 26),
+]
+
+
+def atcocode(number):
+	return "9990SYN%06d" % (number,)
+
+
+class _XmlFile(object):
+	"""Writes elements, and counts them"""
+
+	def __init__(self, out, written):
+		self.out = out
+		self.written = written
+
+	def write(self, text):
+		self.out.write(text.encode("utf8"))
+
+	def element(self, tagname, text):
+		self.write(text)
+		self.written[tagname] += 1
+
+
+def operating_profile(rng):
+	days = rng.choices(
+		[days for days, _ in REGULAR_DAYS],
+		weights=[weight for _, weight in REGULAR_DAYS])[0]
+	regular = "".join("<%s />" % (day,) for day in days)
+
+	excluded = []
+	if rng.random() < 0.7:
+		excluded.extend((day, day) for day in BANK_HOLIDAYS)
+	if rng.random() < 0.1:
+		# a timetable change: this one stops running for a few weeks
+		start = datetime.date(2018, 1, 1) + datetime.timedelta(days=rng.randrange(300))
+		for week in range(rng.randrange(1, 8)):
+			day = start + datetime.timedelta(days=7 * week)
+			excluded.append((day, day))
+	if rng.random() < 0.05:
+		start = datetime.date(2018, 7, 20)
+		excluded.append((start, start + datetime.timedelta(days=rng.randrange(14, 45))))
+
+	special = ""
+	if excluded:
+		special = (
+			"<SpecialDaysOperation><DaysOfNonOperation>"
+			+ "".join(
+				"<DateRange><StartDate>%s</StartDate><EndDate>%s</EndDate></DateRange>" % (start.isoformat(), end.isoformat())
+				for start, end in excluded)
+			+ "</DaysOfNonOperation></SpecialDaysOperation>")
+
+	return (
+		"<OperatingProfile><RegularDayType><DaysOfWeek>%s</DaysOfWeek></RegularDayType>%s</OperatingProfile>"
+		% (regular, special))
+
+
+def runtime(rng):
+	seconds = rng.randrange(30, 600)
+	if seconds % 60 == 0:
+		return "PT%dM" % (seconds // 60,)
+	if seconds < 60:
+		return "PT%dS" % (seconds,)
+	return "PT%dM%dS" % (seconds // 60, seconds % 60)
+
+
+def write_file(out, rng, file_number, services, patterns, links, journeys, stops):
+	"""Writes one TransXChange file. Returns a Counter of elements written"""
+	written = collections.Counter()
+	xml = _XmlFile(out, written)
+	prefix = "%d" % (file_number,)
+
+	# each journey pattern goes along `links` stops in a row
+	paths = {}
+	for service in range(services):
+		for pattern in range(patterns):
+			start = rng.randrange(stops)
+			paths[service, pattern] = [
+				atcocode((start + stop) % stops)
+				for stop in range(links + 1)]
+
+	xml.write(HEADER % dict(filename="synthetic_%s.xml" % (prefix,)))
+
+	xml.write("<StopPoints>")
+	for code in sorted({code for path in paths.values() for code in path}):
+		xml.element("AnnotatedStopPointRef", (
+			"<AnnotatedStopPointRef><StopPointRef>%(code)s</StopPointRef>"
+			"<CommonName>Stop %(code)s</CommonName><Indicator>opp</Indicator>"
+			"<LocalityName>Synthetic</LocalityName><LocalityQualifier>Town</LocalityQualifier>"
+			"</AnnotatedStopPointRef>") % dict(code=code))
+	xml.write("</StopPoints>")
+
+	xml.write("<RouteSections>")
+	for (service, pattern), path in paths.items():
+		name = "%s-%d-%d" % (prefix, service, pattern)
+		xml.element("RouteSection", (
+			'<RouteSection id="RS_%s">' % (name,)
+			+ "".join(
+				'<RouteLink id="RL_%s-%d"><From><StopPointRef>%s</StopPointRef></From>'
+				'<To><StopPointRef>%s</StopPointRef></To><Direction>outbound</Direction></RouteLink>'
+				% (name, link, path[link], path[link + 1])
+				for link in range(links))
+			+ "</RouteSection>"))
+	xml.write("</RouteSections>")
+
+	xml.write("<Routes>")
+	for service, pattern in paths:
+		name = "%s-%d-%d" % (prefix, service, pattern)
+		xml.element("Route", (
+			'<Route id="R_%(name)s"><PrivateCode>%(name)s</PrivateCode>'
+			'<Description>Route %(name)s</Description><RouteSectionRef>RS_%(name)s</RouteSectionRef></Route>')
+			% dict(name=name))
+	xml.write("</Routes>")
+
+	xml.write("<JourneyPatternSections>")
+	for (service, pattern), path in paths.items():
+		name = "%s-%d-%d" % (prefix, service, pattern)
+		xml.element("JourneyPatternSection", (
+			'<JourneyPatternSection id="JPS_%s">' % (name,)
+			+ "".join(
+				'<JourneyPatternTimingLink id="JPTL_%s-%d">'
+				'<From SequenceNumber="%d"><Activity>pickUp</Activity><StopPointRef>%s</StopPointRef><TimingStatus>PTP</TimingStatus></From>'
+				'<To SequenceNumber="%d"><Activity>pickUpAndSetDown</Activity><StopPointRef>%s</StopPointRef><TimingStatus>OTH</TimingStatus></To>'
+				'<RouteLinkRef>RL_%s-%d</RouteLinkRef><RunTime>%s</RunTime></JourneyPatternTimingLink>'
+				% (name, link, link + 1, path[link], link + 2, path[link + 1], name, link, runtime(rng))
+				for link in range(links))
+			+ "</JourneyPatternSection>"))
+	xml.write("</JourneyPatternSections>")
+
+	xml.write("<Operators>")
+	xml.element("Operator", (
+		'<Operator id="O_%(prefix)s"><OperatorCode>SYN%(prefix)s</OperatorCode>'
+		'<OperatorShortName>Synthetic %(prefix)s</OperatorShortName></Operator>')
+		% dict(prefix=prefix))
+	xml.write("</Operators>")
+
+	xml.write("<Services>")
+	for service in range(services):
+		name = "%s-%d" % (prefix, service)
+		xml.element("Service", (
+			"<Service><ServiceCode>S_%(name)s</ServiceCode><PrivateCode>%(name)s</PrivateCode>"
+			'<Lines><Line id="L_%(name)s"><LineName>%(service)d</LineName></Line></Lines>'
+			"<OperatingPeriod><StartDate>2018-01-01</StartDate></OperatingPeriod>"
+			"<RegisteredOperatorRef>O_%(prefix)s</RegisteredOperatorRef><Mode>bus</Mode>"
+			"<Description>Synthetic service %(name)s</Description><StandardService>"
+			"<Origin>Here</Origin><Destination>There</Destination>"
+			% dict(name=name, prefix=prefix, service=service)
+			+ "".join(
+				'<JourneyPattern id="JP_%(name)s-%(pattern)d"><Direction>outbound</Direction>'
+				"<RouteRef>R_%(name)s-%(pattern)d</RouteRef>"
+				"<JourneyPatternSectionRefs>JPS_%(name)s-%(pattern)d</JourneyPatternSectionRefs></JourneyPattern>"
+				% dict(name=name, pattern=pattern)
+				for pattern in range(patterns))
+			+ "</StandardService></Service>"))
+	xml.write("</Services>")
+
+	xml.write("<VehicleJourneys>")
+	for service in range(services):
+		name = "%s-%d" % (prefix, service)
+		for pattern in range(patterns):
+			for journey in range(journeys):
+				departure = rng.randrange(5 * 3600, 24 * 3600, 60)
+				xml.element("VehicleJourney", (
+					"<VehicleJourney><PrivateCode>%(name)s-%(pattern)d-%(journey)d</PrivateCode>%(profile)s"
+					"<VehicleJourneyCode>VJ_%(name)s-%(pattern)d-%(journey)d</VehicleJourneyCode>"
+					"<ServiceRef>S_%(name)s</ServiceRef><LineRef>L_%(name)s</LineRef>"
+					"<JourneyPatternRef>JP_%(name)s-%(pattern)d</JourneyPatternRef>"
+					"<DepartureTime>%(hour)02d:%(minute)02d:00</DepartureTime></VehicleJourney>")
+					% dict(
+						name=name, pattern=pattern, journey=journey, profile=operating_profile(rng),
+						hour=departure // 3600, minute=departure // 60 % 60))
+	xml.write("</VehicleJourneys>")
+
+	xml.write("</TransXChange>\n")
+	return written
+
+
+def write_zip(zip_filename, files=1, services=10, patterns=2, links=20, journeys=50, stops=1000, seed=0):
+	"""Writes a zip of `files` xml files. Returns a Counter of elements written"""
+	rng = random.Random(seed)
+	written = collections.Counter()
+	with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as container:
+		for file_number in range(files):
+			with container.open("synthetic_%d.xml" % (file_number,), "w", force_zip64=True) as out:
+				written.update(write_file(out, rng, file_number, services, patterns, links, journeys, stops))
+	return written
+
+
+def add_size_arguments(parser):
+	parser.add_argument('--files', help='xml files in the zip', type=int, default=1)
+	parser.add_argument('--services', help='services in each file', type=int, default=10)
+	parser.add_argument('--patterns', help='journey patterns for each service', type=int, default=2)
+	parser.add_argument('--links', help='timing links in each journey pattern', type=int, default=20)
+	parser.add_argument('--journeys', help='vehicle journeys for each journey pattern', type=int, default=50)
+	parser.add_argument('--stops', help='stops to choose from', type=int, default=1000)
+	parser.add_argument('--seed', type=int, default=0)
+
+
+def write_zip_from_args(zip_filename, args):
+	return write_zip(
+		zip_filename, files=args.files, services=args.services, patterns=args.patterns,
+		links=args.links, journeys=args.journeys, stops=args.stops, seed=args.seed)
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='Make up TransXChange data')
+	add_size_arguments(parser)
+	parser.add_argument('zip_filename')
+	args = parser.parse_args()
+	written = write_zip_from_args(args.zip_filename, args)
+	for tagname, count in sorted(written.items()):
+		print("%-24s %8d" % (tagname, count))
+
+
+if __name__ == '__main__':
+	main()
@@ -3,6 +3,12 @@
 
 import logging
 
+from . import link_corridor
+from . import link_frequency
+from . import sqlite_storage
+from .database import is_sqlite
+from .intern_cache import intern_cache
+
 
 def _table_command_intern(tablename):
 	"""
@@ -35,13 +41,59 @@ def _table_command_intern(tablename):
 			UNIQUE (source_id, %(tablename)s));
 		""" % dict(tablename=tablename))
 
+# filled in by --profile (no foreign key on source_id: if the file
+# failed, the source_id was rolled back)
+SOURCE_STATS_TABLE = """
+	CREATE TABLE IF NOT EXISTS source_stats(
+		run_started TIMESTAMP NOT NULL,
+		source TEXT NOT NULL,
+		source_id INT,
+		error BOOLEAN NOT NULL,
+		wall_time DOUBLE PRECISION,
+		handler_seconds JSONB,
+		handler_elements JSONB,
+		rows_written JSONB,
+		peak_rss_kb BIGINT);
+	"""
+
+# used by --bulk-load (see bulk_load.py)
+BULK_LOAD_SAVED_TABLE = """
+	CREATE TABLE IF NOT EXISTS bulk_load_saved(
+		kind TEXT NOT NULL,
+		name TEXT NOT NULL,
+		tablename TEXT NOT NULL,
+		definition TEXT NOT NULL,
+		-- for foreign keys
+		column_name TEXT,
+		ref_tablename TEXT,
+		ref_column_name TEXT);
+	"""
+# bumped by refresh_materialized_views, so the server knows when the
+# responses it's kept (see response_cache.py) are out of date
+DATASET_VERSION_TABLE = """
+	CREATE TABLE IF NOT EXISTS dataset_version(
+		version INT NOT NULL);
+	"""
+
+BULK_LOAD_REJECTS_TABLE = """
+	CREATE TABLE IF NOT EXISTS bulk_load_rejects(
+		rejected_at TIMESTAMP NOT NULL DEFAULT now(),
+		constraint_name TEXT NOT NULL,
+		tablename TEXT NOT NULL,
+		row_data JSONB NOT NULL);
+	"""
+
 TABLE_COMMANDS = [
 	("""
 		DROP TABLE IF EXISTS source;
 		""", """
 		CREATE TABLE source(
 			source_id SERIAL PRIMARY KEY,
-			source TEXT UNIQUE)
+			source TEXT UNIQUE,
+			-- from the zip file's central directory, so we can
+			-- tell when a file has changed
+			crc32 BIGINT,
+			file_size BIGINT)
 		"""),
 
 	_table_command_intern("journeypattern"),
@@ -87,7 +139,7 @@ TABLE_COMMANDS = [
 		""", """
 		CREATE TABLE routelink(
 			source_id INT REFERENCES source(source_id),
-			routelink_id INT PRIMARY KEY REFERENCES routelink_intern(routelink_id),
+			routelink_id INT PRIMARY KEY REFERENCES routelink_intern(routelink_id) DEFERRABLE,
 			routesection TEXT,
 			from_stoppoint INT REFERENCES stoppoint(atcocode_id) DEFERRABLE,
 			to_stoppoint INT REFERENCES stoppoint(atcocode_id) DEFERRABLE,
@@ -98,7 +150,7 @@ TABLE_COMMANDS = [
 		""", """
 		CREATE TABLE service(
 			source_id INT REFERENCES source(source_id),
-			service_id INT PRIMARY KEY REFERENCES service_intern(service_id),
+			service_id INT PRIMARY KEY REFERENCES service_intern(service_id) DEFERRABLE,
 			privatecode TEXT,
 			mode TEXT,
 			operator_id TEXT,
@@ -109,7 +161,7 @@ TABLE_COMMANDS = [
 		""", """
 		CREATE TABLE route(
 			source_id INT REFERENCES source(source_id),
-			route_id INT PRIMARY KEY REFERENCES route_intern(route_id),
+			route_id INT PRIMARY KEY REFERENCES route_intern(route_id) DEFERRABLE,
 			privatecode TEXT,
 			routesection TEXT,
 			description TEXT);
@@ -119,7 +171,7 @@ TABLE_COMMANDS = [
 		""", """
 		CREATE TABLE journeypattern_service(
 			source_id INT REFERENCES source(source_id),
-			journeypattern_id INT PRIMARY KEY REFERENCES journeypattern_intern(journeypattern_id),
+			journeypattern_id INT PRIMARY KEY REFERENCES journeypattern_intern(journeypattern_id) DEFERRABLE,
 			service_id INT NOT NULL REFERENCES service(service_id) DEFERRABLE,
 			route_id INT REFERENCES route(route_id) DEFERRABLE,
 			direction TEXT);
@@ -129,29 +181,33 @@ TABLE_COMMANDS = [
 		""", """
 		CREATE TABLE journeypattern_service_section(
 			source_id INT REFERENCES source(source_id),
-			jpsection_id INT PRIMARY KEY REFERENCES jpsection_intern(jpsection_id),
-			journeypattern_id INT REFERENCES journeypattern_service(journeypattern_id) DEFERRABLE)
+			jpsection_id INT PRIMARY KEY REFERENCES jpsection_intern(jpsection_id) DEFERRABLE,
+			journeypattern_id INT REFERENCES journeypattern_service(journeypattern_id) DEFERRABLE,
+			-- where the section comes in the journeypattern, from 0
+			section_sequence INT)
 		"""),
 	("""
 		DROP TABLE IF EXISTS jptiminglink CASCADE;
 		""", """
 		CREATE TABLE jptiminglink(
 			source_id INT REFERENCES source(source_id),
-			jptiminglink_id INT PRIMARY KEY REFERENCES jptiminglink_intern(jptiminglink_id),
+			jptiminglink_id INT PRIMARY KEY REFERENCES jptiminglink_intern(jptiminglink_id) DEFERRABLE,
 			jpsection_id INT REFERENCES journeypattern_service_section(jpsection_id) DEFERRABLE,
 			routelink_id INT REFERENCES routelink(routelink_id) DEFERRABLE,
 			runtime TEXT,
 			from_sequence INT,
 			from_stoppoint INT REFERENCES stoppoint(atcocode_id),
 			to_sequence INT,
-			to_stoppoint INT REFERENCES stoppoint(atcocode_id));
+			to_stoppoint INT REFERENCES stoppoint(atcocode_id),
+			-- runtime, worked out when importing
+			runtime_seconds INT);
 		"""),
 	("""
 		DROP TABLE IF EXISTS line CASCADE;
 		""", """
 		CREATE TABLE line(
 			source_id INT REFERENCES source(source_id),
-			line_id INT PRIMARY KEY REFERENCES line_intern(line_id),
+			line_id INT PRIMARY KEY REFERENCES line_intern(line_id) DEFERRABLE,
 			servicecode TEXT,
 			line_name TEXT);
 		"""),
@@ -160,22 +216,48 @@ TABLE_COMMANDS = [
 		""", """
 		CREATE TABLE vehiclejourney(
 			source_id INT NOT NULL REFERENCES source(source_id),
-			vjcode_id INT PRIMARY KEY REFERENCES vjcode_intern(vjcode_id),
+			vjcode_id INT PRIMARY KEY REFERENCES vjcode_intern(vjcode_id) DEFERRABLE,
 			other_vjcode_id INT REFERENCES vehiclejourney(vjcode_id) DEFERRABLE,
 			journeypattern_id INT REFERENCES journeypattern_service(journeypattern_id) DEFERRABLE,
 			line_id INT NOT NULL REFERENCES line(line_id) DEFERRABLE,
 			privatecode TEXT,
+			-- only filled in if --target-week was given when importing
 			days_mask INT,
 			deptime TEXT,
-			deptime_seconds INT);
+			deptime_seconds INT,
+			-- one bit per day from operating_from: 1 if it runs that day
+			operating_from DATE,
+			operating_days BIT VARYING);
 		"""),
 	("""
 		DROP TABLE IF EXISTS operator CASCADE;
 		""", """
+		-- each file has its own, as they're deleted along with the file
 		CREATE TABLE operator(
-			source_id INT REFERENCES source(source_id),
-			operator_id TEXT PRIMARY KEY,
-			shortname TEXT);
+			source_id INT NOT NULL REFERENCES source(source_id),
+			operator_id TEXT NOT NULL,
+			shortname TEXT,
+			PRIMARY KEY (source_id, operator_id));
+		"""),
+	("""
+		DROP TABLE IF EXISTS source_stats;
+		""", SOURCE_STATS_TABLE),
+	("""
+		DROP TABLE IF EXISTS bulk_load_saved;
+		""", BULK_LOAD_SAVED_TABLE),
+	("""
+		DROP TABLE IF EXISTS bulk_load_rejects;
+		""", BULK_LOAD_REJECTS_TABLE),
+	("""
+		DROP TABLE IF EXISTS dataset_version;
+		""", DATASET_VERSION_TABLE),
+	("""
+		DROP TABLE IF EXISTS target_week;
+		""", """
+		-- the week the materialized views are about: one row, or none
+		-- to use vehiclejourney.days_mask
+		CREATE TABLE target_week(
+			monday DATE NOT NULL);
 		"""),
 	("""
 		DROP TABLE IF EXISTS oscodepointdata;
@@ -186,8 +268,32 @@ TABLE_COMMANDS = [
 			location point NOT NULL);
 		""")]
 
+# Everything which hangs off a source_id, in the order it can be deleted
+SOURCE_TABLES = [
+	"vehiclejourney",
+	"jptiminglink",
+	"journeypattern_service_section",
+	"journeypattern_service",
+	"line",
+	"route",
+	"service",
+	"routelink",
+	"operator",
+	"journeypattern_intern",
+	"jpsection_intern",
+	"jptiminglink_intern",
+	"vjcode_intern",
+	"line_intern",
+	"service_intern",
+	"route_intern",
+	"routelink_intern",
+]
+
 
 def create_tables(conn):
+	if is_sqlite(conn):
+		sqlite_storage.create_tables(conn)
+		return
 	with conn.cursor() as cur:
 		for drop, _ in reversed(TABLE_COMMANDS):
 			logging.info("sql %s", drop)
@@ -214,344 +320,180 @@ def create_tables(conn):
 			CREATE INDEX idx_timing_section ON jptiminglink(jpsection_id);
 		""")
 
-def drop_materialized_views(conn):
+def upgrade_tables(conn):
+	"""Changes to tables made by older versions of create_tables"""
+	if is_sqlite(conn):
+		sqlite_storage.create_tables(conn, drop=False)
+		return
 	with conn.cursor() as cur:
 		cur.execute("""
-			DROP MATERIALIZED VIEW IF EXISTS mv_vehiclejourney_per_hour;
+			ALTER TABLE source
+			ADD COLUMN IF NOT EXISTS crc32 BIGINT,
+			ADD COLUMN IF NOT EXISTS file_size BIGINT;
+		""")
+		cur.execute("""
+			ALTER TABLE vehiclejourney
+			ADD COLUMN IF NOT EXISTS operating_from DATE,
+			ADD COLUMN IF NOT EXISTS operating_days BIT VARYING;
+		""")
+		cur.execute("""
+			ALTER TABLE journeypattern_service_section
+			ADD COLUMN IF NOT EXISTS section_sequence INT;
+		""")
+		cur.execute("""
+			SELECT EXISTS (
+				SELECT 1 FROM information_schema.columns
+				WHERE table_name = 'jptiminglink'
+				AND column_name = 'runtime_seconds')
+		""")
+		[[has_runtime_seconds]] = list(cur)
+		if not has_runtime_seconds:
+			# New rows get this from duration_to_seconds() when they're
+			# imported, but do our best for the ones we've already got
+			logging.info("Adding jptiminglink.runtime_seconds...")
+			cur.execute("""
+				ALTER TABLE jptiminglink
+				ADD COLUMN runtime_seconds INT;
+
+				UPDATE jptiminglink
+				SET runtime_seconds =
+					coalesce(substring(runtime FROM '([0-9]+)H')::int, 0) * 3600
+					+ coalesce(substring(runtime FROM '([0-9]+)M')::int, 0) * 60
+					+ coalesce(substring(runtime FROM '([0-9]+)S')::int, 0)
+				WHERE runtime ~ '^PT([0-9]+H)?([0-9]+M)?([0-9]+S)?$'
+				AND runtime <> 'PT';
 			""")
-		drop_mv_link_frequency3(cur)
-
-def refresh_materialized_views(conn):
-	with conn.cursor() as cur:
 		cur.execute("""
-			REFRESH MATERIALIZED VIEW mv_vehiclejourney_per_hour;
+			SELECT array_length(conkey, 1)
+			FROM pg_constraint
+			WHERE conrelid = 'operator'::regclass
+			AND contype = 'p'
+		""")
+		if list(cur) == [(1,)]:
+			# Operators used to be shared between files, but deleting a
+			# file deleted the ones it happened to insert first. (The
+			# files which lost theirs get them back when they change.)
+			logging.info("Giving each file its own operator rows...")
+			cur.execute("""
+				ALTER TABLE operator
+				DROP CONSTRAINT operator_pkey,
+				ALTER COLUMN source_id SET NOT NULL,
+				ADD PRIMARY KEY (source_id, operator_id);
 			""")
-		refresh_mv_link_frequency3(cur)
+		# The intern rows are written at the end of each file (see
+		# intern_cache.py), so the foreign keys onto them have to wait
+		# until COMMIT. Older databases have them NOT DEFERRABLE.
+		cur.execute("""
+			SELECT conrelid::regclass::text, conname
+			FROM pg_constraint
+			WHERE contype = 'f'
+			AND NOT condeferrable
+			AND confrelid = ANY(%s::regclass[])
+		""", (["%s_intern" % (tablename,) for tablename in sqlite_storage.INTERN_TABLES],))
+		for tablename, constraint in list(cur):
+			logging.info("Making %s on %s DEFERRABLE", constraint, tablename)
+			cur.execute("""
+				ALTER TABLE %s ALTER CONSTRAINT %s DEFERRABLE;
+			""" % (tablename, constraint))
+		cur.execute("""
+			CREATE TABLE IF NOT EXISTS target_week(
+				monday DATE NOT NULL);
+		""")
+		cur.execute(SOURCE_STATS_TABLE)
+		cur.execute(BULK_LOAD_SAVED_TABLE)
+		cur.execute(BULK_LOAD_REJECTS_TABLE)
+		cur.execute(link_frequency.DIRTY_SOURCE_TABLE)
+		cur.execute(DATASET_VERSION_TABLE)
 
-def create_materialized_views(conn):
+def set_target_week(conn, monday):
+	"""Which week the materialized views are about (None to use days_mask)
+
+	Returns True if that's a different week to before.
+	"""
 	with conn.cursor() as cur:
-		logging.info("Defining mv_vehiclejourney_per_hour...")
 		cur.execute("""
-			CREATE MATERIALIZED VIEW mv_vehiclejourney_per_hour AS
-			WITH vehiclejourney_fix_jpid AS (
-				SELECT
-					vj.source_id,
-					vj.vjcode_id,
-					vj.other_vjcode_id,
-					coalesce(vj.journeypattern_id, other.journeypattern_id) AS journeypattern_id,
-					vj.line_id,
-					vj.days_mask,
-					vj.deptime_seconds
-				FROM vehiclejourney vj
-				LEFT JOIN vehiclejourney other ON vj.other_vjcode_id = other.vjcode_id
-			),
-			vehiclejourney_dedup AS (
-				-- So, um, some buses leave at exactly the same time, and go on
-				-- exactly the same route?
-				-- But don't worry, someone adds DaysOfNonOperation each time,
-				-- a couple of days before departure.
-				-- I wouldn't trust that, so let's get rid of the obvious nonsense.
-
-				SELECT DISTINCT source_id, vjcode_id, other_vjcode_id, journeypattern_id, line_id, days_mask, deptime_seconds
-				FROM vehiclejourney_fix_jpid
-			)
-			SELECT
-				vj.journeypattern_id,
-				vj.line_id,
-				vj.days_mask,
-				sum(case when vj.deptime_seconds / 3600 = 0 then 1 else 0 end)::int as hour_0,
-				sum(case when vj.deptime_seconds / 3600 = 1 then 1 else 0 end)::int as hour_1,
-				sum(case when vj.deptime_seconds / 3600 = 2 then 1 else 0 end)::int as hour_2,
-				sum(case when vj.deptime_seconds / 3600 = 3 then 1 else 0 end)::int as hour_3,
-				sum(case when vj.deptime_seconds / 3600 = 4 then 1 else 0 end)::int as hour_4,
-				sum(case when vj.deptime_seconds / 3600 = 5 then 1 else 0 end)::int as hour_5,
-				sum(case when vj.deptime_seconds / 3600 = 6 then 1 else 0 end)::int as hour_6,
-				sum(case when vj.deptime_seconds / 3600 = 7 then 1 else 0 end)::int as hour_7,
-				sum(case when vj.deptime_seconds / 3600 = 8 then 1 else 0 end)::int as hour_8,
-				sum(case when vj.deptime_seconds / 3600 = 9 then 1 else 0 end)::int as hour_9,
-				sum(case when vj.deptime_seconds / 3600 = 10 then 1 else 0 end)::int as hour_10,
-				sum(case when vj.deptime_seconds / 3600 = 11 then 1 else 0 end)::int as hour_11,
-				sum(case when vj.deptime_seconds / 3600 = 12 then 1 else 0 end)::int as hour_12,
-				sum(case when vj.deptime_seconds / 3600 = 13 then 1 else 0 end)::int as hour_13,
-				sum(case when vj.deptime_seconds / 3600 = 14 then 1 else 0 end)::int as hour_14,
-				sum(case when vj.deptime_seconds / 3600 = 15 then 1 else 0 end)::int as hour_15,
-				sum(case when vj.deptime_seconds / 3600 = 16 then 1 else 0 end)::int as hour_16,
-				sum(case when vj.deptime_seconds / 3600 = 17 then 1 else 0 end)::int as hour_17,
-				sum(case when vj.deptime_seconds / 3600 = 18 then 1 else 0 end)::int as hour_18,
-				sum(case when vj.deptime_seconds / 3600 = 19 then 1 else 0 end)::int as hour_19,
-				sum(case when vj.deptime_seconds / 3600 = 20 then 1 else 0 end)::int as hour_20,
-				sum(case when vj.deptime_seconds / 3600 = 21 then 1 else 0 end)::int as hour_21,
-				sum(case when vj.deptime_seconds / 3600 = 22 then 1 else 0 end)::int as hour_22,
-				sum(case when vj.deptime_seconds / 3600 = 23 then 1 else 0 end)::int as hour_23
-			FROM vehiclejourney_dedup vj
-			GROUP BY 1,2,3
-			WITH NO DATA;
+			SELECT monday FROM target_week;
 		""")
+		old = [str(old_monday) for [old_monday] in cur]
+		if old == ([monday.isoformat()] if monday is not None else []):
+			return False
 		cur.execute("""
-			CREATE INDEX idx_vehiclejourney_per_hour_id
-			ON mv_vehiclejourney_per_hour
-			USING btree (journeypattern_id);
+			DELETE FROM target_week;
 		""")
+		if monday is not None:
+			assert monday.weekday() == 0
+			cur.execute("""
+				INSERT INTO target_week(monday) VALUES (%s);
+			""", (monday,))
+	return True
 
-		create_mv_link_frequency3(cur)
-
-def create_mv_link_frequency3(cur):
-	logging.info("Defining mv_link_frequency3...")
-
-	cur.execute("""
-	CREATE TABLE mask_to_weekday (mask INT UNIQUE, weekday CHAR UNIQUE);
-	""")
-	cur.execute("""
-	INSERT INTO mask_to_weekday (mask, weekday)
-	VALUES (1, 'M'), (2, 'T'), (4, 'W'), (8, 'H'), (16, 'F'), (32, 'S'), (64, 'N');
-	""")
-
-
-	cur.execute("""
-	CREATE FUNCTION hourarray_add(INT[24], INT[24]) RETURNS INT[24]
-        AS $$
-                SELECT ARRAY[
-                        $1[1] + $2[1],
-                        $1[2] + $2[2],
-                        $1[3] + $2[3],
-                        $1[4] + $2[4],
-                        $1[5] + $2[5],
-                        $1[6] + $2[6],
-                        $1[7] + $2[7],
-                        $1[8] + $2[8],
-                        $1[9] + $2[9],
-                        $1[10] + $2[10],
-                        $1[11] + $2[11],
-                        $1[12] + $2[12],
-                        $1[13] + $2[13],
-                        $1[14] + $2[14],
-                        $1[15] + $2[15],
-                        $1[16] + $2[16],
-                        $1[17] + $2[17],
-                        $1[18] + $2[18],
-                        $1[19] + $2[19],
-                        $1[20] + $2[20],
-                        $1[21] + $2[21],
-                        $1[22] + $2[22],
-                        $1[23] + $2[23],
-                        $1[24] + $2[24]
-                ];
-        $$ LANGUAGE SQL
-        IMMUTABLE
-        RETURNS NULL ON NULL INPUT;
-	""")
-	cur.execute("""
-	CREATE AGGREGATE hourarray_sum (int[24])
-	(
-	    sfunc = hourarray_add,
-	    stype = int[24],
-	    initcond = '{0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0}'
-	);
-	""")
-
-	cur.execute("""
-	CREATE FUNCTION runtime_to_seconds(TEXT) RETURNS integer
-	AS $$
-		SELECT (coalesce(x.match[1]::int, 0)*60) + coalesce(x.match[2]::int, 0)
-		FROM (
-			SELECT regexp_matches($1, '^PT(?:([0-9]+)M)?(?:([0-9]+)S)?$') as match
-		) AS x;
-	$$ LANGUAGE SQL
-	IMMUTABLE
-	RETURNS NULL ON NULL INPUT;
-	""")
-
-	cur.execute("""
-	CREATE MATERIALIZED VIEW mv_link_frequency3 AS
-		WITH stops_and_frequency_per_line AS (
-			SELECT
-				timing.from_stoppoint,
-				timing.to_stoppoint,
-				jp_service.service_id,
-				weekday.weekday,
-				ARRAY [
-					sum(vjph.hour_0),
-					sum(vjph.hour_1),
-					sum(vjph.hour_2),
-					sum(vjph.hour_3),
-					sum(vjph.hour_4),
-					sum(vjph.hour_5),
-					sum(vjph.hour_6),
-					sum(vjph.hour_7),
-					sum(vjph.hour_8),
-					sum(vjph.hour_9),
-					sum(vjph.hour_10),
-					sum(vjph.hour_11),
-					sum(vjph.hour_12),
-					sum(vjph.hour_13),
-					sum(vjph.hour_14),
-					sum(vjph.hour_15),
-					sum(vjph.hour_16),
-					sum(vjph.hour_17),
-					sum(vjph.hour_18),
-					sum(vjph.hour_19),
-					sum(vjph.hour_20),
-					sum(vjph.hour_21),
-					sum(vjph.hour_22),
-					sum(vjph.hour_23)
-				]::int[24] AS hour_array,
-				min(distinct runtime_to_seconds(timing.runtime)) as min_runtime,
-				max(distinct runtime_to_seconds(timing.runtime)) as max_runtime
-			FROM jptiminglink timing
-			JOIN journeypattern_service_section section USING (jpsection_id)
-			JOIN mv_vehiclejourney_per_hour vjph USING (journeypattern_id)
-			LEFT JOIN journeypattern_service jp_service USING (journeypattern_id)
-			JOIN mask_to_weekday weekday ON weekday.mask & vjph.days_mask > 0
-			GROUP BY
-				timing.from_stoppoint,
-				timing.to_stoppoint,
-				jp_service.service_id,
-				weekday.weekday
-		),
-		stops_and_frequency AS (
-			
-			SELECT
-				from_stoppoint,
-				to_stoppoint,
-				weekday,
-
-				ARRAY [
-					sum(hour_array[1]),
-					sum(hour_array[2]),
-					sum(hour_array[3]),
-					sum(hour_array[4]),
-					sum(hour_array[5]),
-					sum(hour_array[6]),
-					sum(hour_array[7]),
-					sum(hour_array[8]),
-					sum(hour_array[9]),
-					sum(hour_array[10]),
-					sum(hour_array[11]),
-					sum(hour_array[12]),
-					sum(hour_array[13]),
-					sum(hour_array[14]),
-					sum(hour_array[15]),
-					sum(hour_array[16]),
-					sum(hour_array[17]),
-					sum(hour_array[18]),
-					sum(hour_array[19]),
-					sum(hour_array[20]),
-					sum(hour_array[21]),
-					sum(hour_array[22]),
-					sum(hour_array[23]),
-					sum(hour_array[24])
-				] hour_array_total,
-
-				ARRAY [
-					max(hour_array[1]),
-					max(hour_array[2]),
-					max(hour_array[3]),
-					max(hour_array[4]),
-					max(hour_array[5]),
-					max(hour_array[6]),
-					max(hour_array[7]),
-					max(hour_array[8]),
-					max(hour_array[9]),
-					max(hour_array[10]),
-					max(hour_array[11]),
-					max(hour_array[12]),
-					max(hour_array[13]),
-					max(hour_array[14]),
-					max(hour_array[15]),
-					max(hour_array[16]),
-					max(hour_array[17]),
-					max(hour_array[18]),
-					max(hour_array[19]),
-					max(hour_array[20]),
-					max(hour_array[21]),
-					max(hour_array[22]),
-					max(hour_array[23]),
-					max(hour_array[24])
-				] hour_array_best_service,
-
-				array_agg(DISTINCT service_id) AS service_ids,
-				min(min_runtime) AS min_runtime,
-				max(max_runtime) AS max_runtime
-
-			FROM stops_and_frequency_per_line
-			GROUP BY
-				from_stoppoint,
-				to_stoppoint,
-				weekday
-		)
-		SELECT
-			-- a line segment allows you to draw directly from a
-			-- query on this table, which is a massive speed improvement
-			lseg(point(from_point.latitude::double precision, from_point.longitude::double precision), point(to_point.latitude::double precision, to_point.longitude::double precision)) AS line_segment,
-
-			-- ... but you can only (easily) have a gist index on a box!
-			box(point(from_point.latitude::double precision, from_point.longitude::double precision), point(to_point.latitude::double precision, to_point.longitude::double precision)) AS lseg_bbox,
-
-			stops_and_frequency.from_stoppoint,
-			stops_and_frequency.to_stoppoint,
-			stops_and_frequency.weekday,
-
-			stops_and_frequency.hour_array_total,
-			stops_and_frequency.hour_array_best_service,
-			stops_and_frequency.service_ids,
-			stops_and_frequency.min_runtime,
-			stops_and_frequency.max_runtime
-
-		FROM stops_and_frequency
-		JOIN naptan from_point ON stops_and_frequency.from_stoppoint = from_point.atcocode_id
-		JOIN naptan to_point ON stops_and_frequency.to_stoppoint = to_point.atcocode_id
-
-	WITH NO DATA;
-	""")
-	cur.execute("""
-		CREATE INDEX idx_mv_link_frequency3
-		ON mv_link_frequency3
-		USING gist(lseg_bbox);
-	""")
-
-
-def drop_mv_link_frequency3(cur):
-	cur.execute("""
-		DROP MATERIALIZED VIEW mv_link_frequency3
-		""")
-	cur.execute("""
-		DROP TABLE mask_to_weekday
-		""")
-	cur.execute("""
-		DROP FUNCTION hourarray_add(INT[24], INT[24])
-		""")
-	cur.execute("""
-		DROP AGGREGATE hourarray_sum (int[24])
-		""")
-	cur.execute("""
-		DROP FUNCTION runtime_to_seconds(TEXT)
+def drop_materialized_views(conn):
+	if is_sqlite(conn):
+		# they're ordinary tables, see sqlite_storage.py
+		return
+	link_frequency.drop(conn)
+	link_corridor.drop(conn)
+
+def refresh_materialized_views(conn, full=False, engine="sql", weekdays=()):
+	"""Brings link_frequency3 up to date (see link_frequency.py)
+
+	The partitions for weekdays are worked out from scratch afterwards,
+	and then the link_corridor levels (or the bits of them along the
+	links which changed).
+
+	Each swap of a rebuilt table is committed straight away, so the
+	server isn't kept waiting. (If the link_corridor levels then fail,
+	they're out of date until the next --full-refresh.)
+	"""
+	if is_sqlite(conn):
+		sqlite_storage.refresh_link_frequency(conn)
+		bump_dataset_version(conn)
+		return
+	changed = link_frequency.refresh(conn, full=full, engine=engine)
+	if changed == "full":
+		# the swap locked link_frequency3 and link_headway, and the
+		# server can't read them until this commits
+		bump_dataset_version(conn)
+		conn.commit()
+	if weekdays:
+		link_frequency.rebuild_weekdays(conn, weekdays, engine=engine)
+		# (the same goes for DETACH PARTITION)
+		bump_dataset_version(conn)
+		conn.commit()
+		changed = "full"
+	if not link_corridor.exists(conn):
+		link_corridor.refresh(conn)
+	elif changed:
+		link_corridor.refresh(conn, only_keys=changed == "keys")
+	if changed:
+		bump_dataset_version(conn)
+	conn.commit()
+
+def bump_dataset_version(conn):
+	with conn.cursor() as cur:
+		cur.execute("""
+			UPDATE dataset_version SET version = version + 1;
 		""")
+		if not cur.rowcount:
+			cur.execute("""
+				INSERT INTO dataset_version(version) VALUES (1);
+			""")
 
-def refresh_mv_link_frequency3(cur):
-	cur.execute("""
-		REFRESH MATERIALIZED VIEW mv_link_frequency3
+def dataset_version(conn):
+	with conn.cursor() as cur:
+		cur.execute("""
+			SELECT coalesce(max(version), 0) FROM dataset_version;
 		""")
+		[[version]] = list(cur)
+		return version
+
+def create_materialized_views(conn):
+	if is_sqlite(conn):
+		return
+	link_frequency.create(conn)
 
 def _interned(tablename, conn, source_id, longname):
-	with conn.cursor() as cur:
-		sql = """
-			SELECT %(tablename)s_id
-			FROM %(tablename)s_intern
-			WHERE source_id = %%s
-			AND %(tablename)s = %%s
-		""" % dict(tablename=tablename)
-		cur.execute(sql, (source_id, longname,))
-		rows = list(cur)
-		if len(rows) == 0:
-			sql = """
-				INSERT INTO %(tablename)s_intern(source_id, %(tablename)s)
-				VALUES (%%s, %%s)
-				RETURNING %(tablename)s_id
-			""" % dict(tablename=tablename)
-			cur.execute(sql, (source_id, longname,))
-			rows = list(cur)
-		[[short_id]] = rows
-		return short_id
+	return intern_cache(conn).interned(tablename, source_id, longname)
 
 def interned_journeypattern(conn, source_id, journeypattern):
 	return _interned('journeypattern', conn, source_id, journeypattern)
@@ -579,21 +521,4 @@ def interned_routelink(conn, source_id, routelink):
 
 def interned_atcocode(conn, atcocode):
 	"No source_id for this one"
-	with conn.cursor() as cur:
-		sql = """
-			SELECT atcocode_id
-			FROM atcocode_intern
-			WHERE atcocode = %s
-		"""
-		cur.execute(sql, (atcocode,))
-		rows = list(cur)
-		if len(rows) == 0:
-			sql = """
-				INSERT INTO atcocode_intern(atcocode)
-				VALUES (%s)
-				RETURNING atcocode_id
-			"""
-			cur.execute(sql, (atcocode,))
-			rows = list(cur)
-		[[short_id]] = rows
-		return short_id
+	return intern_cache(conn).atcocode(atcocode)
@@ -0,0 +1,130 @@
+from ..connection_pool import ConnectionPool
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import threading
+import time
+import unittest
+
+class StubCursor(object):
+	def __init__(self, conn):
+		self.conn = conn
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		pass
+
+	def execute(self, sql, params=None):
+		if self.conn.dead:
+			raise psycopg2.OperationalError("server closed the connection unexpectedly")
+		self.conn.statements.append(sql)
+
+
+class StubConnection(object):
+	"""Pretends to be a PooledConnection"""
+	def __init__(self):
+		self.closed = 0
+		self.dead = False
+		self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+		self.prepared = set()
+		self.last_used = time.time()
+		self.statements = []
+
+	def cursor(self):
+		return StubCursor(self)
+
+	def get_transaction_status(self):
+		return self.status
+
+	def close(self):
+		self.closed = 1
+
+
+class StubPool(ConnectionPool):
+	def __init__(self, **kwargs):
+		super().__init__("dbname=nothing", **kwargs)
+		self.made = []
+
+	def _new_connection(self):
+		conn = StubConnection()
+		self.made.append(conn)
+		return conn
+
+
+class Pool(unittest.TestCase):
+	def test_reuses_connections(self):
+		pool = StubPool(size=2)
+		with pool.connection() as first:
+			pass
+		with pool.connection() as second:
+			self.assertIs(second, first)
+		stats = pool.stats()
+		self.assertEqual((stats["connects"], stats["checkouts"], stats["in_use"], stats["idle"]), (1, 2, 0, 1))
+
+	def test_full(self):
+		pool = StubPool(size=1, wait_seconds=0.01)
+		with pool.connection():
+			with self.assertRaises(psycopg2.pool.PoolError):
+				with pool.connection():
+					pass
+		self.assertEqual(pool.stats()["waits"], 1)
+		# (and the failed checkout didn't use up the space)
+		with pool.connection():
+			pass
+		self.assertEqual(pool.stats()["in_use"], 0)
+
+	def test_waits_for_one(self):
+		pool = StubPool(size=1, wait_seconds=5)
+		got = []
+		def wait():
+			with pool.connection() as conn:
+				got.append(conn)
+		with pool.connection() as conn:
+			waiter = threading.Thread(target=wait)
+			waiter.start()
+			time.sleep(0.05)
+			self.assertEqual(got, [])
+		waiter.join()
+		self.assertEqual(got, [conn])
+		self.assertGreater(pool.stats()["wait_seconds"], 0.04)
+
+	def test_replaces_dead_idle(self):
+		pool = StubPool(size=1, check_after_seconds=0)
+		with pool.connection() as first:
+			pass
+		# eg: postgres was restarted
+		first.dead = True
+		with pool.connection() as second:
+			self.assertIsNot(second, first)
+		self.assertTrue(first.closed)
+		self.assertEqual(first.statements, [])
+		self.assertEqual(second.statements, [])
+		stats = pool.stats()
+		self.assertEqual((stats["connects"], stats["discarded"]), (2, 1))
+
+	def test_checks_idle(self):
+		pool = StubPool(size=1, check_after_seconds=0)
+		with pool.connection() as first:
+			pass
+		with pool.connection() as second:
+			self.assertIs(second, first)
+		self.assertEqual(first.statements, ["SELECT 1"])
+
+	def test_discards_mid_transaction(self):
+		pool = StubPool(size=1)
+		with self.assertRaises(ValueError):
+			with pool.connection() as first:
+				# eg: a query failed outside autocommit
+				first.status = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+				raise ValueError()
+		self.assertTrue(first.closed)
+		with pool.connection() as second:
+			self.assertIsNot(second, first)
+		stats = pool.stats()
+		self.assertEqual((stats["discarded"], stats["in_use"], stats["idle"]), (1, 0, 1))
+
+
+if __name__ == '__main__':
+	unittest.main()
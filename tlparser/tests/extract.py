@@ -0,0 +1,48 @@
+from ..extract import Extractor
+from lxml.etree import XML
+import unittest
+import logging
+
+NAMESPACES = {"tx": "http://www.transxchange.org.uk/"}
+
+DOC = b"""<Link xmlns="http://www.transxchange.org.uk/" id="L1">
+	<RunTime>PT2M</RunTime>
+	<From SequenceNumber="3"><StopPointRef>A</StopPointRef></From>
+	<Note>one</Note>
+	<Note>two</Note>
+	<Empty/>
+</Link>"""
+
+class ExtractorTest(unittest.TestCase):
+	def test_child_text(self):
+		elem = XML(DOC)
+		fields = (Extractor(NAMESPACES)
+			.one("./tx:RunTime/text()")
+			.maybe_one("./tx:Missing/text()")
+			.maybe_one("./tx:Empty/text()")
+			.all("./tx:Note/text()"))
+		self.assertIsNotNone(fields.child_tags)
+		self.assertEqual(fields(elem), ("PT2M", None, None, ["one", "two"]))
+
+	def test_xpath(self):
+		elem = XML(DOC)
+		fields = (Extractor(NAMESPACES)
+			.one("./tx:RunTime/text()")
+			.one("./tx:From/@SequenceNumber")
+			.one("./tx:From/tx:StopPointRef/text()"))
+		self.assertIsNone(fields.child_tags)
+		self.assertEqual(fields(elem), ("PT2M", "3", "A"))
+
+	def test_cardinality(self):
+		elem = XML(DOC)
+		with self.assertRaises(ValueError):
+			Extractor(NAMESPACES).one("./tx:Missing/text()")(elem)
+		with self.assertRaises(ValueError):
+			Extractor(NAMESPACES).maybe_one("./tx:Note/text()")(elem)
+		with self.assertRaises(ValueError):
+			Extractor(NAMESPACES).one("./tx:From/@Missing")(elem)
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.DEBUG)
+	unittest.main()
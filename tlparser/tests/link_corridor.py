@@ -0,0 +1,116 @@
+from ..database import connect
+from ..table_definitions import create_tables, create_materialized_views
+from .. import link_corridor
+import os
+import unittest
+
+# link_corridor is postgres only: the tests which need a database are
+# skipped without one they can drop and create the tables in (nothing
+# is committed, though)
+TEST_DATABASE = os.environ.get("TRAVELINEDATA_TEST_DATABASE")
+
+class LevelForBbox(unittest.TestCase):
+	def test_levels(self):
+		self.assertIsNone(link_corridor.level_for_bbox(51, -2, 51.5, -1.5))
+		self.assertIsNone(link_corridor.level_for_bbox(51, -2, 51.75, -2))
+		self.assertEqual(link_corridor.level_for_bbox(51, -2, 51.5, -1), 1)
+		self.assertEqual(link_corridor.level_for_bbox(51, -2, 54, -2), 1)
+		self.assertEqual(link_corridor.level_for_bbox(51, -2, 52, 8), 2)
+		self.assertEqual(link_corridor.level_for_bbox(49, -8, 62, 2), 3)
+
+	def test_query_string(self):
+		# (the server passes them on as they came)
+		self.assertEqual(link_corridor.level_for_bbox("51", "-2", "51.5", "-1"), 1)
+
+
+@unittest.skipUnless(TEST_DATABASE, "needs TRAVELINEDATA_TEST_DATABASE")
+class Corridors(unittest.TestCase):
+	def setUp(self):
+		self.conn = connect(TEST_DATABASE)
+		create_tables(self.conn)
+		create_materialized_views(self.conn)
+		with self.conn.cursor() as cur:
+			# 1 and 2 are in the same level 1 cell, 3 is in the next one
+			# north, and 4 is three further on (and in the next level 2 cell)
+			cur.execute("""
+				INSERT INTO atcocode_intern(atcocode_id, atcocode)
+				VALUES (1, 'A'), (2, 'B'), (3, 'C'), (4, 'D');
+
+				INSERT INTO naptan(atcocode_id, latitude, longitude)
+				VALUES (1, 51.001, -2.005), (2, 51.002, -2.004), (3, 51.015, -2.005), (4, 51.045, -2.005);
+			""")
+
+	def tearDown(self):
+		self.conn.rollback()
+		self.conn.close()
+
+	def _add_link(self, cur, from_stoppoint, to_stoppoint, total, best, weekday="M"):
+		cur.execute("""
+			INSERT INTO link_frequency3(line_segment, lseg_bbox, from_stoppoint, to_stoppoint, weekday, hour_array_total, hour_array_best_service)
+			SELECT lseg(from_point, to_point), box(from_point, to_point), %s, %s, %s, %s, %s
+			FROM
+				(SELECT point(latitude::double precision, longitude::double precision) AS from_point FROM naptan WHERE atcocode_id = %s) f,
+				(SELECT point(latitude::double precision, longitude::double precision) AS to_point FROM naptan WHERE atcocode_id = %s) t
+		""", (from_stoppoint, to_stoppoint, weekday, [total] * 24, [best] * 24, from_stoppoint, to_stoppoint))
+
+	def _corridors(self, level):
+		with self.conn.cursor() as cur:
+			cur.execute("""
+				SELECT weekday, from_lat_cell, from_lng_cell, to_lat_cell, to_lng_cell, links, hour_array_total, hour_array_best_service
+				FROM %s
+				ORDER BY 1, 2, 3, 4, 5
+			""" % (link_corridor.tablename(level),))
+			return list(cur)
+
+	def test_adds_up_links(self):
+		with self.conn.cursor() as cur:
+			self._add_link(cur, 1, 3, total=2, best=2)
+			self._add_link(cur, 2, 3, total=3, best=1)
+			# inside a cell, so not drawn
+			self._add_link(cur, 1, 2, total=5, best=5)
+			self._add_link(cur, 3, 4, total=1, best=1, weekday="S")
+		link_corridor.refresh(self.conn)
+
+		self.assertEqual(self._corridors(1), [
+			("M", 5100, -201, 5101, -201, 2, [5] * 24, [2] * 24),
+			("S", 5101, -201, 5104, -201, 1, [1] * 24, [1] * 24),
+		])
+		self.assertEqual(self._corridors(2), [
+			("S", 1275, -51, 1276, -51, 1, [1] * 24, [1] * 24),
+		])
+
+	def test_only_keys(self):
+		with self.conn.cursor() as cur:
+			self._add_link(cur, 1, 3, total=2, best=2)
+			self._add_link(cur, 2, 3, total=3, best=1)
+			self._add_link(cur, 3, 4, total=1, best=1)
+			self._add_link(cur, 4, 3, total=1, best=1)
+		link_corridor.refresh(self.conn)
+
+		# like link_frequency.refresh, after a file changed
+		with self.conn.cursor() as cur:
+			cur.execute("""
+				DELETE FROM link_frequency3
+				WHERE (from_stoppoint, to_stoppoint) IN ((2, 3), (3, 4));
+			""")
+			self._add_link(cur, 2, 3, total=7, best=7)
+			self._add_link(cur, 3, 1, total=1, best=1)
+			cur.execute("""
+				CREATE TEMP TABLE refresh_key ON COMMIT DROP AS
+				SELECT from_stoppoint, to_stoppoint, 'M'::char AS weekday
+				FROM (VALUES (2, 3), (3, 4), (3, 1)) AS key(from_stoppoint, to_stoppoint);
+			""")
+		link_corridor.refresh(self.conn, only_keys=True)
+		updated = [self._corridors(level) for level, _, _ in link_corridor.LEVELS]
+
+		self.assertEqual(updated[0], [
+			("M", 5100, -201, 5101, -201, 2, [9] * 24, [7] * 24),
+			("M", 5101, -201, 5100, -201, 1, [1] * 24, [1] * 24),
+			("M", 5104, -201, 5101, -201, 1, [1] * 24, [1] * 24),
+		])
+		link_corridor.refresh(self.conn)
+		self.assertEqual(updated, [self._corridors(level) for level, _, _ in link_corridor.LEVELS])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,105 @@
+from ..database import connect
+from ..synthetic import write_zip
+from ..table_definitions import create_tables, create_materialized_views, drop_materialized_views, set_target_week
+from ..traveline_file_parser import process_zipfile
+from .. import link_frequency
+from .synthetic import import_args
+import datetime
+import os
+import tempfile
+import unittest
+
+# the incremental refresh is postgres only: this one needs a database it
+# can drop and create the tables in
+TEST_DATABASE = os.environ.get("TRAVELINEDATA_TEST_DATABASE")
+
+def add_stop_locations(conn):
+	with conn.cursor() as cur:
+		cur.execute("""
+			INSERT INTO naptan(atcocode_id, code, latitude, longitude)
+			SELECT atcocode_id, atcocode, 51 + atcocode_id / 1000.0, -2 + atcocode_id / 1000.0
+			FROM atcocode_intern
+			ON CONFLICT DO NOTHING
+		""")
+
+def link_rows(conn):
+	with conn.cursor() as cur:
+		cur.execute("""
+			SELECT from_stoppoint, to_stoppoint, weekday, hour_array_total, hour_array_best_service, service_ids, min_runtime, max_runtime
+			FROM link_frequency3
+			ORDER BY 1, 2, 3
+		""")
+		links = list(cur)
+		cur.execute("""
+			SELECT *
+			FROM link_headway
+			ORDER BY 1, 2, 3, 4
+		""")
+		return links, list(cur)
+
+@unittest.skipUnless(TEST_DATABASE, "needs TRAVELINEDATA_TEST_DATABASE")
+class Refresh(unittest.TestCase):
+	def test_incremental_same_as_full(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			conn = connect(TEST_DATABASE)
+			with conn:
+				drop_materialized_views(conn)
+				create_tables(conn)
+				create_materialized_views(conn)
+
+			# the files in both zips use the same stops
+			write_zip(os.path.join(tmpdir, "A.zip"), files=2, services=3, patterns=2, links=4, journeys=20, stops=30, seed=0)
+			write_zip(os.path.join(tmpdir, "B.zip"), files=1, services=3, patterns=2, links=4, journeys=20, stops=30, seed=1)
+			process_zipfile(conn, os.path.join(tmpdir, "A.zip"), False, import_args())
+			process_zipfile(conn, os.path.join(tmpdir, "B.zip"), False, import_args())
+			with conn:
+				add_stop_locations(conn)
+				set_target_week(conn, datetime.date(2018, 3, 12))
+				link_frequency.refresh(conn, full=True)
+
+			write_zip(os.path.join(tmpdir, "B.zip"), files=1, services=3, patterns=2, links=4, journeys=20, stops=30, seed=2)
+			process_zipfile(conn, os.path.join(tmpdir, "B.zip"), False, import_args())
+			with conn:
+				add_stop_locations(conn)
+				self.assertEqual(link_frequency.refresh(conn), "keys")
+			updated = link_rows(conn)
+
+			with conn:
+				link_frequency.refresh(conn, full=True)
+			self.assertTrue(updated[0])
+			self.assertEqual(updated, link_rows(conn))
+
+			# like --naptan, and then --matview on its own
+			with conn:
+				link_frequency.mark_all_dirty(conn)
+			with conn:
+				self.assertEqual(link_frequency.refresh(conn), "full")
+			with conn:
+				self.assertFalse(link_frequency.refresh(conn))
+			conn.close()
+
+	def test_rebuild_weekdays(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			conn = connect(TEST_DATABASE)
+			with conn:
+				drop_materialized_views(conn)
+				create_tables(conn)
+				create_materialized_views(conn)
+
+			write_zip(os.path.join(tmpdir, "A.zip"), files=2, services=3, patterns=2, links=4, journeys=20, stops=30, seed=0)
+			process_zipfile(conn, os.path.join(tmpdir, "A.zip"), False, import_args())
+			with conn:
+				add_stop_locations(conn)
+				set_target_week(conn, datetime.date(2018, 3, 12))
+				link_frequency.refresh(conn, full=True)
+			full = link_rows(conn)
+
+			with conn:
+				link_frequency.rebuild_weekdays(conn, "SMS")
+			self.assertTrue(full[0])
+			self.assertEqual(full, link_rows(conn))
+			conn.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
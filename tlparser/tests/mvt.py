@@ -0,0 +1,88 @@
+from ..mvt import Layer, tile, tile_bbox, tile_point, varint, zigzag
+import struct
+import unittest
+
+def read_varint(data, position):
+	number = 0
+	shift = 0
+	while True:
+		byte = data[position]
+		position += 1
+		number |= (byte & 0x7f) << shift
+		shift += 7
+		if not byte & 0x80:
+			return number, position
+
+def read_message(data):
+	"""{field: [values]}, where values are ints or bytes"""
+	fields = {}
+	position = 0
+	while position < len(data):
+		key, position = read_varint(data, position)
+		field, wire_type = key >> 3, key & 0x7
+		if wire_type == 0:
+			value, position = read_varint(data, position)
+		elif wire_type == 1:
+			value = data[position:position + 8]
+			position += 8
+		elif wire_type == 2:
+			length, position = read_varint(data, position)
+			value = data[position:position + length]
+			position += length
+		else:
+			raise ValueError(wire_type)
+		fields.setdefault(field, []).append(value)
+	return fields
+
+def read_packed(data):
+	numbers = []
+	position = 0
+	while position < len(data):
+		number, position = read_varint(data, position)
+		numbers.append(number)
+	return numbers
+
+class Encoding(unittest.TestCase):
+	def test_varint(self):
+		self.assertEqual(varint(1), b"\x01")
+		self.assertEqual(varint(300), b"\xac\x02")
+
+	def test_zigzag(self):
+		self.assertEqual([zigzag(n) for n in [0, -1, 1, -2, 2]], [0, 1, 2, 3, 4])
+
+	def test_tile(self):
+		layer = Layer("links")
+		layer.add_linestring([(10, 20), (5, 30), (5, 30)], {"weekday": "M", "buses": 3, "speed": 1.5, "missing": None})
+		layer.add_linestring([(0, 0), (1, 1)], {"buses": 3, "corridor": True}, feature_id=7)
+		self.assertFalse(layer.add_linestring([(8, 8), (8, 8)], {"buses": 1}))
+
+		[layer_data] = read_message(tile([layer]))[3]
+		decoded = read_message(layer_data)
+		self.assertEqual(decoded[15], [2])
+		self.assertEqual(decoded[1], [b"links"])
+		self.assertEqual(decoded[5], [4096])
+		self.assertEqual(decoded[3], [b"weekday", b"buses", b"speed", b"corridor"])
+		values = [read_message(value) for value in decoded[4]]
+		self.assertEqual(values[0], {1: [b"M"]})
+		self.assertEqual(values[1], {6: [zigzag(3)]})
+		self.assertEqual(struct.unpack("<d", values[2][3][0]), (1.5,))
+		self.assertEqual(values[3], {7: [1]})
+
+		first, second = [read_message(feature) for feature in decoded[2]]
+		self.assertEqual(read_packed(first[2][0]), [0, 0, 1, 1, 2, 2])
+		self.assertEqual(first[3], [2])
+		# MoveTo(1) 10,20 LineTo(1) -5,+10 (the repeated point is left out)
+		self.assertEqual(read_packed(first[4][0]), [9, 20, 40, 10, 9, 20])
+		self.assertNotIn(1, first)
+		self.assertEqual(second[1], [7])
+		self.assertEqual(read_packed(second[2][0]), [1, 1, 3, 3])
+
+	def test_tile_coordinates(self):
+		minlat, minlng, maxlat, maxlng = tile_bbox(12, 2029, 1361)
+		self.assertEqual(tile_point(maxlat, minlng, 12, 2029, 1361), (0, 0))
+		self.assertEqual(tile_point(minlat, maxlng, 12, 2029, 1361), (4096, 4096))
+		self.assertEqual(tile_bbox(0, 0, 0)[1::2], (-180, 180))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,56 @@
+from ..database import connect
+from ..table_definitions import create_tables
+from .. import link_frequency, naptan_file_parser
+from unittest import mock
+import os
+import tempfile
+import unittest
+
+def import_stops(conn, stops, **kwargs):
+	with mock.patch.object(naptan_file_parser, "get_datapoints_from_xml", return_value=iter(stops)):
+		naptan_file_parser.process_all_files(conn, **kwargs)
+
+class Upsert(unittest.TestCase):
+	def test_newer_file(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			conn = connect("sqlite:" + os.path.join(tmpdir, "test.sqlite"))
+			with conn:
+				create_tables(conn)
+				import_stops(conn, [
+					("c1", "A", "Stop A", 51.0, -2.0),
+					("c2", "B", "Stop B", 51.1, -2.1),
+					("c3", "C", "Stop C", 51.2, -2.2),
+				])
+
+			with conn:
+				import_stops(conn, [
+					# B's code has moved to A...
+					("c2", "A", "Stop A", 51.0, -2.0),
+					# ... A is listed twice (the last one wins, even in
+					# another batch) ...
+					("c4", "B", "Stop B", 51.1, -2.1),
+					("c5", "A", "Stop A moved", 51.3, -2.3),
+					# ... and C has gone
+					("c6", "D", "Stop D", 51.4, -2.4),
+				], upsert=True, batch_size=2)
+
+			with conn.cursor() as cur:
+				cur.execute("""
+					SELECT atcocode, code, name
+					FROM naptan
+					JOIN atcocode_intern USING (atcocode_id)
+					ORDER BY atcocode
+				""")
+				self.assertEqual(list(cur), [
+					("A", "c5", "Stop A moved"),
+					("B", "c4", "Stop B"),
+					("D", "c6", "Stop D"),
+				])
+				# for the next --matview
+				cur.execute("SELECT source_id FROM link_frequency_dirty_source")
+				self.assertEqual(list(cur), [(link_frequency.ALL_SOURCES,)])
+			conn.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,150 @@
+from ..database import connect
+from ..synthetic import write_zip
+from ..table_definitions import create_tables, refresh_materialized_views, set_target_week
+from ..traveline_file_parser import process_zipfile
+from .synthetic import import_args
+import collections
+import datetime
+import json
+import os
+import tempfile
+import unittest
+import logging
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class NumpyAggregate(unittest.TestCase):
+	def test_same_as_sql(self):
+		from ..numpy_aggregate import JOURNEYS_QUERY, TIMING_QUERY, link_frequencies, per_hour
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			zip_filename = os.path.join(tmpdir, "SYN.zip")
+			write_zip(zip_filename, files=2, services=3, patterns=2, links=4, journeys=20, stops=30)
+			conn = connect("sqlite:" + os.path.join(tmpdir, "test.sqlite"))
+			with conn:
+				create_tables(conn)
+			process_zipfile(conn, zip_filename, False, import_args())
+			with conn:
+				with conn.cursor() as cur:
+					cur.execute("""
+						INSERT INTO naptan(atcocode_id, code, latitude, longitude)
+						SELECT atcocode_id, atcocode, 51 + atcocode_id / 1000.0, -2 + atcocode_id / 1000.0
+						FROM atcocode_intern
+					""")
+				set_target_week(conn, datetime.date(2018, 3, 12))
+				refresh_materialized_views(conn)
+
+			with conn.cursor() as cur:
+				cur.execute(JOURNEYS_QUERY)
+				keys, hist = per_hour(numpy.array(list(cur), dtype=numpy.int64))
+				cur.execute(TIMING_QUERY)
+				timing = numpy.array(list(cur), dtype=numpy.int64)
+
+				cur.execute("SELECT * FROM vehiclejourney_per_hour")
+				self.assertEqual(
+					collections.Counter(tuple(row) for row in cur),
+					collections.Counter(
+						tuple(key[1:]) + tuple(hours)
+						for key, hours in zip(keys.tolist(), hist.tolist())))
+
+				cur.execute("""
+					SELECT from_stoppoint, to_stoppoint, weekday, hour_array_total, hour_array_best_service, service_ids, min_runtime, max_runtime
+					FROM link_frequency3
+				""")
+				# (sqlite's group_concat leaves out NULL service_ids, and
+				# doesn't sort them: NumpyCopy checks those)
+				expected = sorted(
+					(from_stoppoint, to_stoppoint, weekday, json.loads(total), json.loads(best), sorted(json.loads(service_ids)), min_runtime, max_runtime)
+					for from_stoppoint, to_stoppoint, weekday, total, best, service_ids, min_runtime, max_runtime in cur)
+			conn.close()
+
+		self.assertTrue(expected)
+		self.assertEqual(sorted(link_frequencies(keys, hist, timing)), expected)
+
+
+class CopyCursor(object):
+	"""Just enough of a psycopg2 cursor for numpy_aggregate
+
+	Each COPY ... TO STDOUT gets the next of `results`, and execute()
+	gets `rows`. What's sent with COPY ... FROM STDIN is kept in
+	`copied`, as the strings (or None for \\N).
+	"""
+	def __init__(self, results, rows=()):
+		self.results = list(results)
+		self.rows = list(rows)
+		self.copied = {}
+
+	def execute(self, sql, params=None):
+		pass
+
+	def __iter__(self):
+		return iter(self.rows)
+
+	def copy_expert(self, sql, data):
+		if sql.endswith("TO STDOUT"):
+			data.write("".join(
+				"\t".join(str(value) for value in row) + "\n"
+				for row in self.results.pop(0)).encode("ascii"))
+		else:
+			self.copied[sql.split()[1]] = [
+				[None if value == "\\N" else value for value in line.split("\t")]
+				for line in data.getvalue().splitlines()]
+
+
+def hours(**counts):
+	return [counts.get("h%d" % (hour,), 0) for hour in range(24)]
+
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class NumpyCopy(unittest.TestCase):
+	def test_round_trip(self):
+		from ..numpy_aggregate import write_link_frequency3, write_vehiclejourney_per_hour
+
+		cur = CopyCursor([
+			# JOURNEYS_QUERY: source_id, journeypattern_id, line_id, days_mask, deptime_seconds
+			[
+				(1, 10, 100, 1, 8 * 3600),
+				(1, 10, 100, 1, 8 * 3600 + 60),
+				(1, 11, -1, 1, 9 * 3600),
+				(1, 11, -1, 1, -1),
+			],
+			# TIMING_QUERY: from_stoppoint, to_stoppoint, journeypattern_id, service_id, runtime_seconds
+			[
+				(1, 2, 10, 5, 60),
+				# journeypattern 11 isn't in a service
+				(1, 2, 11, -1, -1),
+				(2, 3, 11, -1, 120),
+			],
+		], rows=[(1, 51.0, -2.0), (2, 51.1, -2.1), (3, 51.2, -2.2)])
+
+		keys, hist = write_vehiclejourney_per_hour(cur)
+		self.assertEqual(cur.copied["vehiclejourney_per_hour"], [
+			["1", "10", "100", "1"] + [str(count) for count in hours(h8=2)],
+			["1", "11", None, "1"] + [str(count) for count in hours(h9=1)],
+		])
+
+		self.assertEqual(write_link_frequency3(cur, "link_frequency3_new", keys, hist), 2)
+		self.assertEqual(cur.copied["link_frequency3_new"], [
+			[
+				"[(51.0,-2.0),(51.1,-2.1)]", "((51.0,-2.0),(51.1,-2.1))", "1", "2", "M",
+				"{%s}" % ",".join(str(count) for count in hours(h8=2, h9=1)),
+				"{%s}" % ",".join(str(count) for count in hours(h8=2, h9=1)),
+				# like array_agg(DISTINCT service_id): NULL last
+				"{5,NULL}", "60", "60",
+			],
+			[
+				"[(51.1,-2.1),(51.2,-2.2)]", "((51.1,-2.1),(51.2,-2.2))", "2", "3", "M",
+				"{%s}" % ",".join(str(count) for count in hours(h9=1)),
+				"{%s}" % ",".join(str(count) for count in hours(h9=1)),
+				"{NULL}", "120", "120",
+			],
+		])
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.DEBUG)
+	unittest.main()
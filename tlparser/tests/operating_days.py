@@ -0,0 +1,75 @@
+from ..traveline_xml_parser import parse_single_vj_elem, parse_vj_elem
+from ..traveline_xml_parser import NAMESPACES
+from ..operating_days import operating_bitmap, days_mask_from_bitmap, operating_window, outside_period
+from lxml.etree import XML
+import unittest
+import logging
+from os.path import dirname
+import datetime
+
+def single_vj_elem():
+	with open(dirname(__file__) + "/single_vj.xml", mode='rb') as f:
+		root = XML(f.read())
+	[vjelem] = root.xpath("//tx:VehicleJourney", namespaces=NAMESPACES)
+	return vjelem
+
+class OperatingDays(unittest.TestCase):
+	def test_bitmap(self):
+		*_, regular_days, non_operation = parse_vj_elem(single_vj_elem())
+		bitmap = operating_bitmap(regular_days, non_operation, datetime.date(2018, 2, 26), 28)
+		# sundays only, but not 2018-03-04 or 2018-03-11
+		self.assertEqual(bitmap, "0000000" "0000000" "0000001" "0000001")
+
+	def test_bitmap_not_monday(self):
+		*_, regular_days, non_operation = parse_vj_elem(single_vj_elem())
+		bitmap = operating_bitmap(regular_days, non_operation, datetime.date(2018, 3, 10), 10)
+		# saturday 2018-03-10: skips sunday 2018-03-11, runs sunday 2018-03-18
+		self.assertEqual(bitmap, "0000000010")
+
+	def test_same_as_days_mask(self):
+		vjelem = single_vj_elem()
+		*_, regular_days, non_operation = parse_vj_elem(vjelem)
+		operating_from = datetime.date(2017, 10, 30)
+		bitmap = operating_bitmap(regular_days, non_operation, operating_from, 182)
+		for week in range(26):
+			monday = operating_from + datetime.timedelta(days=7 * week)
+			[*_, days_bitmask, _departuretime] = parse_single_vj_elem(vjelem, monday)
+			self.assertEqual(days_mask_from_bitmap(operating_from, bitmap, monday), days_bitmask, monday)
+
+	def test_outside_bitmap(self):
+		bitmap = "1111111" * 2
+		self.assertIsNone(days_mask_from_bitmap(datetime.date(2018, 3, 5), bitmap, datetime.date(2018, 2, 26)))
+		self.assertIsNone(days_mask_from_bitmap(datetime.date(2018, 3, 5), bitmap, datetime.date(2018, 3, 19)))
+		self.assertEqual(days_mask_from_bitmap(datetime.date(2018, 3, 5), bitmap, datetime.date(2018, 3, 12)), 127)
+
+	def test_window(self):
+		calendar_start = datetime.date(2018, 3, 5)
+		# started ages ago, no end
+		self.assertEqual(
+			operating_window(datetime.date(2017, 1, 1), None, calendar_start, 182),
+			(calendar_start, 182))
+		# whole weeks, from a wednesday to a tuesday
+		self.assertEqual(
+			operating_window(datetime.date(2018, 4, 4), datetime.date(2018, 4, 17), calendar_start, 182),
+			(datetime.date(2018, 4, 2), 21))
+		self.assertEqual(
+			operating_window(datetime.date(2018, 4, 4), datetime.date(2019, 4, 17), calendar_start, 182),
+			(datetime.date(2018, 4, 2), 182))
+		# all over before calendar_start
+		self.assertEqual(
+			operating_window(datetime.date(2017, 1, 1), datetime.date(2018, 1, 1), calendar_start, 182),
+			(calendar_start, 0))
+
+	def test_outside_period(self):
+		*_, regular_days, non_operation = parse_vj_elem(single_vj_elem())
+		start, end = datetime.date(2018, 3, 14), datetime.date(2018, 3, 20)
+		operating_from, days = operating_window(start, end, datetime.date(2018, 2, 26), 182)
+		bitmap = operating_bitmap(regular_days, non_operation + outside_period(start, end), operating_from, days)
+		# the weeks of 2018-03-12 and 2018-03-19, sundays only: 2018-03-18
+		# is the only one in the period
+		self.assertEqual(bitmap, "0000001" "0000000")
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.DEBUG)
+	unittest.main()
@@ -0,0 +1,105 @@
+from ..response_cache import ExpiringCache
+from ..response_cache import ResponseCache
+from unittest import mock
+import os
+import tempfile
+import time
+import unittest
+
+class Cache(unittest.TestCase):
+	def test_memory_then_disk(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			cache = ResponseCache(tmpdir, memory_bytes=10, disk_bytes=1000)
+			self.assertIsNone(cache.get(1, "/a"))
+			cache.put(1, "/a", b"aaaaaaaa")
+			self.assertEqual(cache.get(1, "/a"), b"aaaaaaaa")
+			# pushes /a out of memory, but it's still on disk
+			cache.put(1, "/b", b"bbbbbbbb")
+			self.assertNotIn("/a", cache.memory)
+			self.assertEqual(cache.get(1, "/a"), b"aaaaaaaa")
+
+			# another process (or after a restart) finds them on disk
+			other = ResponseCache(tmpdir, memory_bytes=10, disk_bytes=1000)
+			self.assertEqual(other.get(1, "/b"), b"bbbbbbbb")
+			self.assertEqual(other.stats()["disk_items"], 2)
+
+			stats = cache.stats()
+			self.assertEqual((stats["memory_hits"], stats["disk_hits"], stats["misses"]), (1, 1, 1))
+			self.assertEqual(stats["hit_rate"], 2 / 3)
+
+	def test_new_version(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			cache = ResponseCache(tmpdir)
+			cache.put(1, "/a", b"old")
+			self.assertIsNone(cache.get(2, "/a"))
+			self.assertEqual(os.listdir(tmpdir), [])
+			cache.put(2, "/a", b"new")
+			self.assertEqual(os.listdir(tmpdir), ["2"])
+			# a slow request from before the new version isn't kept
+			cache.put(1, "/a", b"old")
+			self.assertEqual(cache.get(2, "/a"), b"new")
+
+	def test_version_goes_back(self):
+		# eg: after --destroy_create_tables
+		with tempfile.TemporaryDirectory() as tmpdir:
+			cache = ResponseCache(tmpdir)
+			cache.put(5, "/a", b"old")
+			self.assertIsNone(cache.get(1, "/a"))
+			cache.put(1, "/a", b"new")
+			self.assertEqual(cache.get(1, "/a"), b"new")
+			self.assertEqual(os.listdir(tmpdir), ["1"])
+
+	def test_files_without_lock(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			cache = ResponseCache(tmpdir, memory_bytes=0)
+			real_open = open
+			def unlocked_open(*args, **kwargs):
+				self.assertFalse(cache.lock.locked())
+				return real_open(*args, **kwargs)
+			with mock.patch("tlparser.response_cache.open", unlocked_open, create=True):
+				cache.put(1, "/a", b"a")
+				self.assertEqual(cache.get(1, "/a"), b"a")
+
+	def test_disk_eviction(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			cache = ResponseCache(tmpdir, memory_bytes=0, disk_bytes=25)
+			for key in ["/a", "/b", "/c"]:
+				cache.put(1, key, b"1234567890")
+			cache.get(1, "/b")
+			cache.put(1, "/d", b"1234567890")
+			self.assertEqual(cache.stats()["disk_bytes"], 20)
+			self.assertIsNone(cache.get(1, "/a"))
+			self.assertIsNone(cache.get(1, "/c"))
+			self.assertEqual(cache.get(1, "/b"), b"1234567890")
+			self.assertEqual(cache.get(1, "/d"), b"1234567890")
+
+	def test_memory_only(self):
+		cache = ResponseCache(None, memory_bytes=100)
+		cache.put(1, "/a", b"a")
+		self.assertEqual(cache.get(1, "/a"), b"a")
+		self.assertIsNone(cache.get(2, "/a"))
+
+
+class Expiring(unittest.TestCase):
+	def test_least_recently_used(self):
+		cache = ExpiringCache(memory_bytes=20)
+		cache.put("a", [1], 10)
+		cache.put("b", [2], 10)
+		self.assertEqual(cache.get("a"), [1])
+		cache.put("c", [3], 10)
+		self.assertIsNone(cache.get("b"))
+		self.assertEqual(cache.get("a"), [1])
+		self.assertEqual(cache.stats()["memory_bytes"], 20)
+
+	def test_expires(self):
+		cache = ExpiringCache(ttl_seconds=0.01)
+		cache.put("a", [1], 10)
+		self.assertEqual(cache.get("a"), [1])
+		time.sleep(0.02)
+		self.assertIsNone(cache.get("a"))
+		stats = cache.stats()
+		self.assertEqual((stats["hits"], stats["misses"], stats["expired"], stats["memory_items"]), (1, 1, 1, 0))
+
+
+if __name__ == '__main__':
+	unittest.main()
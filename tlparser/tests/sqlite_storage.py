@@ -0,0 +1,75 @@
+from ..database import connect
+from ..synthetic import write_zip
+from ..table_definitions import create_tables, refresh_materialized_views, set_target_week
+from ..traveline_file_parser import process_zipfile
+from ..sqlite_storage import headways, link_frequency_in_bbox
+from .synthetic import import_args
+import datetime
+import os
+import tempfile
+import unittest
+import logging
+
+class SqliteImport(unittest.TestCase):
+	def test_import_and_query(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			zip_filename = os.path.join(tmpdir, "SYN.zip")
+			write_zip(zip_filename, files=2, services=3, patterns=2, links=4, journeys=5, stops=50)
+			conn = connect("sqlite:" + os.path.join(tmpdir, "test.sqlite"))
+			with conn:
+				create_tables(conn)
+
+			process_zipfile(conn, zip_filename, False, import_args())
+			with conn.cursor() as cur:
+				cur.execute("SELECT count(1) FROM vehiclejourney")
+				self.assertEqual(list(cur), [(2 * 3 * 2 * 5,)])
+
+			# put every stop somewhere near (51, -2)
+			with conn:
+				with conn.cursor() as cur:
+					cur.execute("SELECT atcocode_id, atcocode FROM atcocode_intern")
+					stops = list(cur)
+					cur.executemany("""
+						INSERT INTO naptan(atcocode_id, code, name, latitude, longitude)
+						VALUES (%s, %s, %s, %s, %s)
+					""", [
+						(atcocode_id, atcocode, atcocode, 51 + atcocode_id / 1000, -2 + atcocode_id / 1000)
+						for atcocode_id, atcocode in stops])
+				set_target_week(conn, datetime.date(2018, 3, 12))
+				refresh_materialized_views(conn)
+
+			rows = link_frequency_in_bbox(conn, 50, -3, 52, -1, "M", 10000)
+			self.assertTrue(rows)
+			counts = [sum(row[10]) for row in rows]
+			self.assertEqual(counts, sorted(counts))
+			for row in rows:
+				self.assertEqual(len(row), 13)
+				self.assertEqual(row[6], "M")
+				self.assertEqual(len(row[10]), 24)
+				self.assertEqual(sum(headway["departures"] for headway in row[12].values()), sum(row[10]))
+
+			self.assertEqual(len(link_frequency_in_bbox(conn, 50, -3, 52, -1, "M", 2)), 2)
+			self.assertEqual(link_frequency_in_bbox(conn, 0, 0, 1, 1, "M", 10000), [])
+			conn.close()
+
+	def test_headways(self):
+		departures = [
+			(1, 2, "M", 6 * 3600),
+			(1, 2, "M", 8 * 3600),
+			(1, 2, "M", 8 * 3600 + 300),
+			(1, 2, "M", 8 * 3600 + 600),
+			(1, 2, "M", 9 * 3600),
+			(1, 2, "M", 25 * 3600),
+			(1, 2, "T", 8 * 3600),
+		]
+		self.assertEqual(list(headways(departures)), [
+			(1, 2, "M", "early", 1, 6 * 3600, 6 * 3600, None, None),
+			(1, 2, "M", "am_peak", 4, 8 * 3600, 9 * 3600, 3000, 300),
+			(1, 2, "M", "evening", 1, 25 * 3600, 25 * 3600, None, None),
+			(1, 2, "T", "am_peak", 1, 8 * 3600, 8 * 3600, None, None),
+		])
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.DEBUG)
+	unittest.main()
@@ -0,0 +1,91 @@
+from ..synthetic import write_zip
+from ..intern_cache import intern_cache
+from ..recording_connection import RecordingConnection
+from ..traveline_file_parser import process_zipfile
+from ..xmlparser import DEFAULT_BUFFER_SIZE
+from unittest import mock
+import argparse
+import os
+import tempfile
+import unittest
+import logging
+
+def import_args():
+	return argparse.Namespace(
+		read_buffer_size=DEFAULT_BUFFER_SIZE,
+		monday_of_desired_week="2018-03-12",
+		calendar_start="2018-03-05",
+		calendar_days=28,
+		copy_batch_rows=100,
+		pipeline=0,
+		profile=None,
+		row_cache=None)
+
+class SyntheticImport(unittest.TestCase):
+	def test_rows_written(self):
+		conn = RecordingConnection()
+		with tempfile.TemporaryDirectory() as tmpdir:
+			zip_filename = os.path.join(tmpdir, "SYN.zip")
+			written = write_zip(zip_filename, files=2, services=3, patterns=2, links=4, journeys=5, stops=50)
+			process_zipfile(conn, zip_filename, False, import_args())
+
+		self.assertEqual(conn.rollbacks, 0)
+		self.assertEqual(written["VehicleJourney"], 2 * 3 * 2 * 5)
+		self.assertEqual(conn.copy_rows["vehiclejourney"], 2 * 3 * 2 * 5)
+		self.assertEqual(conn.copy_rows["jptiminglink"], 2 * 3 * 2 * 4)
+		self.assertEqual(conn.copy_rows["routelink"], 2 * 3 * 2 * 4)
+		self.assertEqual(conn.copy_rows["journeypattern_service"], 2 * 3 * 2)
+		self.assertEqual(conn.copy_rows["service"], 2 * 3)
+		self.assertEqual(conn.copy_rows["line"], 2 * 3)
+		self.assertEqual(conn.copy_rows["bulk_operator"], 2)
+		self.assertEqual(conn.copy_rows["bulk_stoppoint"], written["AnnotatedStopPointRef"])
+
+	def test_shared_connection(self):
+		# like a --jobs worker
+		conn = RecordingConnection()
+		shared = RecordingConnection()
+		intern_cache(conn).use_shared_connection(shared)
+		with tempfile.TemporaryDirectory() as tmpdir:
+			zip_filename = os.path.join(tmpdir, "SYN.zip")
+			written = write_zip(zip_filename, files=2, services=3, patterns=2, links=4, journeys=5, stops=50)
+			process_zipfile(conn, zip_filename, False, import_args())
+
+		self.assertEqual(conn.copy_rows["bulk_stoppoint"], 0)
+		self.assertEqual(shared.copy_rows["bulk_stoppoint"], written["AnnotatedStopPointRef"])
+		self.assertGreater(shared.statements["INSERT INTO"], 0)
+		self.assertEqual(conn.copy_rows["jptiminglink"], 2 * 3 * 2 * 4)
+		self.assertEqual(shared.rollbacks, 0)
+
+	def test_row_cache(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			zip_filename = os.path.join(tmpdir, "SYN.zip")
+			write_zip(zip_filename, files=2, services=3, patterns=2, links=4, journeys=5, stops=50)
+			args = import_args()
+			args.row_cache = os.path.join(tmpdir, "rows")
+
+			parsed = RecordingConnection()
+			process_zipfile(parsed, zip_filename, False, args)
+			self.assertEqual(len(os.listdir(args.row_cache)), 2)
+
+			cached = RecordingConnection()
+			with mock.patch("tlparser.traveline_file_parser.process_xml_file", side_effect=AssertionError("parsed the xml")):
+				process_zipfile(cached, zip_filename, False, args)
+			self.assertEqual(cached.copy_rows, parsed.copy_rows)
+
+	def test_row_cache_unwritable(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			zip_filename = os.path.join(tmpdir, "SYN.zip")
+			write_zip(zip_filename, files=1, services=1, patterns=1, links=2, journeys=1, stops=10)
+			args = import_args()
+			# a file, so the directory can't be made
+			args.row_cache = zip_filename
+
+			conn = RecordingConnection()
+			process_zipfile(conn, zip_filename, False, args)
+			self.assertEqual(conn.rollbacks, 0)
+			self.assertEqual(conn.copy_rows["vehiclejourney"], 1)
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.DEBUG)
+	unittest.main()
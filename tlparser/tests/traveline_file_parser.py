@@ -0,0 +1,76 @@
+from ..database import connect
+from ..synthetic import write_zip
+from ..table_definitions import create_tables
+from ..traveline_file_parser import delete_source_rows, process_member
+from .synthetic import import_args
+import os
+import sqlite3
+import tempfile
+import unittest
+import zipfile
+
+class FailedCommit(unittest.TestCase):
+	def test_commit_fails(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			zip_filename = os.path.join(tmpdir, "SYN.zip")
+			write_zip(zip_filename, files=2, services=3, patterns=2, links=4, journeys=5, stops=50)
+			conn = connect("sqlite:" + os.path.join(tmpdir, "test.sqlite"))
+			with conn:
+				create_tables(conn)
+
+			# like a deferred foreign key failing at COMMIT
+			def failing_commit():
+				conn.rollback()
+				raise sqlite3.IntegrityError("FOREIGN KEY constraint failed")
+
+			with zipfile.ZipFile(zip_filename) as container:
+				first, second = container.namelist()
+				conn.commit = failing_commit
+				_, error = process_member(conn, container, first, "SYN.zip/" + first, import_args())
+				self.assertIn("IntegrityError", error)
+				del conn.commit
+
+				# the second file uses the same stops, whose atcocodes
+				# were rolled back
+				source_id, error = process_member(conn, container, second, "SYN.zip/" + second, import_args())
+				self.assertIsNone(error)
+				self.assertIsNotNone(source_id)
+
+			with conn.cursor() as cur:
+				cur.execute("""
+					SELECT count(1)
+					FROM jptiminglink
+					WHERE from_stoppoint NOT IN (SELECT atcocode_id FROM atcocode_intern)
+					OR to_stoppoint NOT IN (SELECT atcocode_id FROM atcocode_intern)
+				""")
+				self.assertEqual(list(cur), [(0,)])
+				cur.execute("SELECT count(1) FROM jptiminglink")
+				self.assertEqual(list(cur), [(3 * 2 * 4,)])
+			conn.close()
+
+
+class SharedOperator(unittest.TestCase):
+	def test_delete_one_file(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			zip_filename = os.path.join(tmpdir, "SYN.zip")
+			write_zip(zip_filename, files=1, services=1, patterns=1, links=2, journeys=1, stops=10)
+			conn = connect("sqlite:" + os.path.join(tmpdir, "test.sqlite"))
+			with conn:
+				create_tables(conn)
+
+			# the same operator, in two files
+			with zipfile.ZipFile(zip_filename) as container:
+				[name] = container.namelist()
+				first, _ = process_member(conn, container, name, "A.zip/" + name, import_args())
+				second, _ = process_member(conn, container, name, "B.zip/" + name, import_args())
+
+			with conn:
+				delete_source_rows(conn, first)
+			with conn.cursor() as cur:
+				cur.execute("SELECT source_id FROM operator")
+				self.assertEqual(list(cur), [(second,)])
+			conn.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,4 +1,6 @@
 from ..traveline_xml_parser import parse_single_vj_elem
+from ..traveline_xml_parser import duration_to_seconds
+from ..traveline_xml_parser import departuretime_to_seconds
 from ..traveline_xml_parser import NAMESPACES
 from lxml.etree import XML
 import unittest
@@ -32,6 +34,31 @@ class SingleVJ(unittest.TestCase):
 		self.assertEqual(days_bitmask, 0)
 
 
+class Durations(unittest.TestCase):
+	def test_duration_to_seconds(self):
+		self.assertEqual(duration_to_seconds("PT5M"), 300)
+		self.assertEqual(duration_to_seconds("PT45S"), 45)
+		self.assertEqual(duration_to_seconds("PT2M30S"), 150)
+		self.assertEqual(duration_to_seconds("PT1H5M"), 3900)
+		self.assertEqual(duration_to_seconds("PT1H"), 3600)
+		self.assertEqual(duration_to_seconds("P1DT30M"), 88200)
+		self.assertEqual(duration_to_seconds("PT0.5S"), 0)
+		self.assertEqual(duration_to_seconds("PT1.5M"), 90)
+		self.assertEqual(duration_to_seconds("PT0S"), 0)
+
+	def test_duration_nonsense(self):
+		self.assertEqual(duration_to_seconds(None), None)
+		self.assertEqual(duration_to_seconds(""), None)
+		self.assertEqual(duration_to_seconds("P"), None)
+		self.assertEqual(duration_to_seconds("PT"), None)
+		self.assertEqual(duration_to_seconds("P1M"), None)
+		self.assertEqual(duration_to_seconds("5 minutes"), None)
+
+	def test_departuretime_to_seconds(self):
+		self.assertEqual(departuretime_to_seconds("08:48:00"), 8 * 3600 + 48 * 60)
+		self.assertEqual(departuretime_to_seconds("23:59:59"), 86399)
+
+
 if __name__ == '__main__':
 	logging.basicConfig(level=logging.DEBUG)
 	unittest.main()
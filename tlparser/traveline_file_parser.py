@@ -1,11 +1,22 @@
 #!/usr/bin/python3
 
+import collections
 import logging
+import multiprocessing
+import multiprocessing.util
 import os
+import traceback
 import zipfile
 
+from .bulk_writer import bulk_writer
+from .database import connect, is_sqlite
+from .intern_cache import intern_cache, log_stats
+from .link_frequency import mark_source_dirty
+from .profiling import Profiler, summary
+from .row_cache import RowCache
+from .table_definitions import SOURCE_TABLES, upgrade_tables
 from .xmlparser import process_xml_file
-from .traveline_xml_parser import add_service, add_vehiclejourney, add_journeypatternsection, add_operator, add_stoppoint, add_routesection, add_route
+from .traveline_xml_parser import NAMESPACES, add_service, add_vehiclejourney, add_journeypatternsection, add_operator, add_stoppoint, add_routesection, add_route
 
 
 PARSERS = {
@@ -19,9 +30,77 @@ PARSERS = {
 }
 
 def process_all_files(conn, args, test_data_only=False):
+	with conn:
+		upgrade_tables(conn)
+	cache = intern_cache(conn)
+	cache.preload_atcocodes()
+	configure_writer(conn, args)
+	profiler = make_profiler(args)
 	for zip_filename in list_zip_filenames():
 		logging.info("Processing zip file %s...", zip_filename)
-		process_zipfile(conn, zip_filename, test_data_only, args)
+		process_zipfile(conn, zip_filename, test_data_only, args, profiler)
+	cache.log_stats()
+	if profiler is not None:
+		summary(conn, args.profile, args.profile_run_started, args.profile_dumps)
+
+def process_all_files_parallel(jobs, args, test_data_only=False):
+	"""Like process_all_files, but farms the xml files out to `jobs` processes.
+
+	Each worker has its own connection, and each xml file is still its
+	own transaction, so this is just as safe to Ctrl+C. The rows which
+	are shared between files (atcocodes and stoppoints) are committed
+	on a second connection, so the workers don't hold locks on them
+	for a whole file (see InternCache.use_shared_connection).
+	"""
+	conn = connect(args.database)
+	with conn:
+		upgrade_tables(conn)
+	# don't share a connection with the workers
+	conn.close()
+
+	zip_filenames = list_zip_filenames()
+	members = [
+		(zip_filename, contentname, source)
+		for zip_filename in zip_filenames
+		for contentname, source in list_members(zip_filename, test_data_only)]
+	logging.info("Processing %d files with %d workers...", len(members), jobs)
+
+	hits = collections.Counter()
+	misses = collections.Counter()
+	with multiprocessing.Pool(jobs, initializer=_worker_init, initargs=(args,)) as pool:
+		results = pool.imap_unordered(_worker_process_member, members, chunksize=4)
+		for done, (source, source_id, error, file_hits, file_misses) in enumerate(results, 1):
+			log_result(source, source_id, error)
+			hits.update(file_hits)
+			misses.update(file_misses)
+			if done % 100 == 0:
+				logging.info("Processed %d of %d files", done, len(members))
+		# (rather than terminate, so the workers tidy up)
+		pool.close()
+		pool.join()
+	log_stats(hits, misses)
+
+	if not test_data_only or args.profile:
+		conn = connect(args.database)
+		if not test_data_only:
+			for zip_filename in zip_filenames:
+				delete_missing_sources(conn, zip_filename, [
+					source for member_zip_filename, _, source in members
+					if member_zip_filename == zip_filename])
+		if args.profile:
+			summary(conn, args.profile, args.profile_run_started, args.profile_dumps)
+		conn.close()
+
+def configure_writer(conn, args):
+	writer = bulk_writer(conn)
+	writer.threshold = args.copy_batch_rows
+	if args.pipeline:
+		writer.pipeline(args.pipeline)
+
+def make_profiler(args):
+	if not args.profile:
+		return None
+	return Profiler(args.profile, args.profile_run_started, args.profile_dumps)
 
 def list_zip_filenames():
 	return [
@@ -29,44 +108,226 @@ def list_zip_filenames():
 		for name in os.listdir("travelinedata/")
 		if name.endswith(".zip")]
 
-def process_zipfile(conn, zip_filename, test_data_only, args):
+def list_members(zip_filename, test_data_only):
 	with zipfile.ZipFile(zip_filename) as container:
 		for contentname in container.namelist():
 			source = zip_filename.split("/")[-1] + "/" + contentname
 			if test_data_only and not test_data_filter(source):
 				continue
+			yield contentname, source
+
+def process_zipfile(conn, zip_filename, test_data_only, args, profiler=None):
+	sources = []
+	with zipfile.ZipFile(zip_filename) as container:
+		for contentname, source in list_members(zip_filename, test_data_only):
+			source_id, error = process_member(conn, container, contentname, source, args, profiler)
+			log_result(source, source_id, error)
+			sources.append(source)
+	if not test_data_only:
+		delete_missing_sources(conn, zip_filename, sources)
 
-			with conn as transaction_conn:
+def process_member(conn, container, contentname, source, args, profiler=None):
+	"""Imports one xml file from the zip, in a transaction of its own.
 
-				# We don't know if we'll be told about things in the correct order
-				# but each file should be self-consistent
+	Returns the new source_id (None if we've already imported this
+	file, and it hasn't changed since) and the traceback if something
+	went wrong. If there's a profiler, the stats for the file are
+	written afterwards, in another transaction.
+	"""
+	zipinfo = container.getinfo(contentname)
+	row_cache = RowCache(args.row_cache, args) if args.row_cache else None
+	error = None
+	source_id = None
+	try:
+		with conn as transaction_conn:
+
+			# We don't know if we'll be told about things in the correct order
+			# but each file should be self-consistent
+			if not is_sqlite(transaction_conn):
 				with transaction_conn.cursor() as cur:
 					cur.execute("SET CONSTRAINTS ALL DEFERRED;")
 
-				source_id = source_id_if_not_already_inserted(transaction_conn, source)
-				if source_id:
-					with container.open(contentname) as xmlfile:
-						try:
-							logging.info("Processing file %s (%r)", source, source_id)
-							process_xml_file(xmlfile, PARSERS, args=(transaction_conn, source_id, args))
-						except Exception:
-							logging.exception("Skipping file %s (%r)", source, source_id)
+			source_id = source_id_if_not_already_inserted(transaction_conn, source, zipinfo.CRC, zipinfo.file_size)
+			if source_id:
+				writer = bulk_writer(transaction_conn)
+				writer.reset_stats()
+				parsers = PARSERS if profiler is None else profiler.start(source, PARSERS, writer)
+				cached_rows = row_cache.load(zipinfo) if row_cache is not None else None
+				try:
+					if cached_rows is not None:
+						logging.debug("Loading %s from the row cache", source)
+						row_cache.replay(transaction_conn, source_id, cached_rows, writer)
+					else:
+						if row_cache is not None:
+							writer.recording = collections.defaultdict(list)
+						with container.open(contentname) as xmlfile:
+							process_xml_file(
+								xmlfile, parsers, args=(transaction_conn, source_id, args),
+								namespace=NAMESPACES["tx"], buffer_size=args.read_buffer_size)
+					writer.flush()
+					if writer.recording is not None:
+						row_cache.save(zipinfo, transaction_conn, source_id, writer.recording)
+				except Exception:
+					error = traceback.format_exc()
+					writer.discard()
+				finally:
+					writer.recording = None
+				if profiler is not None:
+					profiler.finish(writer)
+				if writer.queue is not None:
+					stats = writer.pipeline_stats()
+					logging.info(
+						"Pipeline for %s: parser busy %.2fs idle %.2fs, writer busy %.2fs idle %.2fs",
+						source, stats["parser_busy"], stats["parser_idle"], stats["writer_busy"], stats["writer_idle"])
+				intern_cache(transaction_conn).finish_source(source_id, failed=error is not None)
+				if error is not None:
+					# don't keep half a file
+					transaction_conn.rollback()
+	except Exception:
+		# eg: a deferred foreign key which failed at COMMIT, so
+		# everything (including any new atcocodes) was rolled back
+		error = traceback.format_exc()
+		intern_cache(conn).rolled_back()
+	if source_id and profiler is not None:
+		profiler.save(conn, source_id, error)
+	return source_id, error
+
+def log_result(source, source_id, error):
+	if error is not None:
+		logging.error("Skipping file %s (%r)\n%s", source, source_id, error)
+	elif source_id is None:
+		logging.debug("Already processed file %s", source)
+	else:
+		logging.info("Processed file %s (%r)", source, source_id)
+
+
+_worker = {}
+
+def _worker_init(args):
+	conn = connect(args.database)
+	cache = intern_cache(conn)
+	if not is_sqlite(conn):
+		cache.use_shared_connection(connect(args.database))
+	cache.preload_atcocodes()
+	configure_writer(conn, args)
+	_worker.update(conn=conn, args=args, zip_filename=None, container=None, profiler=make_profiler(args))
+	multiprocessing.util.Finalize(None, _worker_exit, exitpriority=10)
+
+def _worker_exit():
+	if _worker["container"] is not None:
+		_worker["container"].close()
+	shared_conn = intern_cache(_worker["conn"]).shared_conn
+	if shared_conn is not None:
+		shared_conn.close()
+	_worker["conn"].close()
+
+def _worker_container(zip_filename):
+	# the members arrive more or less a zip at a time
+	if _worker["zip_filename"] != zip_filename:
+		if _worker["container"] is not None:
+			_worker["container"].close()
+		_worker["container"] = zipfile.ZipFile(zip_filename)
+		_worker["zip_filename"] = zip_filename
+	return _worker["container"]
+
+def _worker_process_member(member):
+	zip_filename, contentname, source = member
+	cache = intern_cache(_worker["conn"])
+	hits = cache.hits.copy()
+	misses = cache.misses.copy()
+	try:
+		source_id, error = process_member(_worker["conn"], _worker_container(zip_filename), contentname, source, _worker["args"], _worker["profiler"])
+	except Exception:
+		# eg: lost the database connection. Tell the parent rather
+		# than killing the whole pool.
+		source_id, error = None, traceback.format_exc()
+	return source, source_id, error, cache.hits - hits, cache.misses - misses
 
 
 def test_data_filter(source):
 	return source.startswith("SE.zip/set_5-")
 
 
-def source_id_if_not_already_inserted(conn, source):
+def source_id_if_not_already_inserted(conn, source, crc32=None, file_size=None):
+	"""The source_id to import this file into, or None to skip it.
+
+	If the file has changed since we imported it, the old rows are
+	deleted (in this transaction) and the source_id is re-used.
+	"""
 	with conn.cursor() as cur:
 		cur.execute("""
-			insert into source(source) values (%s)
+			insert into source(source, crc32, file_size) values (%s, %s, %s)
 			on conflict do nothing
 			returning source_id
-			""", (source,))
+			""", (source, crc32, file_size,))
 		rows = list(cur)
-		if len(rows) == 0:
-			return None
-		else:
+		if len(rows) == 1:
 			[[source_id]] = rows
+			intern_cache(conn).new_source(source_id)
+			mark_source_dirty(conn, source_id)
 			return source_id
+
+		# (sqlite locks the whole file for writing anyway)
+		cur.execute("""
+			select source_id, crc32, file_size
+			from source
+			where source = %%s
+			%s
+			""" % ("" if is_sqlite(conn) else "for update",), (source,))
+		[[source_id, old_crc32, old_file_size]] = list(cur)
+		if old_crc32 is None:
+			# imported before we kept checksums: assume it's the same
+			cur.execute("""
+				update source set crc32 = %s, file_size = %s
+				where source_id = %s
+				""", (crc32, file_size, source_id,))
+			return None
+		if (old_crc32, old_file_size) == (crc32, file_size):
+			return None
+
+		logging.info("File %s (%r) has changed, replacing it", source, source_id)
+		delete_source_rows(conn, source_id)
+		cur.execute("""
+			update source set crc32 = %s, file_size = %s
+			where source_id = %s
+			""", (crc32, file_size, source_id,))
+		intern_cache(conn).new_source(source_id)
+		return source_id
+
+
+def delete_source_rows(conn, source_id):
+	intern_cache(conn).forget_source(source_id)
+	mark_source_dirty(conn, source_id)
+	with conn.cursor() as cur:
+		for tablename in SOURCE_TABLES:
+			cur.execute("""
+				DELETE FROM %(tablename)s
+				WHERE source_id = %%s
+			""" % dict(tablename=tablename), (source_id,))
+
+
+def delete_missing_sources(conn, zip_filename, sources):
+	"""Removes files which used to be in this zip, but aren't any more"""
+	prefix = zip_filename.split("/")[-1] + "/"
+	with conn.cursor() as cur:
+		cur.execute("""
+			select source_id, source
+			from source
+			""")
+		sources = set(sources)
+		missing = [
+			(source_id, source)
+			for source_id, source in cur
+			if source.startswith(prefix) and source not in sources]
+	for source_id, source in missing:
+		with conn as transaction_conn:
+			logging.info("File %s (%r) has gone, deleting it", source, source_id)
+			if not is_sqlite(transaction_conn):
+				with transaction_conn.cursor() as cur:
+					cur.execute("SET CONSTRAINTS ALL DEFERRED;")
+			delete_source_rows(transaction_conn, source_id)
+			with transaction_conn.cursor() as cur:
+				cur.execute("""
+					DELETE FROM source
+					WHERE source_id = %s
+				""", (source_id,))
@@ -1,235 +1,267 @@
 #!/usr/bin/python3
 
 import datetime
+import functools
 import logging
+import re
+import weakref
+from lxml import etree
+from .bulk_writer import bulk_writer
+from .extract import Extractor
+from .operating_days import MON, TUE, WED, THUR, FRI, SAT, SUN, parse_date, days_mask_for_week, operating_bitmap, operating_window, outside_period
 from .table_definitions import interned_journeypattern, interned_jpsection, interned_jptiminglink, interned_vjcode, interned_service, interned_line, interned_route, interned_routelink, interned_atcocode
 
 NAMESPACES = {
 	"tx": "http://www.transxchange.org.uk/",
 }
 
-def maybe_one(many):
-	if len(many) == 1:
-		return many[0]
-	if len(many) == 0:
-		return None
-	raise ValueError(many)
+def elements(path):
+	return etree.XPath(path, namespaces=NAMESPACES)
+
+def fields():
+	return Extractor(NAMESPACES)
+
+OPERATOR_FIELDS = fields().one("./tx:OperatorShortName/text()")
 
 def add_operator(elem, conn, source_id, _args):
 	operator_id = elem.get("id")
-	[shortname] = elem.xpath("./tx:OperatorShortName/text()", namespaces=NAMESPACES)
-	with conn.cursor() as cur:
-		cur.execute("""
-			INSERT INTO operator(source_id, operator_id, shortname)
-			VALUES (%s, %s, %s)
-			ON CONFLICT DO NOTHING
-		""", (source_id, operator_id, shortname,))
+	[shortname] = OPERATOR_FIELDS(elem)
+	bulk_writer(conn).add("operator", (source_id, operator_id, shortname,))
+
 
+SERVICE_FIELDS = (fields()
+	.one("./tx:ServiceCode/text()")
+	.maybe_one("./tx:PrivateCode/text()")
+	.maybe_one("./tx:Mode/text()")
+	.maybe_one("./tx:Description/text()")
+	.one("./tx:RegisteredOperatorRef/text()"))
+SERVICE_PERIOD_FIELDS = (fields()
+	.maybe_one("./tx:OperatingPeriod/tx:StartDate/text()")
+	.maybe_one("./tx:OperatingPeriod/tx:EndDate/text()"))
+SERVICE_LINES = elements("./tx:Lines/tx:Line")
+LINE_FIELDS = fields().one("./tx:LineName/text()")
+SERVICE_JOURNEYPATTERNS = elements("./tx:StandardService/tx:JourneyPattern")
+JOURNEYPATTERN_FIELDS = (fields()
+	.one("./tx:Direction/text()")
+	.maybe_one("./tx:RouteRef/text()")
+	.all("./tx:JourneyPatternSectionRefs/text()"))
+
+# The OperatingPeriod of each servicecode in the file being parsed (the
+# Services come before the VehicleJourneys)
+_OPERATING_PERIODS = weakref.WeakKeyDictionary()
+
+def operating_periods(conn, source_id):
+	try:
+		periods_source_id, periods = _OPERATING_PERIODS[conn]
+	except KeyError:
+		periods_source_id = None
+	if periods_source_id != source_id:
+		periods = {}
+		_OPERATING_PERIODS[conn] = (source_id, periods)
+	return periods
 
 def add_service(elem, conn, source_id, _args):
-	[servicecode] = elem.xpath("./tx:ServiceCode/text()", namespaces=NAMESPACES)
-	privatecode = maybe_one(elem.xpath("./tx:PrivateCode/text()", namespaces=NAMESPACES))
-	mode = maybe_one(elem.xpath("./tx:Mode/text()", namespaces=NAMESPACES))
-	description = maybe_one(elem.xpath("./tx:Description/text()", namespaces=NAMESPACES))
-	[operator] = elem.xpath("./tx:RegisteredOperatorRef/text()", namespaces=NAMESPACES)
-
-	with conn.cursor() as cur:
-		service_id = interned_service(conn, source_id, servicecode)
-		cur.execute("""
-			INSERT INTO service(source_id, service_id, privatecode, mode, operator_id, description)
-			VALUES (%s, %s, %s, %s, %s, %s)
-		""", (source_id, service_id, privatecode, mode, operator, description))
-
-	for lineelem in elem.xpath("./tx:Lines/tx:Line", namespaces=NAMESPACES):
+	servicecode, privatecode, mode, description, operator = SERVICE_FIELDS(elem)
+	start, end = SERVICE_PERIOD_FIELDS(elem)
+	if start is not None:
+		operating_periods(conn, source_id)[servicecode] = (parse_date(start), parse_date(end) if end is not None else None)
+
+	writer = bulk_writer(conn)
+	service_id = interned_service(conn, source_id, servicecode)
+	writer.add("service", (source_id, service_id, privatecode, mode, operator, description))
+
+	for lineelem in SERVICE_LINES(elem):
 		linecode = lineelem.get("id")
-		[line_name] = lineelem.xpath("./tx:LineName/text()", namespaces=NAMESPACES)	
-		with conn.cursor() as cur:
-			line_id = interned_line(conn, source_id, linecode)
-			cur.execute("""
-				INSERT INTO line(source_id, line_id, servicecode, line_name)
-				VALUES (%s, %s, %s, %s)
-			""", (source_id, line_id, servicecode, line_name))
-
-	for jpelem in elem.xpath("./tx:StandardService/tx:JourneyPattern", namespaces=NAMESPACES):
+		[line_name] = LINE_FIELDS(lineelem)
+		line_id = interned_line(conn, source_id, linecode)
+		writer.add("line", (source_id, line_id, servicecode, line_name))
+
+	for jpelem in SERVICE_JOURNEYPATTERNS(elem):
 		jpref = jpelem.get("id")
-		[direction] = jpelem.xpath("./tx:Direction/text()", namespaces=NAMESPACES)
-		routeref = maybe_one(jpelem.xpath("./tx:RouteRef/text()", namespaces=NAMESPACES))
-		jpsectionrefs = jpelem.xpath("./tx:JourneyPatternSectionRefs/text()", namespaces=NAMESPACES)
-		with conn.cursor() as cur:
-			jpintern = interned_journeypattern(conn, source_id, jpref)
-			routeintern = interned_route(conn, source_id, routeref) if routeref is not None else None
-			cur.execute("""
-				INSERT INTO journeypattern_service(source_id, journeypattern_id, service_id, route_id, direction)
-				VALUES (%s, %s, %s, %s, %s)
-			""", (source_id, jpintern, service_id, routeintern, direction))
-
-			for jpsectionref in jpsectionrefs:
-				jpsectionintern = interned_jpsection(conn, source_id, jpsectionref)
-				cur.execute("""
-					INSERT INTO journeypattern_service_section(source_id, jpsection_id, journeypattern_id)
-					VALUES (%s, %s, %s)
-				""", (source_id, jpsectionintern, jpintern))
+		direction, routeref, jpsectionrefs = JOURNEYPATTERN_FIELDS(jpelem)
+		jpintern = interned_journeypattern(conn, source_id, jpref)
+		routeintern = interned_route(conn, source_id, routeref) if routeref is not None else None
+		writer.add("journeypattern_service", (source_id, jpintern, service_id, routeintern, direction))
+
+		for section_sequence, jpsectionref in enumerate(jpsectionrefs):
+			jpsectionintern = interned_jpsection(conn, source_id, jpsectionref)
+			writer.add("journeypattern_service_section", (source_id, jpsectionintern, jpintern, section_sequence))
+
+
+SECTION_TIMINGLINKS = elements("./tx:JourneyPatternTimingLink")
+TIMINGLINK_FIELDS = (fields()
+	.maybe_one("./tx:RouteLinkRef/text()")
+	.one("./tx:RunTime/text()")
+	.maybe_one("./tx:From/@SequenceNumber")
+	.maybe_one("./tx:To/@SequenceNumber")
+	.one("./tx:From/tx:StopPointRef/text()")
+	.one("./tx:To/tx:StopPointRef/text()"))
 
 def add_journeypatternsection(elem, conn, source_id, _args):
 	jpsection = elem.get("id")
-	with conn.cursor() as cur:
-		jpsectionintern = interned_jpsection(conn, source_id, jpsection)
+	writer = bulk_writer(conn)
+	jpsectionintern = interned_jpsection(conn, source_id, jpsection)
 
-	for jptl in elem.xpath("./tx:JourneyPatternTimingLink", namespaces=NAMESPACES):
+	for jptl in SECTION_TIMINGLINKS(elem):
 		jptiminglink = jptl.get("id")
-		routelinkref = maybe_one(jptl.xpath("./tx:RouteLinkRef/text()", namespaces=NAMESPACES))
-		[runtime] = jptl.xpath("./tx:RunTime/text()", namespaces=NAMESPACES)
-		from_sequence = maybe_one(jptl.xpath("./tx:From/@SequenceNumber", namespaces=NAMESPACES))
-		to_sequence = maybe_one(jptl.xpath("./tx:To/@SequenceNumber", namespaces=NAMESPACES))
-		[from_stoppoint] = jptl.xpath("./tx:From/tx:StopPointRef/text()", namespaces=NAMESPACES)
-		[to_stoppoint] = jptl.xpath("./tx:To/tx:StopPointRef/text()", namespaces=NAMESPACES)
-		with conn.cursor() as cur:
-			jptiminglinkintern = interned_jptiminglink(conn, source_id, jptiminglink)
-			routelinkintern = interned_routelink(conn, source_id, routelinkref) if routelinkref is not None else None
-			from_stoppoint_id = interned_atcocode(conn, from_stoppoint)
-			to_stoppoint_id = interned_atcocode(conn, to_stoppoint)
-			cur.execute("""
-				INSERT INTO jptiminglink(source_id, jptiminglink_id, jpsection_id, routelink_id, runtime, from_sequence, from_stoppoint, to_sequence, to_stoppoint)
-				VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-			""", (source_id, jptiminglinkintern, jpsectionintern, routelinkintern, runtime, from_sequence, from_stoppoint_id, to_sequence, to_stoppoint_id))
-
-def parse_date(date_str):
-	return datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+		routelinkref, runtime, from_sequence, to_sequence, from_stoppoint, to_stoppoint = TIMINGLINK_FIELDS(jptl)
+		jptiminglinkintern = interned_jptiminglink(conn, source_id, jptiminglink)
+		routelinkintern = interned_routelink(conn, source_id, routelinkref) if routelinkref is not None else None
+		from_stoppoint_id = interned_atcocode(conn, from_stoppoint)
+		to_stoppoint_id = interned_atcocode(conn, to_stoppoint)
+		writer.add("jptiminglink", (source_id, jptiminglinkintern, jpsectionintern, routelinkintern, runtime, from_sequence, from_stoppoint_id, to_sequence, to_stoppoint_id, duration_to_seconds(runtime)))
 
-def parse_single_vj_elem(elem, monday_of_desired_week):
-	[vjcode] = elem.xpath("./tx:VehicleJourneyCode/text()", namespaces=NAMESPACES)
+# xsd:duration, without years or months (which aren't a fixed length)
+DURATION = re.compile(
+	r"^P(?:([0-9]+(?:\.[0-9]+)?)W)?(?:([0-9]+(?:\.[0-9]+)?)D)?"
+	r"(?:T(?:([0-9]+(?:\.[0-9]+)?)H)?(?:([0-9]+(?:\.[0-9]+)?)M)?(?:([0-9]+(?:\.[0-9]+)?)S)?)?$")
+
+@functools.lru_cache(maxsize=1024)
+def duration_to_seconds(duration):
+	"""Seconds in a RunTime like "PT1H5M30S", or None if it doesn't make sense"""
+	match = DURATION.match(duration) if duration is not None else None
+	if match is None or not any(match.groups()):
+		return None
+	weeks, days, hours, minutes, seconds = (float(value or 0) for value in match.groups())
+	return int(round(((weeks * 7 + days) * 24 + hours) * 3600 + minutes * 60 + seconds))
+
+DAYS_OF_WEEK_TAGS = {
+	'{http://www.transxchange.org.uk/}MondayToFriday': MON|TUE|WED|THUR|FRI,
+	'{http://www.transxchange.org.uk/}MondayToSaturday': MON|TUE|WED|THUR|FRI|SAT,
+	'{http://www.transxchange.org.uk/}MondayToSunday': MON|TUE|WED|THUR|FRI|SAT|SUN,
+	'{http://www.transxchange.org.uk/}Saturday': SAT,
+	'{http://www.transxchange.org.uk/}Sunday': SUN,
+	'{http://www.transxchange.org.uk/}Monday': MON,
+	'{http://www.transxchange.org.uk/}Tuesday': TUE,
+	'{http://www.transxchange.org.uk/}Wednesday': WED,
+	'{http://www.transxchange.org.uk/}Thursday': THUR,
+	'{http://www.transxchange.org.uk/}Friday': FRI,
+}
+
+VEHICLEJOURNEY_FIELDS = (fields()
+	.one("./tx:VehicleJourneyCode/text()")
+	.maybe_one("./tx:JourneyPatternRef/text()")
+	.maybe_one("./tx:VehicleJourneyRef/text()")
+	.one("./tx:LineRef/text()")
+	.maybe_one("./tx:PrivateCode/text()")
+	.one("./tx:DepartureTime/text()"))
+VEHICLEJOURNEY_SERVICE_FIELDS = fields().maybe_one("./tx:ServiceRef/text()")
+VEHICLEJOURNEY_DAYS_OF_WEEK = elements("./tx:OperatingProfile/tx:RegularDayType/tx:DaysOfWeek/*")
+VEHICLEJOURNEY_DAYS_OF_NON_OPERATION = elements("./tx:OperatingProfile/tx:SpecialDaysOperation/tx:DaysOfNonOperation/tx:DateRange")
+DATERANGE_FIELDS = (fields()
+	.one("./tx:StartDate/text()")
+	.one("./tx:EndDate/text()"))
 
+def parse_vj_elem(elem):
+	"""The fields of a VehicleJourney, and the days it runs on
+
+	Returns a days_mask of the regular days, and a list of (start, end)
+	dates when it doesn't run after all.
+	"""
 	# a vehiclejourney will either have a reference to a journeypattern...
-	jpref_id = maybe_one(elem.xpath("./tx:JourneyPatternRef/text()", namespaces=NAMESPACES))
 	# ... or a reference to another vehiclejourney (which hopefully has a reference to a journeypattern)
-	other_vjcode = maybe_one(elem.xpath("./tx:VehicleJourneyRef/text()", namespaces=NAMESPACES))
+	vjcode, jpref_id, other_vjcode, linecode, privatecode, departuretime = VEHICLEJOURNEY_FIELDS(elem)
 	# (let's check this is really true...)
 	assert (
 		(other_vjcode is None and jpref_id is not None) or
 		(other_vjcode == vjcode and jpref_id is not None) or
 		(other_vjcode != vjcode and jpref_id is None))
 
-	[linecode] = elem.xpath("./tx:LineRef/text()", namespaces=NAMESPACES)
-	privatecode = maybe_one(elem.xpath("./tx:PrivateCode/text()", namespaces=NAMESPACES))
-	[departuretime] = elem.xpath("./tx:DepartureTime/text()", namespaces=NAMESPACES)
-
-	MON = 1<<0
-	TUE = 1<<1
-	WED = 1<<2
-	THUR = 1<<3
-	FRI = 1<<4
-	SAT = 1<<5
-	SUN = 1<<6
-	days_bitmask = 0
-	for days in elem.xpath("./tx:OperatingProfile/tx:RegularDayType/tx:DaysOfWeek/*", namespaces=NAMESPACES):
-		if days.tag == '{http://www.transxchange.org.uk/}MondayToFriday':
-			days_bitmask |= MON|TUE|WED|THUR|FRI
-		elif days.tag == '{http://www.transxchange.org.uk/}MondayToSaturday':
-			days_bitmask |= MON|TUE|WED|THUR|FRI|SAT
-		elif days.tag == '{http://www.transxchange.org.uk/}MondayToSunday':
-			days_bitmask |= MON|TUE|WED|THUR|FRI|SAT|SUN
-		elif days.tag == '{http://www.transxchange.org.uk/}Saturday':
-			days_bitmask |= SAT
-		elif days.tag == '{http://www.transxchange.org.uk/}Sunday':
-			days_bitmask |= SUN
-		elif days.tag == '{http://www.transxchange.org.uk/}Monday':
-			days_bitmask |= MON
-		elif days.tag == '{http://www.transxchange.org.uk/}Tuesday':
-			days_bitmask |= TUE
-		elif days.tag == '{http://www.transxchange.org.uk/}Wednesday':
-			days_bitmask |= WED
-		elif days.tag == '{http://www.transxchange.org.uk/}Thursday':
-			days_bitmask |= THUR
-		elif days.tag == '{http://www.transxchange.org.uk/}Friday':
-			days_bitmask |= FRI
-		else:
+	regular_days = 0
+	for days in VEHICLEJOURNEY_DAYS_OF_WEEK(elem):
+		try:
+			regular_days |= DAYS_OF_WEEK_TAGS[days.tag]
+		except KeyError:
 			raise ValueError(days.tag)
 
-
 	# When chaning the service pattern, some routes list the service twice,
 	# and exclude the "wrong" timetable.
 	# For example, when re-timing a saturday service, one operator added a
 	# DaysOfNonOperation for each individual saturday on one or other of
 	# the timetables.
-	assert monday_of_desired_week.weekday() == 0
-	exact_date_to_bitmask = {
-		monday_of_desired_week: MON,
-		monday_of_desired_week + datetime.timedelta(days=1): TUE,
-		monday_of_desired_week + datetime.timedelta(days=2): WED,
-		monday_of_desired_week + datetime.timedelta(days=3): THUR,
-		monday_of_desired_week + datetime.timedelta(days=4): FRI,
-		monday_of_desired_week + datetime.timedelta(days=5): SAT,
-		monday_of_desired_week + datetime.timedelta(days=6): SUN,
-	}
-	for non_days in elem.xpath("./tx:OperatingProfile/tx:SpecialDaysOperation/tx:DaysOfNonOperation/tx:DateRange", namespaces=NAMESPACES):
-		[exclude_start] = [parse_date(date) for date in non_days.xpath("./tx:StartDate/text()", namespaces=NAMESPACES)]
-		[exclude_end] = [parse_date(date) for date in non_days.xpath("./tx:EndDate/text()", namespaces=NAMESPACES)]
-		exclude_date = exclude_start
-		while exclude_date <= exclude_end:
-			remove_bits = exact_date_to_bitmask.get(exclude_date, 0)
-			days_bitmask &= ~remove_bits
-			exclude_date += datetime.timedelta(days=1)
-
-	departuretime_time = datetime.datetime.strptime(departuretime, "%H:%M:%S").time()
+	non_operation = [
+		tuple(parse_date(date) for date in DATERANGE_FIELDS(non_days))
+		for non_days in VEHICLEJOURNEY_DAYS_OF_NON_OPERATION(elem)]
 
+	return privatecode, jpref_id, vjcode, other_vjcode, linecode, departuretime, regular_days, non_operation
+
+def parse_single_vj_elem(elem, monday_of_desired_week):
+	privatecode, jpref_id, vjcode, other_vjcode, linecode, departuretime, regular_days, non_operation = parse_vj_elem(elem)
+	days_bitmask = days_mask_for_week(regular_days, non_operation, monday_of_desired_week)
 	return [privatecode, jpref_id, vjcode, other_vjcode, linecode, days_bitmask, departuretime]
 
+def departuretime_to_seconds(departuretime):
+	departuretime_time = datetime.time.fromisoformat(departuretime)
+	return (departuretime_time.hour * 3600) + (departuretime_time.minute * 60) + departuretime_time.second
+
 def add_vehiclejourney(elem, conn, source_id, args):
-	monday_of_desired_week = parse_date(args.monday_of_desired_week)
-	[privatecode, jpref_id, vjcode, other_vjcode, linecode, days_bitmask, departuretime] = parse_single_vj_elem(elem, monday_of_desired_week)
+	privatecode, jpref_id, vjcode, other_vjcode, linecode, departuretime, regular_days, non_operation = parse_vj_elem(elem)
+
+	# the bitmap covers the service's OperatingPeriod, if we know it
+	[serviceref] = VEHICLEJOURNEY_SERVICE_FIELDS(elem)
+	period = operating_periods(conn, source_id).get(serviceref)
+	if period is None:
+		operating_from, days = parse_date(args.calendar_start), args.calendar_days
+	else:
+		operating_from, days = operating_window(*period, parse_date(args.calendar_start), args.calendar_days)
+		non_operation = non_operation + outside_period(*period)
 
-	departuretime_seconds = (departuretime_time.hour * 3600) + (departuretime_time.minute * 60) + departuretime_time.second
+	# days_mask is only filled in if you ask for a --target-week
+	if args.monday_of_desired_week:
+		days_bitmask = days_mask_for_week(regular_days, non_operation, parse_date(args.monday_of_desired_week))
+	else:
+		days_bitmask = None
+	operating_days = operating_bitmap(regular_days, non_operation, operating_from, days)
 
-	with conn.cursor() as cur:
-		jpintern = interned_journeypattern(conn, source_id, jpref_id) if jpref_id is not None else None
-		vjintern = interned_vjcode(conn, source_id, vjcode) if vjcode is not None else None
-		lineintern = interned_line(conn, source_id, linecode)
-		othervjintern = interned_vjcode(conn, source_id, other_vjcode) if other_vjcode is not None else None
-		cur.execute("""
-			INSERT INTO vehiclejourney(source_id, vjcode_id, other_vjcode_id, journeypattern_id, line_id, privatecode, days_mask, deptime, deptime_seconds)
-			VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s)
-		""", (source_id, vjintern, othervjintern, jpintern, lineintern, privatecode, days_bitmask, departuretime, departuretime_seconds))
+	departuretime_seconds = departuretime_to_seconds(departuretime)
+
+	jpintern = interned_journeypattern(conn, source_id, jpref_id) if jpref_id is not None else None
+	vjintern = interned_vjcode(conn, source_id, vjcode) if vjcode is not None else None
+	lineintern = interned_line(conn, source_id, linecode)
+	othervjintern = interned_vjcode(conn, source_id, other_vjcode) if other_vjcode is not None else None
+	bulk_writer(conn).add("vehiclejourney", (source_id, vjintern, othervjintern, jpintern, lineintern, privatecode, days_bitmask, departuretime, departuretime_seconds, operating_from, operating_days))
+
+
+ROUTE_FIELDS = (fields()
+	.maybe_one("./tx:PrivateCode/text()")
+	.one("./tx:Description/text()")
+	.one("./tx:RouteSectionRef/text()"))
 
 def add_route(elem, conn, source_id, _args):
 	routecode = elem.get("id")
-	privatecode = maybe_one(elem.xpath("./tx:PrivateCode/text()", namespaces=NAMESPACES))
-	[description] = elem.xpath("./tx:Description/text()", namespaces=NAMESPACES)
-	[routesection] = elem.xpath("./tx:RouteSectionRef/text()", namespaces=NAMESPACES)
+	privatecode, description, routesection = ROUTE_FIELDS(elem)
+
+	route_id = interned_route(conn, source_id, routecode)
+	bulk_writer(conn).add("route", (source_id, route_id, privatecode, routesection, description,))
 
-	with conn.cursor() as cur:
-		route_id = interned_route(conn, source_id, routecode)
-		cur.execute("""
-			INSERT INTO route(source_id, route_id, privatecode, routesection, description)
-			VALUES (%s, %s, %s, %s, %s)
-		""", (source_id, route_id, privatecode, routesection, description,))
+
+SECTION_ROUTELINKS = elements("./tx:RouteLink")
+ROUTELINK_FIELDS = (fields()
+	.one("./tx:From/tx:StopPointRef/text()")
+	.one("./tx:To/tx:StopPointRef/text()")
+	.one("./tx:Direction/text()"))
 
 def add_routesection(elem, conn, source_id, _args):
 	routesection = elem.get("id")
-	for linkelem in elem.xpath("./tx:RouteLink", namespaces=NAMESPACES):
+	writer = bulk_writer(conn)
+	for linkelem in SECTION_ROUTELINKS(elem):
 		routelinkcode = linkelem.get("id")
-		[from_stoppoint] = linkelem.xpath("./tx:From/tx:StopPointRef/text()", namespaces=NAMESPACES)
-		[to_stoppoint] = linkelem.xpath("./tx:To/tx:StopPointRef/text()", namespaces=NAMESPACES)
-		[direction] = linkelem.xpath("./tx:Direction/text()", namespaces=NAMESPACES)
-
-		with conn.cursor() as cur:
-			routelink_id = interned_routelink(conn, source_id, routelinkcode)
-			from_stoppoint_id = interned_atcocode(conn, from_stoppoint)
-			to_stoppoint_id = interned_atcocode(conn, to_stoppoint)
-			cur.execute("""
-				INSERT INTO routelink(source_id, routelink_id, routesection, from_stoppoint, to_stoppoint, direction)
-				VALUES (%s, %s, %s, %s, %s, %s)
-			""", (source_id, routelink_id, routesection, from_stoppoint_id, to_stoppoint_id, direction,))
+		from_stoppoint, to_stoppoint, direction = ROUTELINK_FIELDS(linkelem)
+
+		routelink_id = interned_routelink(conn, source_id, routelinkcode)
+		from_stoppoint_id = interned_atcocode(conn, from_stoppoint)
+		to_stoppoint_id = interned_atcocode(conn, to_stoppoint)
+		writer.add("routelink", (source_id, routelink_id, routesection, from_stoppoint_id, to_stoppoint_id, direction,))
+
+
+STOPPOINT_FIELDS = (fields()
+	.one("./tx:StopPointRef/text()")
+	.one("./tx:CommonName/text()")
+	.maybe_one("./tx:Indicator/text()")
+	.maybe_one("./tx:LocalityName/text()")
+	.maybe_one("./tx:LocalityQualifier/text()"))
 
 def add_stoppoint(elem, conn, _source_id, _args):
-	[stoppoint] = elem.xpath("./tx:StopPointRef/text()", namespaces=NAMESPACES)
-	[name] = elem.xpath("./tx:CommonName/text()", namespaces=NAMESPACES)
-	indicator = maybe_one(elem.xpath("./tx:Indicator/text()", namespaces=NAMESPACES))
-	locality_name = maybe_one(elem.xpath("./tx:LocalityName/text()", namespaces=NAMESPACES))
-	locality_qualifier = maybe_one(elem.xpath("./tx:LocalityQualifier/text()", namespaces=NAMESPACES))
-	with conn.cursor() as cur:
-		atcocode_id = interned_atcocode(conn, stoppoint)
-		cur.execute("""
-			INSERT INTO stoppoint(atcocode_id, name, indicator, locality_name, locality_qualifier)
-			VALUES (%s, %s, %s, %s, %s)
-			ON CONFLICT DO NOTHING
-		""", (atcocode_id, name, indicator, locality_name, locality_qualifier,))
+	stoppoint, name, indicator, locality_name, locality_qualifier = STOPPOINT_FIELDS(elem)
+	atcocode_id = interned_atcocode(conn, stoppoint)
+	bulk_writer(conn).add("stoppoint", (atcocode_id, name, indicator, locality_name, locality_qualifier,))
@@ -2,10 +2,17 @@
 # encoding: utf8
 
 from lxml import etree
+import io
 import logging
 
-def process_xml_file(xmlfile, parsers, args):
-	for tagname, elem in iter_elements(xmlfile, parsers.keys()):
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+def process_xml_file(xmlfile, parsers, args, namespace=None, buffer_size=DEFAULT_BUFFER_SIZE):
+	if namespace is None:
+		elements = iter_elements(xmlfile, parsers.keys())
+	else:
+		elements = iter_namespaced_elements(xmlfile, parsers.keys(), namespace, buffer_size)
+	for tagname, elem in elements:
 		try:
 			parser_func = parsers[tagname]
 			parser_func(elem, *args)
@@ -33,6 +40,21 @@ def iter_elements(xmlfile, interesting_tags):
 				cleanup(elem)
 	parser.close()
 
+def iter_namespaced_elements(xmlfile, interesting_tags, namespace, buffer_size=DEFAULT_BUFFER_SIZE):
+	"""Like iter_elements, but lets lxml do the work.
+
+	lxml reads the file itself (through a buffer of buffer_size, as it
+	only asks for 32KiB at a time), and only tells us about the
+	interesting tags in the given namespace.
+	"""
+	tagnames = {
+		"{%s}%s" % (namespace, tagname): tagname
+		for tagname in interesting_tags}
+	stream = io.BufferedReader(xmlfile, buffer_size)
+	for action, elem in etree.iterparse(stream, events=("end",), tag=list(tagnames), no_network=True):
+		yield tagnames[elem.tag], elem
+		cleanup(elem)
+
 def cleanup(element):
 	"""Deletes element from the tree.
 